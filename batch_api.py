@@ -0,0 +1,384 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from batch_extractor import iter_batch_jobs
+from config import REPO_DIR, prompt_registry
+from single_round_extractors import (
+    build_non_openai_request,
+    build_structured_output_request,
+    extraction_cache_key,
+    get_openai_client,
+    get_single_round_extractor,
+    load_pdf_pages,
+    structured_output_response_format,
+)
+from utils.cache import get_extraction_cache
+from utils.image import IMAGE_PROFILES
+from utils.pdf import select_extraction
+from utils.tracing import observe
+from utils.utils import parse_extraction
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Limits of one Batch API input file.
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_BYTES = 200 * 1024 * 1024
+
+
+def build_batch_request(
+    image_path, model: str, image_profile=None
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    (custom_id, Batch API input line) of the single round extraction of one
+    image (a path, or the bytes of a PDF page) with `model`.
+
+    custom_id is the extraction cache key: the same image, model, prompt
+    version and image profile always get the same id, however often a job is
+    submitted.
+    """
+    _, prompt_name, extract_json = get_single_round_extractor(model)
+    prompt_obj = prompt_registry.get_prompt(prompt_name)
+    custom_id = extraction_cache_key(image_path, prompt_obj, model, image_profile)
+
+    if extract_json:
+        body = build_non_openai_request(image_path, prompt_obj, model, image_profile)
+        # only understood by the langfuse.openai client
+        body.pop("langfuse_prompt")
+    else:
+        request = build_structured_output_request(
+            image_path, prompt_obj, model, image_profile
+        )
+        body = {
+            **request,
+            "response_format": structured_output_response_format(
+                request.pop("json_schema"), request.pop("schema_name")
+            ),
+        }
+
+    return custom_id, {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": body,
+    }
+
+
+def iter_job_requests(
+    job: Dict[str, Any], image_profile=None
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    The batch requests of a job: one per image, one per candidate page of a PDF.
+    """
+    image_path = Path(job["image_path"])
+    if image_path.suffix.lower() != ".pdf":
+        yield build_batch_request(image_path, job["model"], image_profile)
+        return
+
+    pages, page_profile = load_pdf_pages(image_path, image_profile=image_profile)
+    for page in pages:
+        yield build_batch_request(page.image, job["model"], page_profile)
+
+
+def write_batch_files(
+    requests: Iterable[Dict[str, Any]],
+    directory: Path,
+    max_requests: int = MAX_BATCH_REQUESTS,
+    max_bytes: int = MAX_BATCH_BYTES,
+) -> List[Path]:
+    """
+    Writes requests as JSONL input files, split to stay within the Batch API
+    limits. A custom_id already written (the same image twice) is skipped.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    batch_file = None
+    written = set()
+    n_requests = n_bytes = 0
+
+    try:
+        for request in requests:
+            if request["custom_id"] in written:
+                continue
+            line = (json.dumps(request) + "\n").encode()
+            if batch_file is None or (
+                n_requests + 1 > max_requests or n_bytes + len(line) > max_bytes
+            ):
+                if batch_file is not None:
+                    batch_file.close()
+                paths.append(directory / f"batch_input_{len(paths):03d}.jsonl")
+                batch_file = open(paths[-1], "wb")
+                n_requests = n_bytes = 0
+            batch_file.write(line)
+            written.add(request["custom_id"])
+            n_requests += 1
+            n_bytes += len(line)
+    finally:
+        if batch_file is not None:
+            batch_file.close()
+
+    return paths
+
+
+def submit_batch_files(
+    client, paths: List[Path], metadata: Optional[Dict[str, str]] = None
+) -> List[Dict[str, Any]]:
+    batches = []
+    for path in paths:
+        with open(path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata={**(metadata or {}), "input_file": path.name},
+        )
+        batches.append(batch.model_dump())
+    return batches
+
+
+def poll_batches(
+    client,
+    batch_ids: List[str],
+    interval_s: float = 30,
+    timeout_s: Optional[float] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Retrieves the batches every interval_s until they all reached a terminal
+    status. Raises TimeoutError after timeout_s.
+    """
+    deadline = None if timeout_s is None else time.monotonic() + timeout_s
+    while True:
+        batches = [
+            client.batches.retrieve(batch_id).model_dump() for batch_id in batch_ids
+        ]
+        if all(batch["status"] in TERMINAL_STATUSES for batch in batches):
+            return batches
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError(
+                f"Batches still running after {timeout_s}s: "
+                + ", ".join(
+                    b["id"] for b in batches if b["status"] not in TERMINAL_STATUSES
+                )
+            )
+        time.sleep(interval_s)
+
+
+def read_batch_results(client, batch: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    {custom_id: {"output", "error", "usage"}} of a finished batch, from its
+    output and error files.
+    """
+    results = {}
+    for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+        if file_id is None:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            body = response.get("body") or {}
+            result = {"output": None, "error": None, "usage": body.get("usage")}
+            if entry.get("error"):
+                result["error"] = entry["error"].get("message")
+            elif response.get("status_code") != 200:
+                error = body.get("error") or {}
+                result["error"] = (
+                    f"{response.get('status_code')}: {error.get('message')}"
+                )
+            else:
+                result["output"] = body["choices"][0]["message"]["content"]
+            results[entry["custom_id"]] = result
+    return results
+
+
+@observe()
+def submit_batch_jobs(
+    jobs: Iterable[Dict[str, Any]],
+    state_path: Path,
+    image_profile=None,
+    use_cache: bool = True,
+    client=None,
+) -> Dict[str, Any]:
+    """
+    Builds the requests of jobs, submits those not already in the extraction
+    cache as Batch API batches, and saves the jobs, their custom_ids and the
+    batches to state_path for collect_batch_jobs.
+    """
+    client = client or get_openai_client()
+    cache = get_extraction_cache() if use_cache else None
+
+    state_jobs = []
+    requests = []
+    for job in jobs:
+        custom_ids = []
+        for custom_id, request in iter_job_requests(job, image_profile):
+            custom_ids.append(custom_id)
+            if cache is None or cache.get(custom_id) is None:
+                requests.append(request)
+        state_jobs.append({**job, "custom_ids": custom_ids})
+
+    paths = write_batch_files(requests, state_path.parent / f"{state_path.stem}_input")
+    state = {
+        "created_at": time.time(),
+        "image_profile": image_profile,
+        "jobs": state_jobs,
+        "batches": submit_batch_files(client, paths, {"state": state_path.name}),
+    }
+    state_path.write_text(json.dumps(state, indent=2))
+    return state
+
+
+def collect_batch_jobs(
+    state_path: Path,
+    output_path: Path,
+    use_cache: bool = True,
+    poll_interval_s: float = 30,
+    timeout_s: Optional[float] = None,
+    client=None,
+) -> Dict[str, int]:
+    """
+    Waits for the batches in state_path, then appends one record per job to
+    output_path, in the format of batch_extractor. Outputs are stored in the
+    extraction cache under their custom_id, so the online extractors reuse
+    them and a resubmission only sends the requests that failed.
+    """
+    client = client or get_openai_client()
+    cache = get_extraction_cache() if use_cache else None
+    state = json.loads(state_path.read_text())
+
+    batches = poll_batches(
+        client, [batch["id"] for batch in state["batches"]], poll_interval_s, timeout_s
+    )
+    state["batches"] = batches
+    state_path.write_text(json.dumps(state, indent=2))
+
+    results = {}
+    for batch in batches:
+        results.update(read_batch_results(client, batch))
+
+    stats = {"succeeded": 0, "failed": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    for custom_id, result in results.items():
+        for key in ("prompt_tokens", "completion_tokens"):
+            stats[key] += (result["usage"] or {}).get(key, 0)
+        if cache is not None and result["output"]:
+            cache.set(custom_id, result["output"])
+
+    with open(output_path, "a") as output_file:
+        for job in state["jobs"]:
+            record = {**job, "output": None, "error": None}
+            outputs, errors = [], []
+            for custom_id in job["custom_ids"]:
+                result = results.get(custom_id)
+                if result is None and cache is not None:
+                    result = {"output": cache.get(custom_id), "error": None}
+                if result is None or result["output"] is None:
+                    errors.append(
+                        (result or {}).get("error") or f"No result for {custom_id}"
+                    )
+                else:
+                    outputs.append(result["output"])
+
+            if errors or not outputs:
+                record["error"] = "; ".join(errors) or "No pages to extract"
+                stats["failed"] += 1
+            else:
+                record["output"] = (
+                    outputs[0]
+                    if len(job["custom_ids"]) == 1
+                    else select_extraction(
+                        [parse_extraction(output) for output in outputs]
+                    ).model_dump_json()
+                )
+                stats["succeeded"] += 1
+            output_file.write(json.dumps(record) + "\n")
+
+    return stats
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Extract ChangeInAccountValue offline through the provider's Batch API."
+    )
+    parser.add_argument("command", choices=["submit", "status", "collect", "run"])
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default=REPO_DIR / "data",
+        type=Path,
+        help="Directory of images or JSONL manifest of image paths (submit and run)",
+    )
+    parser.add_argument("--pattern", default="*.png")
+    parser.add_argument("--models", nargs="+", default=["gpt-4o"])
+    parser.add_argument("--output", type=Path, default=Path("extractions.jsonl"))
+    parser.add_argument(
+        "--state",
+        type=Path,
+        default=Path("batch_state.json"),
+        help="Submitted batches and jobs, written by submit and read by status and collect",
+    )
+    parser.add_argument("--poll-interval", type=float, default=30)
+    parser.add_argument("--timeout", type=float, help="Seconds to wait for the batches")
+    parser.add_argument("--image-profile", choices=list(IMAGE_PROFILES))
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Submit every request, and don't store the outputs in the extraction cache",
+    )
+    parser.add_argument(
+        "--mock",
+        action="store_true",
+        help="Run against an in-process mock_server instead of LITELLM_HOST/LANGFUSE_HOST",
+    )
+    args = parser.parse_args()
+
+    if args.mock:
+        if args.command != "run":
+            parser.error("--mock only keeps its batches for the run command")
+        # the mock's files and batches only live as long as this process
+        from mock_server import MockServer
+
+        mock = MockServer().start()
+        os.environ["LITELLM_HOST"] = mock.url
+        os.environ["LANGFUSE_HOST"] = mock.url
+        os.environ["LANGFUSE_PUBLIC_KEY"] = "pk-lf-mock"
+        os.environ["LANGFUSE_SECRET_KEY"] = "sk-lf-mock"
+
+    prompt_registry.prefetch()
+
+    if args.command in ("submit", "run"):
+        state = submit_batch_jobs(
+            iter_batch_jobs(args.source, args.pattern, args.models),
+            args.state,
+            image_profile=args.image_profile,
+            use_cache=not args.no_cache,
+        )
+        print(
+            {
+                "jobs": len(state["jobs"]),
+                "batches": [batch["id"] for batch in state["batches"]],
+            }
+        )
+
+    if args.command == "status":
+        client = get_openai_client()
+        for batch in json.loads(args.state.read_text())["batches"]:
+            batch = client.batches.retrieve(batch["id"])
+            print(batch.id, batch.status, batch.request_counts)
+
+    if args.command in ("collect", "run"):
+        print(
+            collect_batch_jobs(
+                args.state,
+                args.output,
+                use_cache=not args.no_cache,
+                poll_interval_s=args.poll_interval,
+                timeout_s=args.timeout,
+            )
+        )
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from config import REPO_DIR, prompt_registry
+from single_round_extractors import (
+    a_cascade_single_round_extractor,
+    a_pdf_single_round_extractor,
+    get_single_round_extractor,
+)
+from utils.concurrency import get_rate_controller, retry_limit
+from utils.image import IMAGE_PROFILES
+from utils.tracing import langfuse_context
+
+# Model name for jobs run through the cheapest-first cascade.
+CASCADE = "cascade"
+
+
+def iter_batch_jobs(
+    source: Path, pattern: str = "*.png", models: Sequence[str] = ("gpt-4o",)
+) -> Iterator[Dict]:
+    """
+    Yields one job per (image, model).
+
+    source is either a directory, globbed with pattern, or a JSONL manifest with
+    one {"image_path": ..., "model": ..., "id": ...} object per line. "model" and
+    "id" are optional in the manifest. PDFs are extracted page by page.
+    """
+    source = Path(source)
+
+    if source.is_dir():
+        for image_path in sorted(source.glob(pattern)):
+            for model in models:
+                yield {
+                    "id": image_path.stem,
+                    "image_path": str(image_path),
+                    "model": model,
+                }
+        return
+
+    with open(source) as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            job_models = [entry["model"]] if entry.get("model") else models
+            for model in job_models:
+                yield {
+                    "id": entry.get("id", Path(entry["image_path"]).stem),
+                    "image_path": entry["image_path"],
+                    "model": model,
+                }
+
+
+async def run_batch_extraction(
+    jobs: Iterator[Dict],
+    output_path: Path,
+    concurrency: int = 8,
+    rate_limits: Optional[Dict[str, float]] = None,
+    max_retries: int = 3,
+    image_profile: Optional[str] = None,
+) -> Dict[str, int]:
+    """
+    Runs the single round extractors over jobs with at most `concurrency`
+    documents in flight. Each result is appended to output_path as soon as it
+    completes, so the file can be tailed while the batch is running.
+
+    Requests per model are paced, and retried, by the process' rate controller
+    (utils.concurrency), rate_limits sets its requests per second. max_retries
+    only applies to this run's requests.
+    """
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    controller = get_rate_controller()
+    for model, rate in (rate_limits or {}).items():
+        controller.configure(model, rate=rate)
+    stats = {"succeeded": 0, "failed": 0}
+
+    with open(output_path, "a") as output_file:
+
+        async def worker():
+            while True:
+                job = await queue.get()
+                if job is None:
+                    queue.task_done()
+                    return
+
+                extractor, prompt_name = None, None
+                if job["model"] != CASCADE:
+                    extractor, prompt_name, _ = get_single_round_extractor(
+                        job["model"], asynchronous=True
+                    )
+                if Path(job["image_path"]).suffix.lower() == ".pdf":
+                    extractor = a_pdf_single_round_extractor
+                record = {**job, "output": None, "error": None}
+                start = time.perf_counter()
+
+                async def extract():
+                    if job["model"] == CASCADE:
+                        result = await a_cascade_single_round_extractor(
+                            Path(job["image_path"]), image_profile=image_profile
+                        )
+                        record["cascade_model"] = result.model
+                        return result.output
+
+                    return await extractor(
+                        Path(job["image_path"]),
+                        prompt_name,
+                        model=job["model"],
+                        image_profile=image_profile,
+                    )
+
+                try:
+                    with retry_limit(max_retries):
+                        record["output"] = await extract()
+                    stats["succeeded"] += 1
+                except Exception as e:
+                    record["error"] = f"{type(e).__name__}: {e}"
+                    stats["failed"] += 1
+
+                record["latency_s"] = round(time.perf_counter() - start, 3)
+                output_file.write(json.dumps(record) + "\n")
+                output_file.flush()
+                queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+
+        for job in jobs:
+            await queue.put(job)
+        for _ in workers:
+            await queue.put(None)
+
+        await asyncio.gather(*workers)
+
+    langfuse_context.flush()
+
+    stats["rate_control"] = controller.stats()
+    return stats
+
+
+def parse_rate_limits(values: List[str]) -> Dict[str, float]:
+    rate_limits = {}
+    for value in values:
+        model, rate = value.split("=", 1)
+        rate_limits[model] = float(rate)
+    return rate_limits
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Extract ChangeInAccountValue from many statements concurrently."
+    )
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default=REPO_DIR / "data",
+        type=Path,
+        help="Directory of images or JSONL manifest of image paths",
+    )
+    parser.add_argument("--pattern", default="*.png")
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=["gpt-4o"],
+        help=f"Models to run, or '{CASCADE}' for the cheapest-first cascade",
+    )
+    parser.add_argument("--output", type=Path, default=Path("extractions.jsonl"))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--rate-limit",
+        action="append",
+        default=[],
+        metavar="MODEL=REQUESTS_PER_SECOND",
+    )
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--image-profile", choices=list(IMAGE_PROFILES))
+    args = parser.parse_args()
+
+    prompt_registry.prefetch()
+    prompt_registry.start_background_refresh()
+
+    stats = asyncio.run(
+        run_batch_extraction(
+            iter_batch_jobs(args.source, args.pattern, args.models),
+            args.output,
+            concurrency=args.concurrency,
+            rate_limits=parse_rate_limits(args.rate_limit),
+            max_retries=args.max_retries,
+            image_profile=args.image_profile,
+        )
+    )
+    print(stats)
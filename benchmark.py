@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List
+
+import numpy as np
+
+from utils.timing import STAGES, collect_timings, count, timed
+
+REPO_DIR = Path(__file__).parent
+
+TARGETS = (
+    "openai_structured",
+    "openai_streaming",
+    "non_openai",
+    "multiagent",
+    "multiagent_new",
+)
+
+
+def instrument_tracing():
+    """
+    Times the Langfuse calls made from the pipeline as the "tracing" stage.
+    """
+    from langfuse.decorators import langfuse_context
+
+    def wrap(method):
+        def wrapper(*args, **kwargs):
+            with timed("tracing"):
+                return method(*args, **kwargs)
+
+        return wrapper
+
+    for name in (
+        "update_current_observation",
+        "update_current_trace",
+        "score_current_trace",
+        "flush",
+    ):
+        setattr(langfuse_context, name, wrap(getattr(langfuse_context, name)))
+
+
+def count_chat_usage(chat_results):
+    """
+    Counts the tokens of every chat, and the replies of the extractor agents:
+    a chat whose extraction passes validation ends after one.
+    """
+    for chat_result in chat_results.values():
+        # the initiator's messages are "assistant", the recipient's "user"
+        count(
+            "extractor_replies",
+            sum(message["role"] == "user" for message in chat_result.chat_history),
+        )
+        usage = chat_result.cost.get("usage_including_cached_inference", {})
+        for model, model_usage in usage.items():
+            if model == "total_cost":
+                continue
+            count("prompt_tokens", model_usage.get("prompt_tokens", 0))
+            count("completion_tokens", model_usage.get("completion_tokens", 0))
+
+
+def get_target(
+    name: str, openai_model: str, non_openai_model: str, use_cache: bool
+) -> Callable[[Path], Awaitable[Any]]:
+    """
+    Returns an async function extracting one document with the entry point
+    `name`. Sync extractors run in a thread.
+    """
+    if name == "openai_structured":
+        from single_round_extractors import (
+            openai_single_round_extractor_with_structured_outputs,
+        )
+
+        return lambda image_path: asyncio.to_thread(
+            openai_single_round_extractor_with_structured_outputs,
+            image_path,
+            "extractor_system_prompt",
+            model=openai_model,
+            use_cache=use_cache,
+        )
+
+    if name == "openai_streaming":
+        from single_round_extractors import a_streaming_single_round_extractor
+
+        async def run_streaming(image_path):
+            async for partial in a_streaming_single_round_extractor(
+                image_path,
+                "extractor_system_prompt",
+                model=openai_model,
+                use_cache=use_cache,
+            ):
+                pass
+            return partial.output
+
+        return run_streaming
+
+    if name == "non_openai":
+        from single_round_extractors import non_openai_single_round_extractor
+
+        return lambda image_path: asyncio.to_thread(
+            non_openai_single_round_extractor,
+            image_path,
+            "qwen_extractor_prompt",
+            model=non_openai_model,
+            use_cache=use_cache,
+        )
+
+    if name == "multiagent":
+        from multi_agent_extractor import multiagent_extractor as extractor
+    elif name == "multiagent_new":
+        from multi_agent_extractor_new_arch import (
+            multiagent_extractor_new as extractor,
+        )
+    else:
+        raise ValueError(f"Unknown benchmark target {name}")
+
+    async def run_multiagent(image_path):
+        chat_results = await extractor(image_path)
+        count_chat_usage(chat_results)
+        return chat_results
+
+    return run_multiagent
+
+
+async def run_document(target, image_path: Path) -> Dict[str, Any]:
+    with collect_timings() as timings:
+        error = None
+        start = time.perf_counter()
+        try:
+            await target(image_path)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        latency_s = time.perf_counter() - start
+
+    return {
+        "image": image_path.name,
+        "latency_s": latency_s,
+        "error": error,
+        **timings.to_dict(),
+    }
+
+
+def summarize(documents: List[Dict[str, Any]], wall_s: float) -> Dict[str, Any]:
+    """
+    Latency percentiles and throughput, plus the mean time per stage and mean
+    counters (bytes, tokens, turns) per successful document. Stages of
+    concurrent calls within a document are summed, so "other" can be negative
+    for the multi-agent extractors.
+    """
+    succeeded = [doc for doc in documents if doc["error"] is None]
+    latencies = np.array([doc["latency_s"] for doc in succeeded])
+
+    summary = {
+        "documents": len(documents),
+        "errors": len(documents) - len(succeeded),
+        "wall_s": round(wall_s, 3),
+        "documents_per_s": round(len(succeeded) / wall_s, 3) if wall_s else None,
+    }
+    if not succeeded:
+        return summary
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    summary["latency_s"] = {
+        "p50": round(float(p50), 4),
+        "p95": round(float(p95), 4),
+        "p99": round(float(p99), 4),
+        "mean": round(float(latencies.mean()), 4),
+        "max": round(float(latencies.max()), 4),
+    }
+
+    stage_names = list(STAGES) + sorted(
+        {s for doc in succeeded for s in doc["stages"]} - set(STAGES)
+    )
+    stages = {
+        stage: float(np.mean([doc["stages"].get(stage, 0.0) for doc in succeeded]))
+        for stage in stage_names
+    }
+    stages["other"] = float(latencies.mean()) - sum(stages.values())
+    summary["stages_s"] = {stage: round(value, 4) for stage, value in stages.items()}
+
+    counter_names = sorted({c for doc in succeeded for c in doc["counters"]})
+    summary["per_document"] = {
+        name: round(
+            float(np.mean([doc["counters"].get(name, 0) for doc in succeeded])), 2
+        )
+        for name in counter_names
+    }
+    return summary
+
+
+async def run_level(target, images: List[Path], concurrency: int, repeat: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(image_path):
+        async with semaphore:
+            return await run_document(target, image_path)
+
+    start = time.perf_counter()
+    documents = await asyncio.gather(*(bounded(p) for p in images * repeat))
+    wall_s = time.perf_counter() - start
+
+    errors = sorted({doc["error"] for doc in documents if doc["error"]})
+    return {**summarize(documents, wall_s), "error_messages": errors[:5]}
+
+
+async def run_benchmark(
+    targets: List[str],
+    images: List[Path],
+    concurrency_levels: List[int],
+    repeat: int = 1,
+    warmup: int = 1,
+    openai_model: str = "gpt-4o",
+    non_openai_model: str = "pixtral-12b",
+    use_cache: bool = False,
+) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    for name in targets:
+        target = get_target(name, openai_model, non_openai_model, use_cache)
+        for image_path in images[:warmup]:
+            await run_document(target, image_path)
+
+        results[name] = {}
+        for concurrency in concurrency_levels:
+            results[name][str(concurrency)] = await run_level(
+                target, images, concurrency, repeat
+            )
+            print(name, concurrency, json.dumps(results[name][str(concurrency)]))
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the extractor entry points over sample statements."
+    )
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=TARGETS)
+    parser.add_argument(
+        "--images", default="data/*.png", help="Glob, relative to the repo"
+    )
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Times each image is extracted per level"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="Untimed documents per target"
+    )
+    parser.add_argument("--openai-model", default="gpt-4o")
+    parser.add_argument("--non-openai-model", default="pixtral-12b")
+    parser.add_argument(
+        "--use-cache", action="store_true", help="Use the extraction cache"
+    )
+    parser.add_argument(
+        "--mock",
+        action="store_true",
+        help="Run against an in-process mock_server instead of LITELLM_HOST/LANGFUSE_HOST",
+    )
+    parser.add_argument("--output", type=Path, default=Path("benchmark.json"))
+    args = parser.parse_args()
+
+    mock = None
+    if args.mock:
+        # before config is imported, so every client points at the mock
+        from mock_server import MockServer
+
+        mock = MockServer().start()
+        os.environ["LITELLM_HOST"] = mock.url
+        os.environ["LANGFUSE_HOST"] = mock.url
+        os.environ["LANGFUSE_PUBLIC_KEY"] = "pk-lf-mock"
+        os.environ["LANGFUSE_SECRET_KEY"] = "sk-lf-mock"
+
+    from config import prompt_registry
+    from langfuse.decorators import langfuse_context
+    from utils.concurrency import get_rate_controller
+    from utils.trace_export import get_trace_exporter
+    from utils.utils import get_commit_hash
+
+    instrument_tracing()
+    prompt_registry.prefetch()
+
+    images = sorted(REPO_DIR.glob(args.images))
+
+    results = asyncio.run(
+        run_benchmark(
+            args.targets,
+            images,
+            args.concurrency,
+            repeat=args.repeat,
+            warmup=args.warmup,
+            openai_model=args.openai_model,
+            non_openai_model=args.non_openai_model,
+            use_cache=args.use_cache,
+        )
+    )
+
+    report = {
+        "commit_hash": get_commit_hash(REPO_DIR),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "mock": args.mock,
+        "images": [str(p.relative_to(REPO_DIR)) for p in images],
+        "settings": {
+            k: v for k, v in vars(args).items() if k not in ("output", "images")
+        },
+        "results": results,
+        "rate_control": get_rate_controller().stats(),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if mock is not None:
+        # send the remaining trace events before the mock goes away
+        get_trace_exporter().flush()
+        langfuse_context.flush()
+        mock.stop()
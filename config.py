@@ -1,11 +1,7 @@
-from utils.utils import encode_image
 from pathlib import Path
-from langfuse.openai import openai
-from langfuse import Langfuse
-import json
-from copy import deepcopy
-from langfuse.decorators import observe, langfuse_context
-from utils.utils import get_git_repository_info
+from utils.utils import get_langfuse_client
+from utils.prompts import PromptRegistry
+from utils.cascade import order_by_cost
 from dotenv import load_dotenv
 from os import getenv
 
@@ -20,14 +16,38 @@ MODELS = [
     "llama-3.2-11b-vision-preview",
 ]
 
-langfuse_client = Langfuse(
-    host=getenv("LANGFUSE_HOST"),
-    secret_key=getenv("LANGFUSE_SECRET_KEY"),
-    public_key=getenv("LANGFUSE_PUBLIC_KEY"),
-)
+# Approximate USD per 1M input tokens, only used to order the cascade.
+MODEL_COSTS = {
+    "qwen2-vl-7b": 0.1,
+    "pixtral-12b": 0.15,
+    "gpt-4o-mini": 0.15,
+    "llama-3.2-11b-vision-preview": 0.18,
+    "gpt-4o": 2.5,
+    "claude-3.5-sonnet": 3.0,
+}
+
+# Models tried by the cascade extractors, cheapest first.
+CASCADE_MODELS = [
+    model for model in getenv("CASCADE_MODELS", "").split(",") if model
+] or order_by_cost(MODELS, MODEL_COSTS)
+CASCADE_THRESHOLD = float(getenv("CASCADE_THRESHOLD", 0.7))
+
+# What multimodal agents send on follow-up turns instead of the full image:
+# "crop", "reference" or "full", see utils.image_reuse. With "reference" a
+# re-extraction asked for by the verifier is done without the image.
+IMAGE_REUSE = getenv("IMAGE_REUSE", "crop")
 
 REPO_DIR = Path(__file__).parent
 
+# The Langfuse client is created on the first prompt fetch, not on import.
+prompt_registry = PromptRegistry(
+    get_langfuse_client,
+    ttl_seconds=float(getenv("PROMPT_CACHE_TTL", 300)),
+    snapshot_path=getenv(
+        "PROMPT_SNAPSHOT_PATH", REPO_DIR / ".cache" / "prompts.json"
+    ),
+)
+
 
 AUTOGEN_ALL_LLMS_CONFIG = {"config_list":[]}
 
@@ -39,3 +59,10 @@ for model in MODELS:
             "base_url": getenv("LITELLM_HOST"),
         }
     )
+
+
+def __getattr__(name):
+    # config.langfuse_client is created on first access
+    if name == "langfuse_client":
+        return get_langfuse_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
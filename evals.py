@@ -1,10 +1,16 @@
-from config import langfuse_client
+from config import langfuse_client, prompt_registry, MODELS, CASCADE_MODELS
+import argparse
 import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from single_round_extractors import (
-    openai_single_round_extractor_with_structured_outputs,
-    non_openai_single_round_extractor,
+    cascade_single_round_extractor,
+    get_single_round_extractor,
 )
-from utils.utils import extract_jsons_from_message_content
+from utils.concurrency import get_rate_controller
+from utils.json_recovery import recover_extraction
+from utils.metrics import EvalFrames, evaluate, record_scores
 from pathlib import Path
 
 models = [
@@ -16,65 +22,312 @@ models = [
     # "llama-3.2-11b-vision-preview",
 ]
 
-dataset = langfuse_client.get_dataset("brokerage_statements_table_extraction")
+DATASET_NAME = "brokerage_statements_table_extraction"
+
+# Pseudo model running the cheapest-first cascade over config.CASCADE_MODELS.
+CASCADE = "cascade"
 
 
 def eval_exact_match(output_json, expected_output_json):
+    """
+    Share of the expected fields the output gets exactly right, once numbers
+    and dates are normalized. Use utils.metrics directly to score many outputs.
+    """
+    frames = EvalFrames.from_records(
+        [{"output": output_json, "expected_output": expected_output_json}]
+    )
+    return float(record_scores(frames)["exact"].iloc[0])
+
+
+class EvalCheckpoint:
+    """
+    Append-only JSONL record of finished (item, model, prompt_version) runs,
+    so an interrupted eval resumes where it stopped.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.completed = set()
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.completed.add(self.key(**record))
+
+    @staticmethod
+    def key(item_id, model, prompt_version, **_):
+        return (item_id, model, prompt_version)
+
+    def is_done(self, item_id, model, prompt_version):
+        return self.key(item_id, model, prompt_version) in self.completed
+
+    def records(self):
+        if not self.path.exists():
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def add(self, records):
+        with self._lock:
+            with open(self.path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+                    self.completed.add(self.key(**record))
+
+
+class ScoreBatcher:
+    """
+    Buffers eval runs, scores each batch in one vectorized pass and submits the
+    scores to Langfuse. Runs are only checkpointed once their score has been
+    flushed.
+    """
+
+    def __init__(self, checkpoint: EvalCheckpoint, batch_size: int = 20):
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def add(self, record):
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) < self.batch_size:
+                return
+            batch, self._pending = self._pending, []
+        self._submit(batch)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        self._submit(batch)
+
+    def _submit(self, batch):
+        if not batch:
+            return
+        scores = record_scores(EvalFrames.from_records(batch))
+        for record, exact, match in zip(batch, scores["exact"], scores["match"]):
+            record["score"] = float(exact)
+            record["match_score"] = float(match)
+            langfuse_client.score(
+                trace_id=record["trace_id"],
+                name="exact_match",
+                value=record["score"],
+                comment=f"Exact match model={record['model']}, image={record['image_name']}",
+            )
+            langfuse_client.score(
+                trace_id=record["trace_id"],
+                name="tolerant_match",
+                value=record["match_score"],
+                comment=f"Match within tolerance model={record['model']}, image={record['image_name']}",
+            )
+        langfuse_client.flush()
+        self.checkpoint.add(batch)
+
+
+def cascade_application(image_path, prompt_name, model):
+    # the cascade output is already normalized JSON
+    return cascade_single_round_extractor(image_path).output
+
+
+def get_eval_application(model):
+    """
+    Returns (llm_application, langfuse_prompt_name, extract_json) for a model
+    or the cascade.
+    """
+    if model == CASCADE:
+        return cascade_application, CASCADE, False
+    return get_single_round_extractor(model)
+
 
-    expected_output_dict = json.loads(expected_output_json)
-    try:
-        output_dict = json.loads(output_json)
-    except:
-        return 0
+def get_prompt_version(prompt_name):
+    if prompt_name == CASCADE:
+        # the cascade uses the prompts of every model it may escalate to
+        prompt_names = sorted(
+            {get_single_round_extractor(model)[1] for model in CASCADE_MODELS}
+        )
+        return ",".join(
+            f"{name}:{prompt_registry.get_prompt(name).version}"
+            for name in prompt_names
+        )
+    return prompt_registry.get_prompt(prompt_name).version
 
-    score = 0
-    for key, value in expected_output_dict.items():
-        if key in output_dict and output_dict[key] == value:
-            score += 1
-    return score / len(expected_output_dict)
 
+def run_eval(item, model, prompt_name, prompt_version, extract_json):
 
-for item in dataset.items:
+    llm_application, _, _ = get_eval_application(model)
 
     image_path = item.input["args"][0]
 
     image_name = Path(image_path).stem
 
+    with item.observe(
+        run_name=f"{model}_eval",
+        run_description=f"Eval {model}",
+        run_metadata={
+            "model": model,
+            "prompt_version": prompt_version,
+            "prompt_name": prompt_name,
+        },
+    ) as trace_id:
+        output = llm_application(image_path, prompt_name, model=model)
+        repairs = []
+        output_json = output
+        if extract_json:
+            recovery = recover_extraction(output)
+            repairs = recovery.repairs
+            if recovery.extraction is not None:
+                output_json = recovery.extraction.model_dump_json()
+            elif recovery.data is not None:
+                output_json = json.dumps(recovery.data)
+
+    return {
+        "item_id": item.id,
+        "model": model,
+        "prompt_name": prompt_name,
+        "prompt_version": prompt_version,
+        "image_name": image_name,
+        "trace_id": trace_id,
+        "output": output_json,
+        "expected_output": item.expected_output,
+        "repairs": repairs,
+    }
+
+
+def run_evals(
+    dataset_name=DATASET_NAME,
+    models=models,
+    item_ids=None,
+    limit=None,
+    max_concurrency_per_model=4,
+    checkpoint_path=Path(".eval_checkpoint.jsonl"),
+    score_batch_size=20,
+):
+    """
+    Runs every (item, model) pair of the dataset on a thread pool, with at most
+    max_concurrency_per_model calls in flight per model. Pairs already in the
+    checkpoint for the current prompt version are skipped.
+    """
+    dataset = langfuse_client.get_dataset(dataset_name)
+
+    items = dataset.items
+    if item_ids:
+        items = [item for item in items if item.id in item_ids]
+    if limit:
+        items = items[:limit]
+
+    checkpoint = EvalCheckpoint(checkpoint_path)
+    scores = ScoreBatcher(checkpoint, batch_size=score_batch_size)
+    # created up front, the worker threads only read it
+    model_slots = {
+        model: threading.Semaphore(max_concurrency_per_model) for model in models
+    }
+
+    prompt_versions = {}
+    pairs = []
     for model in models:
+        _, prompt_name, extract_json = get_eval_application(model)
+        if prompt_name not in prompt_versions:
+            prompt_versions[prompt_name] = get_prompt_version(prompt_name)
+        for item in items:
+            if not checkpoint.is_done(item.id, model, prompt_versions[prompt_name]):
+                pairs.append(
+                    (
+                        item,
+                        model,
+                        prompt_name,
+                        prompt_versions[prompt_name],
+                        extract_json,
+                    )
+                )
+
+    def run_pair(item, model, *args):
+        with model_slots[model]:
+            return run_eval(item, model, *args)
 
-        if "gpt" in model or "o1" in model:
-            llm_application = openai_single_round_extractor_with_structured_outputs
-            prompt_name = "extractor_system_prompt"
-            extract_json = False
-        else:
-            llm_application = non_openai_single_round_extractor
-            extract_json = True
-            prompt_name = "qwen_extractor_prompt"
-
-        prompt = langfuse_client.get_prompt(prompt_name)
-        with item.observe(
-            run_name=f"{model}_eval",
-            run_description=f"Eval {model}",
-            run_metadata={
-                "model": model,
-                "prompt_version": prompt.version,
-                "prompt_name": prompt_name,
-            },
-        ) as trace_id:
+    results = {
+        "skipped": len(items) * len(models) - len(pairs),
+        "scored": 0,
+        "failed": 0,
+    }
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_concurrency_per_model * len(models))
+    ) as executor:
+        futures = {executor.submit(run_pair, *pair): pair for pair in pairs}
+        for future in as_completed(futures):
+            item, model = futures[future][:2]
             try:
-                output = llm_application(image_path, prompt_name, model=model)
-                if extract_json :
-                    output_json = extract_jsons_from_message_content(output)[0]
-                else:
-                    output_json = output
-                langfuse_client.score(
-                    trace_id=trace_id,
-                    name="exact_match",
-                    value=eval_exact_match(output_json, item.expected_output),
-                    comment=f"Exact match model={model}, image={image_name}",
-                )
-            except Exception as e:
-                print(f"Error: {e}")
-                continue
+                scores.add(future.result())
+                results["scored"] += 1
+            except Exception:
+                results["failed"] += 1
+                print(f"Error: item={item.id} model={model}\n{traceback.format_exc()}")
+
+    scores.flush()
+
+    # throttling per model, failed pairs are usually retries that ran out
+    results["rate_control"] = get_rate_controller().stats()
+    return results
+
+
+def field_report(checkpoint_path=Path(".eval_checkpoint.jsonl"), models=None):
+    """
+    Field level metrics (utils.metrics.evaluate) over the checkpointed runs of
+    each model's latest prompt version.
+    """
+    records = [
+        record
+        for record in EvalCheckpoint(checkpoint_path).records()
+        if "output" in record and (models is None or record["model"] in models)
+    ]
+    latest_versions = {record["model"]: record["prompt_version"] for record in records}
+    records = [
+        record
+        for record in records
+        if record["prompt_version"] == latest_versions[record["model"]]
+    ]
+    return evaluate(records)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run extraction evals on a dataset.")
+    parser.add_argument("--dataset", default=DATASET_NAME)
+    parser.add_argument(
+        "--models", nargs="+", default=models, choices=MODELS + [CASCADE]
+    )
+    parser.add_argument("--items", nargs="+", help="Only run these dataset item ids")
+    parser.add_argument("--limit", type=int, help="Only run the first N items")
+    parser.add_argument("--max-concurrency-per-model", type=int, default=4)
+    parser.add_argument(
+        "--checkpoint", type=Path, default=Path(".eval_checkpoint.jsonl")
+    )
+    parser.add_argument("--score-batch-size", type=int, default=20)
+    parser.add_argument(
+        "--metrics-output",
+        type=Path,
+        help="Write the model x field metrics to this CSV file",
+    )
+    args = parser.parse_args()
+
+    prompt_registry.prefetch()
+    prompt_registry.start_background_refresh()
+
+    print(
+        run_evals(
+            dataset_name=args.dataset,
+            models=args.models,
+            item_ids=args.items,
+            limit=args.limit,
+            max_concurrency_per_model=args.max_concurrency_per_model,
+            checkpoint_path=args.checkpoint,
+            score_batch_size=args.score_batch_size,
+        )
+    )
 
-langfuse_client.flush()
+    report = field_report(args.checkpoint, args.models)
+    print(report["match_matrix"].T.to_string())
+    if args.metrics_output:
+        report["fields"].to_csv(args.metrics_output)
@@ -0,0 +1,89 @@
+import argparse
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+REPO_DIR = Path(__file__).parent
+
+# Modules the CLIs start from.
+ENTRY_MODULES = (
+    "config",
+    "single_round_extractors",
+    "batch_extractor",
+    "evals",
+    "multi_agent_extractor",
+    "multi_agent_extractor_new_arch",
+)
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure_import(module: str) -> Tuple[float, List[Tuple[str, float]]]:
+    """
+    Imports `module` in a fresh interpreter with -X importtime.
+
+    Returns the cumulative import time in ms and the (package, cumulative ms)
+    of its direct and indirect top-level dependencies, heaviest first.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    total_ms = 0.0
+    packages: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        indent, name = match.group(3), match.group(4)
+        if name == module:
+            total_ms = cumulative_ms
+            break
+        if len(indent) == 1:
+            # a finished top-level import unrelated to module, e.g. site
+            packages = {}
+            continue
+        # a package's first import carries the cost of everything under it
+        package = name.split(".")[0]
+        packages[package] = max(packages.get(package, 0.0), cumulative_ms)
+
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return total_ms, heaviest
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Check the import time of the CLI entry modules."
+    )
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_MODULES))
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=None,
+        help="Exit non-zero if any module takes longer to import",
+    )
+    parser.add_argument(
+        "--top", type=int, default=5, help="Heaviest dependencies to show"
+    )
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        total_ms, heaviest = measure_import(module)
+        deps = ", ".join(f"{name} {ms:.0f}ms" for name, ms in heaviest[: args.top])
+        print(f"{module}: {total_ms:.0f}ms ({deps})")
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"Over the {args.budget_ms:.0f}ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
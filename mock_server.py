@@ -0,0 +1,826 @@
+import argparse
+import email.policy
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+from utils.schema import ChangeInAccountValue
+
+REPO_DIR = Path(__file__).parent
+
+# Consistent with every accounting identity, so validation and the cascade
+# accept it.
+DEFAULT_RESPONSE = ChangeInAccountValue(
+    reporting_period_start_date="2024-05-01",
+    reporting_period_end_date="2024-05-31",
+    starting_value=3295752.51,
+    credits=37997.22,
+    debits=-37974.82,
+    transfer_of_securities=4480.0,
+    income_reinvested=-347.97,
+    change_in_investment_value=45927.86,
+    accrued_income=5577.94,
+    ending_value_with_accrued_income=3351412.74,
+    ending_value=3345834.80,
+    total_change_in_value=50082.29,
+).model_dump()
+
+_SCHEMA = ChangeInAccountValue.model_json_schema()
+_EXTRACTOR_SYSTEM_PROMPT = (
+    "You are an assistant in charge of looking at brokerage account statements "
+    "for your clients. Extract the relevant information from the account "
+    "statement. If a field is not present in the statement, leave it as null."
+)
+
+# Served when the prompts file has no entry for a prompt. Same format as the
+# PromptRegistry snapshot (utils.prompts.prompt_to_dict).
+DEFAULT_PROMPTS = {
+    "extractor_system_prompt": {
+        "type": "text",
+        "prompt": _EXTRACTOR_SYSTEM_PROMPT,
+        "config": {"json_schema": _SCHEMA},
+    },
+    "qwen_extractor_prompt": {
+        "type": "chat",
+        "prompt": [
+            {"role": "system", "content": _EXTRACTOR_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": "Here is the account statement image. Please extract "
+                "the following information: {{schema}}",
+            },
+        ],
+        "config": {"json_schema": _SCHEMA},
+    },
+    "autogen_extractor_system_prompt": {
+        "type": "text",
+        "prompt": _EXTRACTOR_SYSTEM_PROMPT + " Reply with JSON following {{schema}}.",
+        "config": {"json_schema": _SCHEMA},
+    },
+    "autogen_extractor_message_prompt": {
+        "type": "text",
+        "prompt": "Extract the change in account value from <img {{image_path}}>.",
+        "config": {},
+    },
+    "verifier_system_prompt": {
+        "type": "text",
+        "prompt": "Check the extracted values add up. Reply TERMINATE when they do.",
+        "config": {},
+    },
+}
+
+
+# OpenAI Files and Batches API, with or without LiteLLM's /v1 prefix
+FILES_ROUTE = re.compile(r"(?:/v1)?/files")
+FILE_ROUTE = re.compile(r"(?:/v1)?/files/([^/]+)")
+FILE_CONTENT_ROUTE = re.compile(r"(?:/v1)?/files/([^/]+)/content")
+BATCHES_ROUTE = re.compile(r"(?:/v1)?/batches")
+BATCH_ROUTE = re.compile(r"(?:/v1)?/batches/([^/]+)")
+BATCH_CANCEL_ROUTE = re.compile(r"(?:/v1)?/batches/([^/]+)/cancel")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _parse_model_values(value: Optional[str]) -> Dict[str, float]:
+    """
+    Parses "model=value,model=value".
+    """
+    values = {}
+    for entry in (value or "").split(","):
+        if "=" in entry:
+            model, number = entry.split("=", 1)
+            values[model.strip()] = float(number)
+    return values
+
+
+@dataclass
+class MockSettings:
+    """
+    Behaviour of the mock server. Every setting can be given through the
+    environment, see from_env.
+
+    latency_distribution is "fixed", "uniform" (latency_ms ± latency_spread as
+    a fraction of it) or "lognormal" (median latency_ms, sigma latency_spread). A fraction
+    error_rate of chat completions fail with a status from error_statuses.
+    Batches complete batch_latency_ms after they are created, with the same
+    error rate per request.
+    """
+
+    latency_ms: float = 500
+    latency_distribution: str = "lognormal"
+    latency_spread: float = 0.5
+    model_latency_ms: Dict[str, float] = field(default_factory=dict)
+    error_rate: float = 0.0
+    error_statuses: List[int] = field(default_factory=lambda: [429, 500, 503])
+    retry_after_s: float = 1.0
+    batch_latency_ms: float = 2000
+    responses_path: Optional[Path] = None
+    prompts_path: Optional[Path] = REPO_DIR / ".cache" / "prompts.json"
+    dataset_path: Optional[Path] = None
+    trace_sink_path: Optional[Path] = None
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "MockSettings":
+        defaults = cls()
+        return cls(
+            latency_ms=float(getenv("MOCK_LATENCY_MS", defaults.latency_ms)),
+            latency_distribution=getenv(
+                "MOCK_LATENCY_DISTRIBUTION", defaults.latency_distribution
+            ),
+            latency_spread=float(
+                getenv("MOCK_LATENCY_SPREAD", defaults.latency_spread)
+            ),
+            model_latency_ms=_parse_model_values(getenv("MOCK_MODEL_LATENCY_MS")),
+            error_rate=float(getenv("MOCK_ERROR_RATE", defaults.error_rate)),
+            error_statuses=[
+                int(status)
+                for status in getenv("MOCK_ERROR_STATUSES", "429,500,503").split(",")
+            ],
+            retry_after_s=float(getenv("MOCK_RETRY_AFTER_S", defaults.retry_after_s)),
+            batch_latency_ms=float(
+                getenv("MOCK_BATCH_LATENCY_MS", defaults.batch_latency_ms)
+            ),
+            responses_path=getenv("MOCK_RESPONSES") or None,
+            prompts_path=getenv("MOCK_PROMPTS", defaults.prompts_path),
+            dataset_path=getenv("MOCK_DATASET") or None,
+            trace_sink_path=getenv("MOCK_TRACE_SINK") or None,
+            seed=int(getenv("MOCK_SEED")) if getenv("MOCK_SEED") else None,
+        )
+
+
+class MockBackend:
+    """
+    State of the fake LiteLLM/OpenAI and Langfuse APIs: canned responses,
+    prompts, dataset items, uploaded files and batches, and counters of
+    everything received.
+    """
+
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._sink_lock = threading.Lock()
+
+        self.responses = {"default": DEFAULT_RESPONSE}
+        if settings.responses_path:
+            with open(settings.responses_path) as f:
+                self.responses.update(json.load(f))
+
+        self.prompts = {
+            name: {"name": name, "version": 1, "labels": ["production"], "tags": []}
+            | prompt
+            for name, prompt in DEFAULT_PROMPTS.items()
+        }
+        if settings.prompts_path and Path(settings.prompts_path).exists():
+            with open(settings.prompts_path) as f:
+                self.prompts.update(json.load(f))
+
+        self.dataset_items = self._load_dataset_items()
+
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.file_contents: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+
+    def count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    # LiteLLM / OpenAI
+
+    def latency_s(self, model: str) -> float:
+        s = self.settings
+        latency_ms = s.model_latency_ms.get(model, s.latency_ms)
+        with self._lock:
+            if s.latency_distribution == "fixed":
+                sample = latency_ms
+            elif s.latency_distribution == "uniform":
+                sample = latency_ms * self.random.uniform(
+                    1 - s.latency_spread, 1 + s.latency_spread
+                )
+            else:
+                sample = latency_ms * self.random.lognormvariate(0, s.latency_spread)
+        return max(0.0, sample) / 1000
+
+    def pick_error(self) -> Optional[int]:
+        with self._lock:
+            if self.random.random() >= self.settings.error_rate:
+                return None
+            return self.random.choice(self.settings.error_statuses)
+
+    def completion_content(self, request: Dict[str, Any]) -> str:
+        model = request.get("model", "")
+        response = self.responses.get(model, self.responses["default"])
+        content = response if isinstance(response, str) else json.dumps(response)
+
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") in ("json_schema", "json_object"):
+            return content
+        # non structured output models answer with a code block
+        return f"```json\n{content}\n```"
+
+    @staticmethod
+    def usage(request: Dict[str, Any], content: str) -> Dict[str, int]:
+        prompt_tokens = 0
+        for message in request.get("messages", []):
+            parts = message.get("content")
+            if isinstance(parts, str):
+                parts = [{"type": "text", "text": parts}]
+            for part in parts or []:
+                if part.get("type") == "image_url":
+                    prompt_tokens += 765
+                else:
+                    prompt_tokens += len(part.get("text", "")) // 4
+        completion_tokens = max(1, len(content) // 4)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def completion(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        model = request.get("model", "mock")
+        content = self.completion_content(request)
+        return {
+            "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": content,
+                        "refusal": None,
+                    },
+                    "finish_reason": "stop",
+                    "logprobs": None,
+                }
+            ],
+            "usage": self.usage(request, content),
+        }
+
+    # Files and Batches
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> Dict[str, Any]:
+        file = {
+            "id": f"file-mock-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self._lock:
+            self.files[file["id"]] = file
+            self.file_contents[file["id"]] = content
+            self.stats["files_uploaded"] += 1
+        return file
+
+    def create_batch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        now = int(time.time())
+        batch = {
+            "id": f"batch_mock_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": request.get("endpoint"),
+            "errors": None,
+            "input_file_id": request.get("input_file_id"),
+            "completion_window": request.get("completion_window", "24h"),
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": now,
+            "expires_at": now + 24 * 3600,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": request.get("metadata"),
+        }
+        with self._lock:
+            self.batches[batch["id"]] = batch
+            self.stats["batches_created"] += 1
+        return batch
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """
+        The batch, run once batch_latency_ms has passed since it was created.
+        """
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            if (
+                batch is None
+                or batch["status"] != "in_progress"
+                or time.time() - batch["created_at"]
+                < self.settings.batch_latency_ms / 1000
+            ):
+                return batch
+            # so concurrent polls don't run it twice
+            batch["status"] = "finalizing"
+        self._run_batch(batch)
+        return batch
+
+    def cancel_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            if batch is not None and batch["status"] == "in_progress":
+                batch["status"] = "cancelled"
+                batch["cancelled_at"] = int(time.time())
+        return batch
+
+    def _run_batch(self, batch: Dict[str, Any]):
+        with self._lock:
+            content = self.file_contents.get(batch["input_file_id"])
+        if content is None:
+            return self._fail_batch(batch, "invalid_file", "Input file not found")
+
+        lines = [line for line in content.decode().splitlines() if line.strip()]
+        custom_ids = set()
+        for number, line in enumerate(lines, 1):
+            entry = json.loads(line)
+            if entry.get("url") != batch["endpoint"] or entry.get("method") != "POST":
+                return self._fail_batch(
+                    batch, "invalid_url", f"Line {number} doesn't match the endpoint"
+                )
+            if entry.get("custom_id") in custom_ids:
+                return self._fail_batch(
+                    batch, "duplicate_custom_id", f"Line {number} reuses a custom_id"
+                )
+            custom_ids.add(entry.get("custom_id"))
+
+        outputs, errors = [], []
+        for line in lines:
+            entry = json.loads(line)
+            request = entry["body"]
+            self.count("batch_requests")
+            self.count(f"batch_requests:{request.get('model')}")
+            result = {
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": entry["custom_id"],
+                "error": None,
+            }
+            status = self.pick_error()
+            if status is None:
+                result["response"] = {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": self.completion(request),
+                }
+                outputs.append(result)
+            else:
+                self.count(f"batch_errors:{status}")
+                result["response"] = {
+                    "status_code": status,
+                    "request_id": uuid.uuid4().hex,
+                    "body": {
+                        "error": {"message": f"Mock error {status}", "code": status}
+                    },
+                }
+                errors.append(result)
+
+        def write(results):
+            if not results:
+                return None
+            data = "".join(json.dumps(result) + "\n" for result in results)
+            return self.add_file(data.encode(), "batch_output.jsonl", "batch_output")[
+                "id"
+            ]
+
+        output_file_id, error_file_id = write(outputs), write(errors)
+        now = int(time.time())
+        with self._lock:
+            batch.update(
+                status="completed",
+                output_file_id=output_file_id,
+                error_file_id=error_file_id,
+                finalizing_at=now,
+                completed_at=now,
+                request_counts={
+                    "total": len(lines),
+                    "completed": len(outputs),
+                    "failed": len(errors),
+                },
+            )
+
+    def _fail_batch(self, batch: Dict[str, Any], code: str, message: str):
+        with self._lock:
+            batch.update(
+                status="failed",
+                failed_at=int(time.time()),
+                errors={"object": "list", "data": [{"code": code, "message": message}]},
+            )
+
+    # Langfuse
+
+    def _load_dataset_items(self) -> List[Dict[str, Any]]:
+        if self.settings.dataset_path:
+            with open(self.settings.dataset_path) as f:
+                entries = [json.loads(line) for line in f if line.strip()]
+        else:
+            entries = [
+                {
+                    "id": image_path.stem,
+                    "input": {"args": [str(image_path)]},
+                    "expected_output": json.dumps(DEFAULT_RESPONSE),
+                }
+                for image_path in sorted((REPO_DIR / "data").glob("*.png"))
+            ]
+        return [
+            {
+                "id": entry.get("id") or str(uuid.uuid4()),
+                "status": "ACTIVE",
+                "input": entry.get("input"),
+                "expectedOutput": entry.get("expected_output"),
+                "metadata": entry.get("metadata"),
+                "sourceTraceId": None,
+                "sourceObservationId": None,
+                "datasetId": "mock-dataset",
+                "createdAt": _now(),
+                "updatedAt": _now(),
+            }
+            for entry in entries
+        ]
+
+    def sink(self, events: List[Dict[str, Any]]):
+        for event in events:
+            self.count(f"langfuse_{event.get('type', 'unknown')}")
+        if self.settings.trace_sink_path:
+            with self._sink_lock, open(self.settings.trace_sink_path, "a") as f:
+                for event in events:
+                    f.write(json.dumps(event, default=str) + "\n")
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    backend: MockBackend
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _read_json(self) -> Any:
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def _read_form(self) -> Dict[str, Any]:
+        """
+        Fields of a multipart/form-data body: str values, and (filename, bytes)
+        for files.
+        """
+        header = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n"
+        message = BytesParser(policy=email.policy.HTTP).parsebytes(
+            header.encode() + self._read_body()
+        )
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            content = part.get_payload(decode=True)
+            if part.get_filename() is not None:
+                fields[name] = (part.get_filename(), content)
+            else:
+                fields[name] = content.decode()
+        return fields
+
+    def _send_json(self, status: int, payload: Any, headers: Dict[str, str] = None):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._send_json(404, {"message": f"Mock server has no route {self.path}"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        query = parse_qs(url.query)
+        backend = self.backend
+
+        if path in ("/health", "/api/public/health"):
+            self._send_json(200, {"status": "OK", "version": "mock"})
+        elif path == "/mock/stats":
+            with backend._lock:
+                self._send_json(200, dict(backend.stats))
+        elif match := FILE_CONTENT_ROUTE.fullmatch(path):
+            content = backend.file_contents.get(match.group(1))
+            if content is None:
+                self._not_found()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif match := FILE_ROUTE.fullmatch(path):
+            file = backend.files.get(match.group(1))
+            if file is None:
+                self._not_found()
+            else:
+                self._send_json(200, file)
+        elif match := BATCH_ROUTE.fullmatch(path):
+            batch = backend.get_batch(match.group(1))
+            if batch is None:
+                self._not_found()
+            else:
+                self._send_json(200, batch)
+        elif path.startswith("/api/public/v2/prompts/"):
+            name = unquote(path[len("/api/public/v2/prompts/") :])
+            backend.count("langfuse_get_prompt")
+            if name not in backend.prompts:
+                self._send_json(404, {"message": f"Prompt {name} not found"})
+            else:
+                self._send_json(200, backend.prompts[name])
+        elif path.startswith("/api/public/v2/datasets/"):
+            name = unquote(path[len("/api/public/v2/datasets/") :])
+            self._send_json(
+                200,
+                {
+                    "id": "mock-dataset",
+                    "name": name,
+                    "description": None,
+                    "metadata": None,
+                    "projectId": "mock",
+                    "createdAt": _now(),
+                    "updatedAt": _now(),
+                },
+            )
+        elif path == "/api/public/dataset-items":
+            page = int(query.get("page", ["1"])[0])
+            limit = int(query.get("limit", ["50"])[0])
+            name = unquote(query.get("datasetName", [""])[0])
+            items = [
+                {**item, "datasetName": name}
+                for item in backend.dataset_items[(page - 1) * limit : page * limit]
+            ]
+            total = len(backend.dataset_items)
+            self._send_json(
+                200,
+                {
+                    "data": items,
+                    "meta": {
+                        "page": page,
+                        "limit": limit,
+                        "totalItems": total,
+                        "totalPages": max(1, -(-total // limit)),
+                    },
+                },
+            )
+        else:
+            self._not_found()
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip("/")
+        backend = self.backend
+
+        if FILES_ROUTE.fullmatch(path):
+            form = self._read_form()
+            filename, content = form["file"]
+            self._send_json(200, backend.add_file(content, filename, form["purpose"]))
+            return
+
+        request = self._read_json()
+
+        if path.endswith("/chat/completions"):
+            self._chat_completion(request)
+        elif BATCHES_ROUTE.fullmatch(path):
+            self._send_json(200, backend.create_batch(request))
+        elif match := BATCH_CANCEL_ROUTE.fullmatch(path):
+            batch = backend.cancel_batch(match.group(1))
+            if batch is None:
+                self._not_found()
+            else:
+                self._send_json(200, batch)
+        elif path == "/api/public/ingestion":
+            events = request.get("batch", [])
+            backend.sink(events)
+            self._send_json(
+                207,
+                {
+                    "successes": [{"id": e.get("id"), "status": 201} for e in events],
+                    "errors": [],
+                },
+            )
+        elif path == "/api/public/dataset-run-items":
+            backend.count("langfuse_dataset_run_item")
+            self._send_json(
+                200,
+                {
+                    "id": str(uuid.uuid4()),
+                    "datasetRunId": "mock-run",
+                    "datasetRunName": request.get("runName"),
+                    "datasetItemId": request.get("datasetItemId"),
+                    "traceId": request.get("traceId"),
+                    "observationId": request.get("observationId"),
+                    "createdAt": _now(),
+                    "updatedAt": _now(),
+                },
+            )
+        elif path == "/api/public/scores":
+            backend.count("langfuse_score")
+            self._send_json(200, {"id": request.get("id") or str(uuid.uuid4())})
+        elif path == "/api/public/media":
+            media_id = str(uuid.uuid4())
+            host = self.headers.get("Host")
+            self._send_json(
+                200,
+                {
+                    "mediaId": media_id,
+                    "uploadUrl": f"http://{host}/mock/upload/{media_id}",
+                },
+            )
+        elif path == "/mock/reset":
+            with backend._lock:
+                backend.stats.clear()
+            self._send_json(200, {})
+        else:
+            self._not_found()
+
+    def do_PUT(self):
+        # media uploads, the body is discarded
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._send_json(200, {})
+
+    def do_PATCH(self):
+        self._read_json()
+        self._send_json(204 if "/media/" in self.path else 200, {})
+
+    def _chat_completion(self, request: Dict[str, Any]):
+        backend = self.backend
+        model = request.get("model", "mock")
+        backend.count("chat_completions")
+        backend.count(f"chat_completions:{model}")
+
+        latency = backend.latency_s(model)
+
+        status = backend.pick_error()
+        if status is not None:
+            time.sleep(latency / 4)
+            backend.count(f"errors:{status}")
+            headers = {}
+            if status == HTTPStatus.TOO_MANY_REQUESTS:
+                headers["Retry-After"] = str(backend.settings.retry_after_s)
+            self._send_json(
+                status,
+                {"error": {"message": f"Mock error {status}", "code": status}},
+                headers,
+            )
+            return
+
+        if request.get("stream"):
+            content = backend.completion_content(request)
+            completion_id = f"chatcmpl-mock-{uuid.uuid4().hex}"
+            usage = backend.usage(request, content)
+            self._stream_completion(request, completion_id, content, usage, latency)
+            return
+
+        time.sleep(latency)
+        self._send_json(200, backend.completion(request))
+
+    def _stream_completion(self, request, completion_id, content, usage, latency):
+        """
+        Server-sent events, with a third of the latency before the first token
+        and the rest spread over the chunks.
+        """
+        chunks = [content[i : i + 16] for i in range(0, len(content), 16)] or [""]
+        include_usage = (request.get("stream_options") or {}).get("include_usage")
+
+        def event(choices, **extra):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model"),
+                "choices": choices,
+                **extra,
+            }
+            return f"data: {json.dumps(payload)}\n\n".encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        time.sleep(latency / 3)
+        chunk_delay = latency * 2 / 3 / len(chunks)
+        try:
+            for i, chunk in enumerate(chunks):
+                delta = {"content": chunk}
+                if i == 0:
+                    delta["role"] = "assistant"
+                self.wfile.write(
+                    event([{"index": 0, "delta": delta, "finish_reason": None}])
+                )
+                self.wfile.flush()
+                time.sleep(chunk_delay)
+            self.wfile.write(
+                event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            )
+            if include_usage:
+                self.wfile.write(event([], usage=usage))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client aborted the stream
+            self.backend.count("streams_aborted")
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing keep-alive connections on exit
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class MockServer:
+    """
+    Offline stand-in for LiteLLM and Langfuse, on one port. Point LITELLM_HOST
+    and LANGFUSE_HOST at `url` to run the pipeline against it. Runs in a
+    background thread when started in-process.
+    """
+
+    def __init__(
+        self,
+        settings: Optional[MockSettings] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.backend = MockBackend(settings or MockSettings.from_env())
+        handler = type("BoundMockHandler", (MockHandler,), {"backend": self.backend})
+        self.httpd = _MockHTTPServer((host, port), handler)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name="mock-server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Serve fake LiteLLM/OpenAI and Langfuse APIs for offline load tests. "
+        "Run with LITELLM_HOST and LANGFUSE_HOST pointed at it. Settings are read "
+        "from the MOCK_* environment variables."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4010)
+    args = parser.parse_args()
+
+    server = MockServer(host=args.host, port=args.port)
+    print(f"Mock server listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -4,17 +4,78 @@ from utils.autogen_langfuse import (
     LangfuseConversableAgent,
 )
 import asyncio
-from config import REPO_DIR, AUTOGEN_ALL_LLMS_CONFIG
-from langfuse.decorators import observe, langfuse_context
-from utils.utils import get_git_repository_info
+from config import (
+    REPO_DIR,
+    AUTOGEN_ALL_LLMS_CONFIG,
+    CASCADE_THRESHOLD,
+    MODEL_COSTS,
+    prompt_registry,
+)
+from utils.tracing import observe, langfuse_context
+from utils.image import preprocessed_image_file
+from utils.timing import timed
+from utils.utils import get_commit_hash
+from utils.fanout import a_initiate_chats_parallel, last_extraction_content
+from utils.cascade import a_run_cascade, order_by_cost
+from utils.agent_pool import AGENT_POOL, agent_key
+from contextlib import ExitStack
+from functools import partial
+
+
+def build_user_proxy():
+    return LangfuseConversableAgent(
+        name="user",
+        llm_config=None,
+        human_input_mode="NEVER",
+        max_consecutive_auto_reply=2,
+    )
 
-@observe()
-async def multiagent_extractor(image_path):
 
+def build_multimodal_agent(model):
+
+    model_config = {
+        "config_list": autogen.filter_config(
+            AUTOGEN_ALL_LLMS_CONFIG["config_list"],
+            filter_dict={
+                "model": [model],
+            },
+        )
+    }
+
+    return LangfuseMultimodalConversableAgent(
+        name=f"{model} agent",
+        langfuse_prompt_name="autogen_extractor_system_prompt",
+        llm_config={
+            **model_config,
+            "temperature": 0,
+            "cache_seed": None,
+        },
+        human_input_mode="NEVER",
+        max_consecutive_auto_reply=2,
+    )
+
+
+@observe()
+async def multiagent_extractor(
+    image_path,
+    parallel: bool = True,
+    timeout: float = None,
+    first_n: int = None,
+    cascade: bool = False,
+    threshold: float = CASCADE_THRESHOLD,
+    image_profile=None,
+):
+
+    # the agents load the image from its path, so a preprocessed (e.g. cropped
+    # to the table) copy is written to a file for them
+    with timed("image_encoding"):
+        agent_image_path = await asyncio.to_thread(
+            preprocessed_image_file, image_path, image_profile
+        )
 
-    git_info = get_git_repository_info(REPO_DIR)
+    commit_hash = get_commit_hash(REPO_DIR)
     langfuse_context.update_current_trace(
-        session_id="multiagent_extractor", version=git_info["commit_hash"]
+        session_id="multiagent_extractor", version=commit_hash
     )
 
     # model = "qwen2-vl-7b"
@@ -27,53 +88,58 @@ async def multiagent_extractor(image_path):
         # "llama-3.2-11b-vision-preview",
     ]
 
-    user_proxy = LangfuseConversableAgent(
-        name="user",
-        llm_config=None,
-        human_input_mode="NEVER",
-        max_consecutive_auto_reply=2,
-    )
+    with ExitStack() as agents:
 
-    multimodal_agent_chats = []
+        user_proxy = agents.enter_context(
+            AGENT_POOL.lease(agent_key("user"), build_user_proxy)
+        )
 
-    for model in models:
+        multimodal_agent_chats = []
 
-        model_config = {
-            "config_list": autogen.filter_config(
-                AUTOGEN_ALL_LLMS_CONFIG["config_list"],
-                filter_dict={
-                    "model": [model],
-                },
-            )
-        }
-
-        multimodal_agent = LangfuseMultimodalConversableAgent(
-            name=f"{model} agent",
-            langfuse_prompt_name="autogen_extractor_system_prompt",
-            llm_config={
-                **model_config,
-                "temperature": 0,
-                "cache_seed": None,
-            },
-            human_input_mode="NEVER",
-            max_consecutive_auto_reply=2,
-        )
+        for model in models:
 
-        multimodal_agent_chats.append(
-            {
-                "chat_id": model,
-                "recipient": multimodal_agent,
-                "langfuse_prompt_name": "autogen_extractor_message_prompt",
-                "langfuse_prompt_args": {"image_path": image_path},
-                "summary_method": "last_msg",
-            }
-        )
+            multimodal_agent = agents.enter_context(
+                AGENT_POOL.lease(
+                    agent_key(
+                        f"{model} agent", model, "autogen_extractor_system_prompt"
+                    ),
+                    partial(build_multimodal_agent, model),
+                )
+            )
 
+            multimodal_agent_chats.append(
+                {
+                    "chat_id": model,
+                    "recipient": multimodal_agent,
+                    "langfuse_prompt_name": "autogen_extractor_message_prompt",
+                    "langfuse_prompt_args": {"image_path": agent_image_path},
+                    "summary_method": "last_msg",
+                }
+            )
 
-    chat_results = await user_proxy.a_initiate_chats(multimodal_agent_chats)
+        if cascade:
+            # one model at a time, cheapest first, until one is confident enough
+            chats = {
+                chat_info["chat_id"]: chat_info
+                for chat_info in multimodal_agent_chats
+            }
+            chat_results = {}
 
+            async def extract(model):
+                chat_info = dict(chats[model])
+                chat_info.pop("chat_id")
+                chat_results[model] = await user_proxy.a_initiate_chat(**chat_info)
+                return last_extraction_content(chat_results[model])
 
-    summary = user_proxy.get_chat_results()
+            await a_run_cascade(
+                order_by_cost(models, MODEL_COSTS), extract, threshold
+            )
+        elif parallel:
+            chat_results = await a_initiate_chats_parallel(
+                user_proxy, multimodal_agent_chats, timeout=timeout, first_n=first_n
+            )
+        else:
+            chat_results = await user_proxy.a_initiate_chats(multimodal_agent_chats)
 
     return chat_results
 
@@ -82,6 +148,8 @@ async def multiagent_extractor(image_path):
 
 if __name__ == "__main__":
 
+    prompt_registry.prefetch()
+
     # image_path = REPO_DIR / "data" / "fidelity.png"
     from pathlib import Path
 
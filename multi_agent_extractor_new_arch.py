@@ -6,61 +6,116 @@ from utils.autogen_langfuse import (
     LangfuseConversableAgent,
 )
 import asyncio
-from config import REPO_DIR, AUTOGEN_ALL_LLMS_CONFIG
-from langfuse.decorators import observe, langfuse_context
+from config import (
+    REPO_DIR,
+    AUTOGEN_ALL_LLMS_CONFIG,
+    CASCADE_THRESHOLD,
+    MODEL_COSTS,
+    prompt_registry,
+)
+from utils.tracing import observe, langfuse_context
+from utils.image import preprocessed_image_file
+from utils.timing import timed
+from utils.tools import LocalTools, calculator
 from dotenv import load_dotenv
-from utils.utils import get_git_repository_info
+from utils.utils import get_commit_hash, parse_extraction
+from utils.validation import validate_change_in_account_value
+from utils.fanout import a_initiate_chats_parallel, last_extraction_content
+from utils.cascade import a_run_cascade, order_by_cost
+from utils.agent_pool import AGENT_POOL, agent_key
+from contextlib import ExitStack
+from functools import partial
 
 load_dotenv()
 
 
-from typing import Annotated, Literal
+# Tools the verifier runs itself, see utils.tools.LocalTools.
+VERIFIER_TOOLS = LocalTools(
+    {
+        "calculator": (
+            calculator,
+            "Evaluates a list of arithmetic expressions exactly, "
+            "check every identity in one call",
+        )
+    }
+)
 
-Operator = Literal["+", "-", "*", "/"]
 
+def is_termination_msg(msg):
+    """
+    Whether msg (or the last of a list of messages) contains TERMINATE. The
+    multimodal agent stores contents as lists of text and image parts, only
+    the text parts are searched.
+    """
+    if isinstance(msg, list):
+        msg = msg[-1]
+    content = msg.get("content")
+    if isinstance(content, list):
+        content = "\n".join(
+            part.get("text", "") for part in content if part.get("type") == "text"
+        )
+    return bool(content) and "TERMINATE" in content
+
+
+def validate_last_extraction(messages):
+    """
+    Runs the accounting identity checks on the extraction in the last message.
+    Returns None when there is no extraction or no identity can be checked, so
+    the verifier LLM handles the message as before.
+    """
+    extraction = parse_extraction(messages[-1].get("content"))
+    if extraction is None:
+        return None, None
+
+    report = validate_change_in_account_value(extraction)
+    langfuse_context.update_current_observation(
+        metadata={"validation": report.to_dict()}
+    )
+    if not report.checked:
+        return None, None
+    return extraction, report
 
-def calculator(a: int, b: int, operator: Annotated[Operator, "operator"]) -> int:
-    if operator == "+":
-        return a + b
-    elif operator == "-":
-        return a - b
-    elif operator == "*":
-        return a * b
-    elif operator == "/":
-        return int(a / b)
-    else:
-        raise ValueError("Invalid operator")
 
+def with_validation_failures(messages, report):
+    """
+    Appends the failing identities to the last message, so the verifier LLM
+    only has to look at the fields that don't add up.
+    """
+    last_message = messages[-1]
+    content = f"{last_message['content']}\n\n{report.summary()}"
+    return messages[:-1] + [{**last_message, "content": content}]
 
-def is_termination_msg(msg):
 
-    if isinstance(msg, list):
-        msg_content = msg[-1].get("content", "")
-    else:
-        msg_content = msg.get("content", "")
-    if msg_content:
-        return "TERMINATE" in msg.get("content", "")
-    return False
+def validation_reply(recipient, messages=None, sender=None, config=None):
 
+    extraction, report = validate_last_extraction(messages)
+    if report is None:
+        return False, None
 
-@observe()
-async def multiagent_extractor_new(image_path):
+    if report.ok:
+        # identities hold, no need for an LLM verification round
+        return True, f"{extraction.model_dump_json()}\nTERMINATE"
 
-    git_info = get_git_repository_info(REPO_DIR)
-    langfuse_context.update_current_trace(
-        session_id="multiagent_extractor_new", version=git_info["commit_hash"]
+    return VERIFIER_TOOLS.generate_oai_reply(
+        recipient, with_validation_failures(messages, report), sender
     )
 
-    models = [
-        "gpt-4o",
-        # "qwen2-vl-7b",
-        # "pixtral-12b",
-        # "claude-3.5-sonnet",
-        "gpt-4o-mini",
-        # "llama-3.2-11b-vision-preview",
-    ]
 
-    verifier_model = "gpt-4o"
+async def a_validation_reply(recipient, messages=None, sender=None, config=None):
+
+    extraction, report = validate_last_extraction(messages)
+    if report is None:
+        return False, None
+
+    if report.ok:
+        return True, f"{extraction.model_dump_json()}\nTERMINATE"
+
+    return await VERIFIER_TOOLS.a_generate_oai_reply(
+        recipient, with_validation_failures(messages, report), sender
+    )
+
+
+def build_verifier_agent(verifier_model):
 
     verifier_agent = LangfuseConversableAgent(
         name=f"verifier_{verifier_model}",
@@ -83,61 +138,158 @@ async def multiagent_extractor_new(image_path):
         langfuse_prompt_name="verifier_system_prompt",
     )
 
-    # Register the tool signature with the assistant agent.
-    verifier_agent.register_for_llm(
-        name="calculator", description="A simple calculator"
-    )(calculator)
+    # The verifier runs its tools itself instead of sending the calls to the
+    # multimodal agent.
+    VERIFIER_TOOLS.add_to_agent(verifier_agent)
+
+    # Check extractions deterministically before asking the verifier LLM.
+    verifier_agent.register_reply([autogen.Agent, None], validation_reply, position=0)
+    verifier_agent.register_reply(
+        [autogen.Agent, None],
+        a_validation_reply,
+        position=0,
+        ignore_async_in_sync_chat=True,
+    )
+
+    return verifier_agent
 
-    verifier_multimodel_agent_chats = []
 
-    for model in models:
+def build_multimodal_agent(model):
 
-        model_config = {
-            "config_list": autogen.filter_config(
-                AUTOGEN_ALL_LLMS_CONFIG["config_list"],
-                filter_dict={
-                    "model": [model],
-                },
-            )
-        }
-
-        multimodal_agent = LangfuseMultimodalConversableAgent(
-            name=f"{model}_agent",
-            langfuse_prompt_name="autogen_extractor_system_prompt",
-            llm_config={
-                **model_config,
-                "temperature": 0,
-                "cache_seed": None,
+    model_config = {
+        "config_list": autogen.filter_config(
+            AUTOGEN_ALL_LLMS_CONFIG["config_list"],
+            filter_dict={
+                "model": [model],
             },
-            human_input_mode="NEVER",
-            max_consecutive_auto_reply=10,
-            is_termination_msg=is_termination_msg,
         )
+    }
+
+    multimodal_agent = LangfuseMultimodalConversableAgent(
+        name=f"{model}_agent",
+        langfuse_prompt_name="autogen_extractor_system_prompt",
+        llm_config={
+            **model_config,
+            "temperature": 0,
+            "cache_seed": None,
+        },
+        human_input_mode="NEVER",
+        max_consecutive_auto_reply=10,
+        is_termination_msg=is_termination_msg,
+    )
 
-        # Register the tool function with the user proxy agent.
-        multimodal_agent.register_for_execution(name="calculator")(calculator)
+    # Tool calls still pending after the verifier's local tool rounds.
+    multimodal_agent.register_for_execution(name="calculator")(calculator)
 
-        verifier_multimodel_agent_chats.append(
-            {
-                "chat_id": model,
-                "recipient": multimodal_agent,
-                "langfuse_prompt_name": "autogen_extractor_message_prompt",
-                "langfuse_prompt_args": {"image_path": str(image_path)},
-                "summary_method": "last_msg",
-            }
+    return multimodal_agent
+
+
+@observe()
+async def multiagent_extractor_new(
+    image_path,
+    parallel: bool = True,
+    timeout: float = None,
+    first_n: int = None,
+    cascade: bool = False,
+    threshold: float = CASCADE_THRESHOLD,
+    image_profile=None,
+):
+
+    # the agents load the image from its path, so a preprocessed (e.g. cropped
+    # to the table) copy is written to a file for them
+    with timed("image_encoding"):
+        agent_image_path = await asyncio.to_thread(
+            preprocessed_image_file, image_path, image_profile
         )
 
-    chat_results = await verifier_agent.a_initiate_chats(
-        verifier_multimodel_agent_chats
+    commit_hash = get_commit_hash(REPO_DIR)
+    langfuse_context.update_current_trace(
+        session_id="multiagent_extractor_new", version=commit_hash
     )
 
-    summary = verifier_agent.get_chat_results()
+    models = [
+        "gpt-4o",
+        # "qwen2-vl-7b",
+        # "pixtral-12b",
+        # "claude-3.5-sonnet",
+        "gpt-4o-mini",
+        # "llama-3.2-11b-vision-preview",
+    ]
+
+    verifier_model = "gpt-4o"
+
+    with ExitStack() as agents:
+
+        verifier_agent = agents.enter_context(
+            AGENT_POOL.lease(
+                agent_key(
+                    f"verifier_{verifier_model}",
+                    verifier_model,
+                    "verifier_system_prompt",
+                ),
+                partial(build_verifier_agent, verifier_model),
+            )
+        )
+
+        verifier_multimodel_agent_chats = []
+
+        for model in models:
+
+            multimodal_agent = agents.enter_context(
+                AGENT_POOL.lease(
+                    agent_key(
+                        f"{model}_agent", model, "autogen_extractor_system_prompt"
+                    ),
+                    partial(build_multimodal_agent, model),
+                )
+            )
+
+            verifier_multimodel_agent_chats.append(
+                {
+                    "chat_id": model,
+                    "recipient": multimodal_agent,
+                    "langfuse_prompt_name": "autogen_extractor_message_prompt",
+                    "langfuse_prompt_args": {"image_path": agent_image_path},
+                    "summary_method": "last_msg",
+                }
+            )
+
+        if cascade:
+            # one model at a time, cheapest first, until one is confident enough
+            chats = {
+                chat_info["chat_id"]: chat_info
+                for chat_info in verifier_multimodel_agent_chats
+            }
+            chat_results = {}
+
+            async def extract(model):
+                chat_info = dict(chats[model])
+                chat_info.pop("chat_id")
+                chat_results[model] = await verifier_agent.a_initiate_chat(**chat_info)
+                return last_extraction_content(chat_results[model])
+
+            await a_run_cascade(
+                order_by_cost(models, MODEL_COSTS), extract, threshold
+            )
+        elif parallel:
+            chat_results = await a_initiate_chats_parallel(
+                verifier_agent,
+                verifier_multimodel_agent_chats,
+                timeout=timeout,
+                first_n=first_n,
+            )
+        else:
+            chat_results = await verifier_agent.a_initiate_chats(
+                verifier_multimodel_agent_chats
+            )
 
     return chat_results
 
 
 if __name__ == "__main__":
 
+    prompt_registry.prefetch()
+
     image_path = REPO_DIR / "data" / "abc.png"
 
     loop = asyncio.get_event_loop()
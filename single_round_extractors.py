@@ -1,34 +1,107 @@
-from utils.utils import encode_image
+import asyncio
+from dataclasses import dataclass, replace
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence
 from pathlib import Path
 import json
 from copy import deepcopy
-from langfuse.decorators import observe, langfuse_context
-from utils.utils import get_git_repository_info
+from utils.tracing import observe, langfuse_context
+from utils.utils import get_commit_hash, parse_extraction
 
-from config import langfuse_client, REPO_DIR
-import openai
+from config import prompt_registry, REPO_DIR, CASCADE_MODELS, CASCADE_THRESHOLD
+from utils.cache import ExtractionCache, get_extraction_cache
+from utils.cascade import CascadeResult, a_run_cascade, run_cascade
+from utils.image import (
+    get_image_profile,
+    image_profile_cache_params,
+    preprocess_image,
+)
+from utils.schema import ChangeInAccountValue
+from utils.pdf import DEFAULT_PAGE_KEYWORDS, PdfPage, iter_pdf_pages, select_extraction
+from utils.roi import crop_pdf_page
+from utils.schema_registry import DEFAULT_SCHEMA_NAME, schema_registry
+from utils.streaming import PartialExtraction, StreamingViolation, a_stream_completion
+from utils.text_layer import is_complete_extraction, parse_change_in_account_value
+from utils.timing import count, timed
+from utils.validation import validate_change_in_account_value
+from functools import lru_cache
 from os import getenv
 
-OPENAI_CLIENT = openai.OpenAI(api_key="anything", base_url=getenv("LITELLM_HOST"))
 
+@lru_cache(maxsize=None)
+def get_openai_client():
+    # langfuse.openai traces the calls and accepts the langfuse_prompt kwarg
+    from langfuse.openai import openai
+    from utils.concurrency import get_rate_controlled_http_client
 
-@observe()
-def openai_single_round_extractor_with_structured_outputs(
-    image_path: Path, langfuse_prompt_name: str, model: str
-):
+    # retries are left to the rate controller, see utils.concurrency
+    return openai.OpenAI(
+        api_key="anything",
+        base_url=getenv("LITELLM_HOST"),
+        http_client=get_rate_controlled_http_client(),
+        max_retries=0,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_async_openai_client():
+    from langfuse.openai import openai
+    from utils.concurrency import get_rate_controlled_async_http_client
+
+    return openai.AsyncOpenAI(
+        api_key="anything",
+        base_url=getenv("LITELLM_HOST"),
+        http_client=get_rate_controlled_async_http_client(),
+        max_retries=0,
+    )
+
+
+def __getattr__(name):
+    # OPENAI_CLIENT and ASYNC_OPENAI_CLIENT are created on first access
+    if name == "OPENAI_CLIENT":
+        return get_openai_client()
+    if name == "ASYNC_OPENAI_CLIENT":
+        return get_async_openai_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def prepare_image(image_path: Path, image_profile=None):
+    with timed("image_encoding"):
+        image = preprocess_image(image_path, image_profile)
+    count("image_bytes_uploaded", len(image.base64))
+    langfuse_context.update_current_observation(metadata={"image": image.stats()})
+    return image
+
+
+def record_usage(chat_response):
+    usage = chat_response.usage
+    if usage is not None:
+        count("prompt_tokens", usage.prompt_tokens)
+        count("completion_tokens", usage.completion_tokens)
 
-    git_info = get_git_repository_info(REPO_DIR)
-    langfuse_context.update_current_trace(version=git_info["commit_hash"])
 
-    prompt_obj = langfuse_client.get_prompt(langfuse_prompt_name)
+def build_structured_output_request(
+    image_path: Path,
+    prompt_obj,
+    model: str,
+    image_profile=None,
+    json_schema=None,
+    schema_name: str = None,
+):
+    """
+    json_schema and schema_name override the prompt config's, e.g. to extract
+    several tables at once.
+    """
 
     config = deepcopy(prompt_obj.config)
 
-    json_schema = config.pop("json_schema")
+    prompt_schema = config.pop("json_schema")
+    prompt_schema_name = config.pop("schema_name", DEFAULT_SCHEMA_NAME)
+    json_schema = json_schema or prompt_schema
+    schema_name = schema_name or prompt_schema_name
 
-    system_prompt = prompt_obj.compile()
+    system_prompt = prompt_registry.compile(prompt_obj)
 
-    base64_image = encode_image(image_path)
+    image = prepare_image(image_path, image_profile)
 
     messages = [
         {"role": "system", "content": system_prompt},
@@ -37,45 +110,33 @@ def openai_single_round_extractor_with_structured_outputs(
             "content": [
                 {
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/png;base64,{base64_image}"},
+                    "image_url": {"url": image.data_url},
                 },
             ],
         },
     ]
 
-    @observe(as_type="generation")
-    def generate_openai_structured_output(model, messages, json_schema, **config):
-        return OPENAI_CLIENT.beta.chat.completions.parse(
-            model=model,
-            messages=messages,
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": "change_in_account_value",
-                    "schema": json_schema,
-                    # "strict": True,
-                },
-            },
-            **config,
-        )
-
-    chat_response = generate_openai_structured_output(
-        model=model, messages=messages, json_schema=json_schema, **config
-    )
-    return chat_response.choices[0].message.content
+    return {
+        "model": model,
+        "messages": messages,
+        "json_schema": json_schema,
+        "schema_name": schema_name,
+        **config,
+    }
 
 
-@observe()
-def non_openai_single_round_extractor(
-    image_path: Path, langfuse_prompt_name: str, model: str = None
+def build_non_openai_request(
+    image_path: Path,
+    prompt_obj,
+    model: str = None,
+    image_profile=None,
+    json_schema=None,
 ):
-    git_info = get_git_repository_info(REPO_DIR)
-    langfuse_context.update_current_trace(version=git_info["commit_hash"])
-
-    prompt_obj = langfuse_client.get_prompt(langfuse_prompt_name)
 
     config = deepcopy(prompt_obj.config)
-    json_schema = config.pop("json_schema")
+    prompt_schema = config.pop("json_schema")
+    config.pop("schema_name", None)
+    json_schema = json_schema or prompt_schema
 
     if "model" not in config and model is None:
         raise ValueError(
@@ -85,9 +146,9 @@ def non_openai_single_round_extractor(
     if model:
         config["model"] = model
 
-    messages = prompt_obj.compile(schema=json.dumps(json_schema))
+    messages = prompt_registry.compile(prompt_obj, schema=json.dumps(json_schema))
 
-    base64_image = encode_image(image_path)
+    image = prepare_image(image_path, image_profile)
 
     new_messages = [
         messages[0],
@@ -97,17 +158,720 @@ def non_openai_single_round_extractor(
                 {"type": "text", "text": messages[1]["content"]},
                 {
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/png;base64,{base64_image}"},
+                    "image_url": {"url": image.data_url},
                 },
             ],
         },
     ]
 
-    chat_response = OPENAI_CLIENT.chat.completions.create(
-        langfuse_prompt=prompt_obj, messages=new_messages, **config
+    return {"langfuse_prompt": prompt_obj, "messages": new_messages, **config}
+
+
+def extraction_cache_key(image_path: Path, prompt_obj, model: str, image_profile=None):
+    return ExtractionCache.make_key(
+        image_path,
+        model=model or prompt_obj.config.get("model"),
+        prompt_name=prompt_obj.name,
+        prompt_version=prompt_obj.version,
+        **image_profile_cache_params(image_profile),
+    )
+
+
+def get_cached_extraction(cache, cache_key):
+    if cache is None:
+        return None
+    output = cache.get(cache_key)
+    cache.report(hit=output is not None)
+    return output
+
+
+def lookup_extraction(use_cache: bool, make_key: Callable[[], str]):
+    """
+    (cache, cache_key, cached output or None) of an extraction. make_key is
+    only called when a cache is in use.
+    """
+    cache = get_extraction_cache() if use_cache else None
+    if cache is None:
+        return None, None, None
+    cache_key = make_key()
+    return cache, cache_key, get_cached_extraction(cache, cache_key)
+
+
+def store_extraction(cache, cache_key, chat_response) -> Optional[str]:
+    """
+    The output of chat_response, saved under cache_key when a cache is in use.
+    """
+    output = chat_response.choices[0].message.content
+    if cache is not None and output:
+        cache.set(cache_key, output)
+    return output
+
+
+def start_extraction(
+    image_path: Path, langfuse_prompt_name: str, model: str, use_cache, image_profile
+):
+    """
+    Common start of the single round extractors, sync and async: tags the
+    trace with the commit, gets the prompt and looks the extraction up in the
+    cache. Returns (prompt_obj, cache, cache_key, cached output or None).
+    """
+    commit_hash = get_commit_hash(REPO_DIR)
+    langfuse_context.update_current_trace(version=commit_hash)
+
+    prompt_obj = prompt_registry.get_prompt(langfuse_prompt_name)
+    cache, cache_key, output = lookup_extraction(
+        use_cache,
+        lambda: extraction_cache_key(image_path, prompt_obj, model, image_profile),
+    )
+    return prompt_obj, cache, cache_key, output
+
+
+def structured_output_response_format(json_schema, name: str = DEFAULT_SCHEMA_NAME):
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "schema": json_schema,
+            # "strict": True,
+        },
+    }
+
+
+@observe(as_type="generation")
+def generate_openai_structured_output(
+    model, messages, json_schema, schema_name=DEFAULT_SCHEMA_NAME, **config
+):
+    with timed("model_call"):
+        chat_response = get_openai_client().beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=structured_output_response_format(json_schema, schema_name),
+            **config,
+        )
+    record_usage(chat_response)
+    return chat_response
+
+
+@observe(as_type="generation")
+async def a_generate_openai_structured_output(
+    model, messages, json_schema, schema_name=DEFAULT_SCHEMA_NAME, **config
+):
+    with timed("model_call"):
+        chat_response = await get_async_openai_client().beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=structured_output_response_format(json_schema, schema_name),
+            **config,
+        )
+    record_usage(chat_response)
+    return chat_response
+
+
+def create_chat_completion(request):
+    with timed("model_call"):
+        chat_response = get_openai_client().chat.completions.create(**request)
+    record_usage(chat_response)
+    return chat_response
+
+
+async def a_create_chat_completion(request):
+    with timed("model_call"):
+        chat_response = await get_async_openai_client().chat.completions.create(
+            **request
+        )
+    record_usage(chat_response)
+    return chat_response
+
+
+@observe()
+def openai_single_round_extractor_with_structured_outputs(
+    image_path: Path,
+    langfuse_prompt_name: str,
+    model: str,
+    use_cache: bool = True,
+    image_profile=None,
+):
+
+    prompt_obj, cache, cache_key, output = start_extraction(
+        image_path, langfuse_prompt_name, model, use_cache, image_profile
+    )
+    if output is not None:
+        return output
+
+    request = build_structured_output_request(
+        image_path, prompt_obj, model, image_profile
+    )
+
+    return store_extraction(
+        cache, cache_key, generate_openai_structured_output(**request)
+    )
+
+
+@observe()
+async def a_openai_single_round_extractor_with_structured_outputs(
+    image_path: Path,
+    langfuse_prompt_name: str,
+    model: str,
+    use_cache: bool = True,
+    image_profile=None,
+):
+
+    prompt_obj, cache, cache_key, output = start_extraction(
+        image_path, langfuse_prompt_name, model, use_cache, image_profile
+    )
+    if output is not None:
+        return output
+
+    request = build_structured_output_request(
+        image_path, prompt_obj, model, image_profile
+    )
+
+    return store_extraction(
+        cache, cache_key, await a_generate_openai_structured_output(**request)
+    )
+
+
+@observe()
+def non_openai_single_round_extractor(
+    image_path: Path,
+    langfuse_prompt_name: str,
+    model: str = None,
+    use_cache: bool = True,
+    image_profile=None,
+):
+    prompt_obj, cache, cache_key, output = start_extraction(
+        image_path, langfuse_prompt_name, model, use_cache, image_profile
+    )
+    if output is not None:
+        return output
+
+    request = build_non_openai_request(image_path, prompt_obj, model, image_profile)
+
+    return store_extraction(cache, cache_key, create_chat_completion(request))
+
+
+@observe()
+async def a_non_openai_single_round_extractor(
+    image_path: Path,
+    langfuse_prompt_name: str,
+    model: str = None,
+    use_cache: bool = True,
+    image_profile=None,
+):
+    prompt_obj, cache, cache_key, output = start_extraction(
+        image_path, langfuse_prompt_name, model, use_cache, image_profile
+    )
+    if output is not None:
+        return output
+
+    request = build_non_openai_request(image_path, prompt_obj, model, image_profile)
+
+    return store_extraction(cache, cache_key, await a_create_chat_completion(request))
+
+
+# Added to the system prompt when a streamed extraction is retried.
+STRICT_JSON_INSTRUCTION = (
+    "Respond with exactly one JSON object matching the schema and nothing else: "
+    "no explanation, no markdown and no code fences. Numbers must be plain JSON "
+    "numbers, and fields that are not in the statement must be null."
+)
+
+
+def build_streaming_request(
+    image_path: Path, prompt_obj, model: str, image_profile=None, strict=False
+):
+    _, _, extract_json = get_single_round_extractor(model)
+    if extract_json:
+        request = build_non_openai_request(image_path, prompt_obj, model, image_profile)
+    else:
+        request = build_structured_output_request(
+            image_path, prompt_obj, model, image_profile
+        )
+        request["response_format"] = structured_output_response_format(
+            request.pop("json_schema"), request.pop("schema_name")
+        )
+
+    if strict:
+        system_message = request["messages"][0]
+        request["messages"] = [
+            {
+                **system_message,
+                "content": f"{system_message['content']}\n\n{STRICT_JSON_INSTRUCTION}",
+            },
+            *request["messages"][1:],
+        ]
+    return request
+
+
+@observe()
+async def a_streaming_single_round_extractor(
+    image_path: Path,
+    langfuse_prompt_name: str,
+    model: str,
+    use_cache: bool = True,
+    image_profile=None,
+    max_attempts: int = 2,
+    max_completion_chars: int = 4000,
+    max_preamble_chars: int = 200,
+) -> AsyncIterator[PartialExtraction]:
+    """
+    Streams the extraction and yields a PartialExtraction each time another
+    field is parsed and validated against ChangeInAccountValue; the last one
+    has done=True and the full JSON output.
+
+    The request is aborted as soon as the output can't be a valid extraction
+    (prose instead of JSON, an invalid field, more than max_completion_chars)
+    and retried with STRICT_JSON_INSTRUCTION, up to max_attempts in total.
+    The StreamingViolation of the last attempt is raised.
+    """
+    prompt_obj, cache, cache_key, output = start_extraction(
+        image_path, langfuse_prompt_name, model, use_cache, image_profile
+    )
+    if output is not None:
+        extraction = parse_extraction(output)
+        yield PartialExtraction(
+            fields=extraction.model_dump() if extraction else {},
+            done=True,
+            output=output,
+        )
+        return
+
+    violations = []
+    for attempt in range(1, max_attempts + 1):
+        request = build_streaming_request(
+            image_path, prompt_obj, model, image_profile, strict=attempt > 1
+        )
+        try:
+            async for partial in a_stream_completion(
+                get_async_openai_client(),
+                request,
+                max_completion_chars=max_completion_chars,
+                max_preamble_chars=max_preamble_chars,
+                attempt=attempt,
+            ):
+                if partial.done:
+                    langfuse_context.update_current_observation(
+                        metadata={"attempts": attempt, "violations": violations}
+                    )
+                    if cache is not None:
+                        cache.set(cache_key, partial.output)
+                yield partial
+            return
+        except StreamingViolation as e:
+            violations.append(e.reason)
+            if attempt == max_attempts:
+                langfuse_context.update_current_observation(
+                    metadata={"attempts": attempt, "violations": violations},
+                    level="WARNING",
+                )
+                raise
+
+
+def get_single_round_extractor(model: str, asynchronous: bool = False):
+    """
+    Returns (extractor, langfuse_prompt_name, extract_json) for a model.
+    OpenAI models use structured outputs, the rest return JSON in a code block.
+    """
+    if "gpt" in model or "o1" in model:
+        if asynchronous:
+            extractor = a_openai_single_round_extractor_with_structured_outputs
+        else:
+            extractor = openai_single_round_extractor_with_structured_outputs
+        return extractor, "extractor_system_prompt", False
+
+    if asynchronous:
+        extractor = a_non_openai_single_round_extractor
+    else:
+        extractor = non_openai_single_round_extractor
+    return extractor, "qwen_extractor_prompt", True
+
+
+@observe()
+def cascade_single_round_extractor(
+    image_path: Path,
+    models: List[str] = CASCADE_MODELS,
+    threshold: float = CASCADE_THRESHOLD,
+    **extractor_kwargs,
+) -> CascadeResult:
+    """
+    Tries the single round extractor of each model, cheapest first, and only
+    escalates to the next model when the output's confidence score is below
+    threshold. PDFs go through the PDF extractor of each model. The output is
+    normalized to ChangeInAccountValue JSON.
+    """
+
+    def extract(model):
+        extractor, prompt_name, _ = get_single_round_extractor(model)
+        if Path(image_path).suffix.lower() == ".pdf":
+            extractor = pdf_single_round_extractor
+        return extractor(image_path, prompt_name, model=model, **extractor_kwargs)
+
+    return run_cascade(models, extract, threshold)
+
+
+@observe()
+async def a_cascade_single_round_extractor(
+    image_path: Path,
+    models: List[str] = CASCADE_MODELS,
+    threshold: float = CASCADE_THRESHOLD,
+    **extractor_kwargs,
+) -> CascadeResult:
+
+    async def extract(model):
+        extractor, prompt_name, _ = get_single_round_extractor(model, asynchronous=True)
+        if Path(image_path).suffix.lower() == ".pdf":
+            extractor = a_pdf_single_round_extractor
+        return await extractor(image_path, prompt_name, model=model, **extractor_kwargs)
+
+    return await a_run_cascade(models, extract, threshold)
+
+
+def build_multi_table_request(
+    image_path: Path,
+    model: str,
+    tables: Sequence[str],
+    image_profile=None,
+):
+    """
+    Returns (request, prompt_obj, structured) for one call extracting every
+    table in `tables`, with the model's usual extractor prompt.
+    """
+    _, prompt_name, extract_json = get_single_round_extractor(model)
+    prompt_obj = prompt_registry.get_prompt(prompt_name)
+    json_schema = schema_registry.json_schema(tables)
+
+    if extract_json:
+        request = build_non_openai_request(
+            image_path, prompt_obj, model, image_profile, json_schema=json_schema
+        )
+    else:
+        request = build_structured_output_request(
+            image_path,
+            prompt_obj,
+            model,
+            image_profile,
+            json_schema=json_schema,
+            schema_name=schema_registry.schema_name(tables),
+        )
+    return request, prompt_obj, not extract_json
+
+
+def multi_table_cache_key(image_path: Path, prompt_obj, model, tables, image_profile):
+    return ExtractionCache.make_key(
+        image_path,
+        model=model,
+        prompt_name=prompt_obj.name,
+        prompt_version=prompt_obj.version,
+        json_schema=schema_registry.json_schema(tables),
+        tables=list(tables),
+        **image_profile_cache_params(image_profile),
+    )
+
+
+def start_multi_table_extraction(
+    image_path: Path, model: str, tables, document_type, use_cache, image_profile
+):
+    """
+    start_extraction of the multi table extractors. Returns (tables, cache,
+    cache_key, cached output or None).
+    """
+    commit_hash = get_commit_hash(REPO_DIR)
+    langfuse_context.update_current_trace(version=commit_hash)
+
+    tables = schema_registry.select(document_type, tables)
+    langfuse_context.update_current_observation(metadata={"tables": list(tables)})
+
+    _, prompt_name, _ = get_single_round_extractor(model)
+    prompt_obj = prompt_registry.get_prompt(prompt_name)
+    cache, cache_key, output = lookup_extraction(
+        use_cache,
+        lambda: multi_table_cache_key(
+            image_path, prompt_obj, model, tables, image_profile
+        ),
+    )
+    return tables, cache, cache_key, output
+
+
+@observe()
+def multi_table_single_round_extractor(
+    image_path: Path,
+    model: str,
+    tables: Sequence[str] = None,
+    document_type: str = None,
+    use_cache: bool = True,
+    image_profile=None,
+) -> Dict[str, Any]:
+    """
+    Extracts several tables (see utils.schema_registry) from one image in a
+    single model call, so the image is uploaded once instead of once per
+    table. `tables` defaults to the tables of `document_type`, or every
+    registered table.
+
+    Returns the typed object per table, None for tables the model didn't
+    return or that don't validate.
+    """
+    tables, cache, cache_key, output = start_multi_table_extraction(
+        image_path, model, tables, document_type, use_cache, image_profile
+    )
+
+    if output is None:
+        request, _, structured = build_multi_table_request(
+            image_path, model, tables, image_profile
+        )
+        if structured:
+            chat_response = generate_openai_structured_output(**request)
+        else:
+            chat_response = create_chat_completion(request)
+        output = store_extraction(cache, cache_key, chat_response)
+
+    return schema_registry.parse(output, tables)
+
+
+@observe()
+async def a_multi_table_single_round_extractor(
+    image_path: Path,
+    model: str,
+    tables: Sequence[str] = None,
+    document_type: str = None,
+    use_cache: bool = True,
+    image_profile=None,
+) -> Dict[str, Any]:
+    tables, cache, cache_key, output = start_multi_table_extraction(
+        image_path, model, tables, document_type, use_cache, image_profile
+    )
+
+    if output is None:
+        request, _, structured = build_multi_table_request(
+            image_path, model, tables, image_profile
+        )
+        if structured:
+            chat_response = await a_generate_openai_structured_output(**request)
+        else:
+            chat_response = await a_create_chat_completion(request)
+        output = store_extraction(cache, cache_key, chat_response)
+
+    return schema_registry.parse(output, tables)
+
+
+def crop_pages_to_table(pages: List[PdfPage], image_profile=None):
+    """
+    With a roi image profile, PDF pages are cropped to the table here, where
+    their text layer is at hand. Returns the pages and the profile to extract
+    them with, which doesn't look for the table again.
+    """
+    profile = get_image_profile(image_profile)
+    if profile is None or not profile.roi:
+        return pages, image_profile
+    with timed("image_encoding"):
+        pages = [
+            crop_pdf_page(page, profile.roi_margin, profile.roi_min_confidence)[0]
+            for page in pages
+        ]
+    return pages, replace(profile, roi=False)
+
+
+def load_pdf_pages(
+    pdf_path: Path, dpi: int = 150, keywords=DEFAULT_PAGE_KEYWORDS, image_profile=None
+):
+    """
+    The rendered candidate pages of a PDF, cropped to the table with a roi
+    image profile. Returns the pages and the profile to extract them with.
+    """
+    return crop_pages_to_table(
+        list(iter_pdf_pages(pdf_path, dpi=dpi, keywords=keywords)), image_profile
+    )
+
+
+def select_page_output(pages: List[PdfPage], outputs: List[Optional[str]]) -> str:
+    langfuse_context.update_current_observation(
+        metadata={"pages": [page.page_number for page in pages]}
+    )
+    return select_extraction(
+        [parse_extraction(output) for output in outputs]
+    ).model_dump_json()
+
+
+@observe()
+def pdf_single_round_extractor(
+    pdf_path: Path,
+    langfuse_prompt_name: str,
+    model: str,
+    dpi: int = 150,
+    keywords=DEFAULT_PAGE_KEYWORDS,
+    **extractor_kwargs,
+):
+    """
+    Runs the single round extractor for `model` on each candidate page of a PDF
+    and keeps the most complete per-page result as ChangeInAccountValue JSON.
+    """
+    extractor, _, _ = get_single_round_extractor(model)
+
+    pages, extractor_kwargs["image_profile"] = load_pdf_pages(
+        pdf_path, dpi, keywords, extractor_kwargs.get("image_profile")
+    )
+    outputs = [
+        extractor(page.image, langfuse_prompt_name, model=model, **extractor_kwargs)
+        for page in pages
+    ]
+    return select_page_output(pages, outputs)
+
+
+@observe()
+async def a_pdf_single_round_extractor(
+    pdf_path: Path,
+    langfuse_prompt_name: str,
+    model: str,
+    dpi: int = 150,
+    keywords=DEFAULT_PAGE_KEYWORDS,
+    **extractor_kwargs,
+):
+    extractor, _, _ = get_single_round_extractor(model, asynchronous=True)
+
+    pages, extractor_kwargs["image_profile"] = await asyncio.to_thread(
+        load_pdf_pages, pdf_path, dpi, keywords, extractor_kwargs.get("image_profile")
+    )
+    outputs = await asyncio.gather(
+        *[
+            extractor(page.image, langfuse_prompt_name, model=model, **extractor_kwargs)
+            for page in pages
+        ]
+    )
+    return select_page_output(pages, outputs)
+
+
+@dataclass
+class PdfExtractionResult:
+    output: str
+    # "text_parser", "text_model" or "image"
+    path: str
+    pages: List[int]
+
+
+def build_text_request(page_text: str, prompt_obj, model: str):
+
+    config = deepcopy(prompt_obj.config)
+
+    json_schema = config.pop("json_schema")
+    schema_name = config.pop("schema_name", DEFAULT_SCHEMA_NAME)
+
+    messages = [
+        {"role": "system", "content": prompt_registry.compile(prompt_obj)},
+        {
+            "role": "user",
+            "content": f"Here is the text of the account statement:\n\n{page_text}",
+        },
+    ]
+
+    return {
+        "model": model,
+        "messages": messages,
+        "json_schema": json_schema,
+        "schema_name": schema_name,
+        **config,
+    }
+
+
+def text_cache_key(page_text: str, prompt_obj, model: str):
+    return ExtractionCache.make_key(
+        page_text.encode(),
+        model=model,
+        prompt_name=prompt_obj.name,
+        prompt_version=prompt_obj.version,
+        source="text_layer",
     )
 
-    return chat_response.choices[0].message.content
+
+def is_verified_extraction(extraction: Optional[ChangeInAccountValue]) -> bool:
+    """
+    Whether a text layer extraction can be used without looking at the page:
+    it has every required field and its accounting identities hold, which a
+    row missed by the parser or the text model would break.
+    """
+    if not is_complete_extraction(extraction):
+        return False
+    report = validate_change_in_account_value(extraction)
+    return report.checked and report.ok
+
+
+@observe()
+def text_layer_pdf_extractor(
+    pdf_path: Path,
+    langfuse_prompt_name: str,
+    model: str,
+    text_model: Optional[str] = "gpt-4o-mini",
+    keywords=DEFAULT_PAGE_KEYWORDS,
+    use_cache: bool = True,
+    **image_extractor_kwargs,
+) -> PdfExtractionResult:
+    """
+    Extracts from the PDF text layer when there is one, trying in order:
+    the deterministic row parser, the text-only `text_model` on the candidate
+    pages' text, and finally the vision `model` on the rendered pages. A text
+    layer extraction is only kept when is_verified_extraction, and a failing
+    text_model call falls through to the vision model. Model outputs go
+    through the extraction cache like the image extractors'.
+    """
+    pages = [
+        page
+        for page in iter_pdf_pages(pdf_path, keywords=keywords, render=False)
+        if page.text.strip()
+    ]
+    page_numbers = [page.page_number for page in pages]
+
+    extraction = None
+    path = None
+    text_model_error = None
+
+    if pages:
+        extraction = select_extraction(
+            [parse_change_in_account_value(page.text, page.words)[0] for page in pages]
+        )
+        path = "text_parser"
+
+        if not is_verified_extraction(extraction) and text_model:
+            prompt_obj = prompt_registry.get_prompt(langfuse_prompt_name)
+            page_text = "\n\n".join(page.text for page in pages)
+            cache, cache_key, output = lookup_extraction(
+                use_cache, lambda: text_cache_key(page_text, prompt_obj, text_model)
+            )
+            try:
+                if output is None:
+                    output = store_extraction(
+                        cache,
+                        cache_key,
+                        generate_openai_structured_output(
+                            **build_text_request(page_text, prompt_obj, text_model)
+                        ),
+                    )
+                extraction = parse_extraction(output)
+                path = "text_model"
+            except Exception as e:
+                # the vision path below still has a chance
+                text_model_error = f"{type(e).__name__}: {e}"
+
+    if is_verified_extraction(extraction):
+        output = extraction.model_dump_json()
+    else:
+        output = pdf_single_round_extractor(
+            pdf_path,
+            langfuse_prompt_name,
+            model=model,
+            keywords=keywords,
+            use_cache=use_cache,
+            **image_extractor_kwargs,
+        )
+        path = "image"
+
+    langfuse_context.update_current_trace(tags=[f"extraction_path:{path}"])
+    langfuse_context.update_current_observation(
+        metadata={
+            "extraction_path": path,
+            "pages": page_numbers,
+            "text_model_error": text_model_error,
+        }
+    )
+
+    return PdfExtractionResult(output=output, path=path, pages=page_numbers)
 
 
 if __name__ == "__main__":
@@ -116,6 +880,8 @@ if __name__ == "__main__":
     # create_qwen_extractor_langfuse_prompt()
     # create_openai_extractor_langfuse_prompt()
 
+    prompt_registry.prefetch()
+
     table_images_dir = REPO_DIR / "data"
 
     for image_path in table_images_dir.glob(f"*.png"):
@@ -126,3 +892,9 @@ if __name__ == "__main__":
         #     image_path, "qwen_extractor_prompt", model="pixtral-12b"
         # )
         print(result)
+
+    for pdf_path in table_images_dir.glob(f"*.pdf"):
+        result = text_layer_pdf_extractor(
+            pdf_path, "extractor_system_prompt", model="gpt-4o"
+        )
+        print(result.path, result.output)
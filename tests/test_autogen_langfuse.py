@@ -0,0 +1,38 @@
+from utils import autogen_langfuse
+from utils.agent_pool import AgentPool
+from utils.autogen_langfuse import LangfuseConversableAgent
+
+
+class RecordingExporter:
+    def __init__(self):
+        self.events = []
+
+    def submit(self, event):
+        self.events.append(event)
+
+
+def build_agent(name):
+    return LangfuseConversableAgent(
+        name=name,
+        llm_config=False,
+        human_input_mode="NEVER",
+        max_consecutive_auto_reply=1,
+        default_auto_reply="ok",
+    )
+
+
+def test_pooled_agent_traces_first_turn_of_every_chat(monkeypatch):
+    exporter = RecordingExporter()
+    monkeypatch.setattr(autogen_langfuse, "get_trace_exporter", lambda: exporter)
+    pool = AgentPool()
+    sender = build_agent("sender")
+
+    for document in ("first", "second"):
+        with pool.lease(("receiver",), lambda: build_agent("receiver")) as receiver:
+            exporter.events.clear()
+            sender.initiate_chat(receiver, message=document, max_turns=1)
+
+        first_turn = exporter.events[0]
+        assert first_turn.metadata["message_offset"] == 0
+        assert [m["content"] for m in first_turn.messages] == [document]
+    assert pool.created == 1
@@ -0,0 +1,29 @@
+import json
+
+from utils.json_recovery import recover_extraction, repair_json
+
+
+def test_truncation_mid_number_drops_the_member():
+    text, repairs = repair_json('{"starting_value": 1.5, "ending_value": 33458')
+    assert json.loads(text) == {"starting_value": 1.5}
+    assert repairs == ["dropped:ending_value", "truncated"]
+
+
+def test_truncation_before_delimiter_drops_the_member():
+    text, repairs = repair_json('{"starting_value": 1.5, "credits": "12.0"')
+    assert json.loads(text) == {"starting_value": 1.5}
+    assert "dropped:credits" in repairs
+
+
+def test_truncation_after_delimiter_keeps_the_members():
+    text, repairs = repair_json('{"starting_value": 1.5, "ending_value": 2.5,')
+    assert json.loads(text) == {"starting_value": 1.5, "ending_value": 2.5}
+    assert repairs == ["truncated"]
+
+
+def test_truncated_extraction_has_no_cut_value():
+    result = recover_extraction(
+        '```json\n{"starting_value": 1.5, "ending_value": 334582.17'[:-4]
+    )
+    assert result.extraction.starting_value == 1.5
+    assert result.extraction.ending_value is None
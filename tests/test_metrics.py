@@ -0,0 +1,45 @@
+import json
+
+from utils.metrics import EvalFrames, compare, FIELDS
+
+END_DATE = FIELDS.index("reporting_period_end_date")
+
+
+def end_date_comparison(predicted, expected):
+    frames = EvalFrames.from_records(
+        [
+            {
+                "model": "gpt-4o",
+                "item_id": str(i),
+                "output": json.dumps({"reporting_period_end_date": p}),
+                "expected_output": json.dumps({"reporting_period_end_date": e}),
+            }
+            for i, (p, e) in enumerate(zip(predicted, expected))
+        ]
+    )
+    comparison = compare(frames)
+    return (
+        comparison["exact"][:, END_DATE].tolist(),
+        comparison["match"][:, END_DATE].tolist(),
+    )
+
+
+def test_complete_dates_in_other_formats_match():
+    exact, match = end_date_comparison(
+        ["05/31/2024", "May 31, 2024", " 2024-05-31 "], ["2024-05-31"] * 3
+    )
+    assert exact == match == [True, True, True]
+
+
+def test_partial_dates_dont_match_a_day():
+    exact, match = end_date_comparison(
+        ["2024", "May 2024", "2024-05"], ["2024-01-01", "2024-05-01", "2024-05-01"]
+    )
+    assert exact == match == [False, False, False]
+
+
+def test_partial_dates_are_compared_as_text():
+    exact, match = end_date_comparison(
+        ["May  2024", "may 2024"], ["may 2024", "June 2024"]
+    )
+    assert exact == match == [True, False]
@@ -0,0 +1,24 @@
+from utils.pdf import select_extraction
+from utils.schema import ChangeInAccountValue
+
+
+def test_pages_of_different_accounts_are_not_mixed():
+    first_account = ChangeInAccountValue(starting_value=100.0, credits=5.0)
+    second_account = ChangeInAccountValue(
+        starting_value=2000.0, credits=10.0, ending_value=2500.0
+    )
+
+    selected = select_extraction([first_account, None, second_account])
+
+    assert selected == second_account
+
+
+def test_first_page_wins_a_tie():
+    first_page = ChangeInAccountValue(starting_value=100.0, ending_value=110.0)
+    second_page = ChangeInAccountValue(starting_value=2000.0, ending_value=2500.0)
+
+    assert select_extraction([first_page, second_page]) == first_page
+
+
+def test_no_extraction_is_empty():
+    assert select_extraction([None]) == ChangeInAccountValue()
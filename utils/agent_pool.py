@@ -0,0 +1,88 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from autogen import ConversableAgent
+
+from config import prompt_registry
+
+
+def agent_key(
+    name: str, model: Optional[str] = None, langfuse_prompt_name: Optional[str] = None
+) -> Tuple:
+    """
+    Pool key for an agent. It ends with the system prompt's current version, so
+    agents built from an outdated prompt are not reused after a prompt update.
+    """
+    prompt_version = None
+    if langfuse_prompt_name:
+        prompt_version = prompt_registry.get_prompt(langfuse_prompt_name).version
+    return (name, model, langfuse_prompt_name, prompt_version)
+
+
+class AgentPool:
+    """
+    Thread-safe pool of idle autogen agents, so agents are built once and reused
+    across documents instead of being re-created for every request.
+
+    An agent is leased by one document at a time and reset (chat history, auto
+    reply counters, usage) when it goes back to the pool.
+
+    Keys from agent_key end with a version. Once a key with a new version is
+    leased, the idle agents of the older versions are dropped, and agents of an
+    older version still leased are not taken back.
+    """
+
+    def __init__(self, max_idle_per_key: int = 8):
+        self.max_idle_per_key = max_idle_per_key
+        self._idle: Dict[Hashable, List[ConversableAgent]] = defaultdict(list)
+        self._current: Dict[Hashable, Hashable] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _slot(key: Hashable) -> Hashable:
+        return key[:-1] if isinstance(key, tuple) else key
+
+    def _evict_stale(self, key: Hashable):
+        slot = self._slot(key)
+        stale = self._current.get(slot)
+        if stale is not None and stale != key:
+            self.evicted += len(self._idle.pop(stale, ()))
+        self._current[slot] = key
+
+    def acquire(
+        self, key: Hashable, factory: Callable[[], ConversableAgent]
+    ) -> ConversableAgent:
+        with self._lock:
+            self._evict_stale(key)
+            if self._idle[key]:
+                return self._idle[key].pop()
+            self.created += 1
+        return factory()
+
+    def release(self, key: Hashable, agent: ConversableAgent):
+        agent.reset()
+        with self._lock:
+            if self._current.get(self._slot(key)) != key:
+                self.evicted += 1
+            elif len(self._idle[key]) < self.max_idle_per_key:
+                self._idle[key].append(agent)
+
+    @contextmanager
+    def lease(self, key: Hashable, factory: Callable[[], ConversableAgent]):
+        agent = self.acquire(key, factory)
+        try:
+            yield agent
+        finally:
+            self.release(key, agent)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            self._current.clear()
+
+
+AGENT_POOL = AgentPool()
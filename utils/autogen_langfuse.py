@@ -5,8 +5,30 @@ from autogen import ConversableAgent, Agent
 from autogen.agentchat.contrib.multimodal_conversable_agent import (
     MultimodalConversableAgent,
 )
-from langfuse.decorators import observe, langfuse_context
-import langfuse
+from autogen.oai.client import OpenAIClient, OpenAIWrapper
+from utils.tracing import observe, langfuse_context
+
+# patches openai so the agents' completions are traced as Langfuse generations
+import langfuse.openai
+from config import IMAGE_REUSE, prompt_registry
+from utils.utils import get_langfuse_client
+from utils.timing import count, timed
+from utils.trace_export import TraceEvent, get_trace_exporter, new_messages
+from utils.image_reuse import ImageReuse
+from utils.concurrency import get_rate_controlled_http_client
+
+
+def rate_controlled(wrapper: Optional[OpenAIWrapper]) -> Optional[OpenAIWrapper]:
+    """
+    wrapper with its OpenAI clients sending through the process' rate
+    controller (see utils.concurrency), which retries instead of them.
+    """
+    for model_client in getattr(wrapper, "_clients", []):
+        if isinstance(model_client, OpenAIClient):
+            model_client._oai_client = model_client._oai_client.with_options(
+                http_client=get_rate_controlled_http_client(), max_retries=0
+            )
+    return wrapper
 
 
 class LangfuseConversableAgent(ConversableAgent):
@@ -32,7 +54,9 @@ class LangfuseConversableAgent(ConversableAgent):
         description: str | None = None,
     ):
 
-        self.langfuse_client = langfuse.Langfuse()
+        self.langfuse_client = get_langfuse_client()
+        # messages already traced, per sender
+        self._traced_message_counts: Dict[Agent, int] = {}
 
         system_message = None
         if langfuse_prompt_name:
@@ -55,6 +79,15 @@ class LangfuseConversableAgent(ConversableAgent):
             description=description,
         )
 
+    @property
+    def client(self) -> Optional[OpenAIWrapper]:
+        return self._client
+
+    @client.setter
+    def client(self, client: Optional[OpenAIWrapper]):
+        # autogen builds a new wrapper on init and whenever a tool is registered
+        self._client = rate_controlled(client)
+
     def log_langfuse_prompt(
         self,
         prompt_name: str,
@@ -62,7 +95,7 @@ class LangfuseConversableAgent(ConversableAgent):
         obervation_name: str = None,
     ):
         
-        prompt_obj = self.langfuse_client.get_prompt(prompt_name)
+        prompt_obj = prompt_registry.get_prompt(prompt_name)
 
         p_args = {}
         if "json_schema" in prompt_obj.config:
@@ -71,7 +104,7 @@ class LangfuseConversableAgent(ConversableAgent):
         if prompt_args:
             p_args.update(prompt_args)
 
-        prompt = prompt_obj.compile(**p_args)
+        prompt = prompt_registry.compile(prompt_obj, **p_args)
         
         langfuse_context.update_current_observation(
             prompt=prompt_obj, output=prompt, name=obervation_name
@@ -79,6 +112,55 @@ class LangfuseConversableAgent(ConversableAgent):
 
         return prompt
 
+    def clear_history(
+        self,
+        recipient: Optional[Agent] = None,
+        nr_messages_to_preserve: Optional[int] = None,
+    ):
+        # reset() and initiate_chat(clear_history=True) both end up here, so a
+        # pooled agent's next conversation is traced from its first message
+        if recipient is not None:
+            super().clear_history(recipient, nr_messages_to_preserve)
+            self._traced_message_counts.pop(recipient, None)
+            return
+
+        lengths = {key: len(messages) for key, messages in self.chat_messages.items()}
+        super().clear_history(recipient, nr_messages_to_preserve)
+        for key in list(self._traced_message_counts):
+            dropped = lengths.get(key, 0) - len(self.chat_messages.get(key, []))
+            traced = self._traced_message_counts[key] - dropped
+            if traced > 0:
+                self._traced_message_counts[key] = traced
+            else:
+                del self._traced_message_counts[key]
+
+    def reset(self):
+        super().reset()
+        self._traced_message_counts.clear()
+        # set by initiate_chats, a pooled agent must not keep a document's results
+        self._finished_chats = {}
+
+    def trace_new_messages(self, sender: Agent):
+        """
+        Logs the messages received from sender since the previous reply as the
+        input of the current observation. Only the new messages are sent, with
+        images replaced by hashes, and in the background, so tracing a turn
+        costs the same however long the conversation is.
+        """
+        messages = self.chat_messages[sender]
+        offset, messages = new_messages(self._traced_message_counts, sender, messages)
+        get_trace_exporter().submit(
+            TraceEvent(
+                trace_id=langfuse_context.get_current_trace_id(),
+                observation_id=langfuse_context.get_current_observation_id(),
+                messages=messages,
+                metadata={
+                    "message_offset": offset,
+                    "message_count": offset + len(messages),
+                },
+            )
+        )
+
     @observe(as_type="generation")
     def initiate_chat(
         self,
@@ -165,18 +247,22 @@ class LangfuseConversableAgent(ConversableAgent):
             **context,
         )
 
-    @observe(as_type="generation")
+    @observe(as_type="generation", capture_input=False)
     def generate_reply(
         self,
         messages: List[Dict[str, Any]] | None = None,
         sender: Agent | None = None,
         **kwargs: Any,
     ) -> str | Dict | None:
-        
+
         langfuse_context.update_current_observation(
-            name=f"{self.name} --> {sender.name}", input=self.chat_messages[sender]
+            name=f"{self.name} --> {sender.name}"
         )
-        reply = super().generate_reply(messages, sender, **kwargs)
+        self.trace_new_messages(sender)
+        with timed("model_call"):
+            reply = super().generate_reply(messages, sender, **kwargs)
+        if reply is not None:
+            count("agent_turns")
         usage = self.get_actual_usage()
         if usage:
             for model_name, usage_dict in usage.items():
@@ -186,7 +272,7 @@ class LangfuseConversableAgent(ConversableAgent):
                     )
         return reply
 
-    @observe(as_type="generation")
+    @observe(as_type="generation", capture_input=False)
     async def a_generate_reply(
         self,
         messages: Optional[List[Dict[str, Any]]] = None,
@@ -195,11 +281,14 @@ class LangfuseConversableAgent(ConversableAgent):
     ) -> Union[str, Dict[str, Any], None]:
 
         langfuse_context.update_current_observation(
-            name=f"{self.name} --> {sender.name}",
-            input=self.chat_messages[sender],
+            name=f"{self.name} --> {sender.name}"
         )
+        self.trace_new_messages(sender)
         langfuse_context.update_current_trace()
-        reply = await super().a_generate_reply(messages, sender, **kwargs)
+        with timed("model_call"):
+            reply = await super().a_generate_reply(messages, sender, **kwargs)
+        if reply is not None:
+            count("agent_turns")
         usage = self.get_actual_usage()
         if usage:
             for model_name, usage_dict in usage.items():
@@ -215,5 +304,12 @@ class LangfuseMultimodalConversableAgent(
 ):
     """
     A MultimodalConversableAgent with the same Langfuse custom logging as LangfuseConversableAgent.
+
+    Once the agent has replied to an image, later turns send it as set by
+    image_reuse (see utils.image_reuse) instead of resending it in full.
     """
+
+    def __init__(self, *args, image_reuse: str = IMAGE_REUSE, **kwargs):
+        super().__init__(*args, **kwargs)
+        ImageReuse(image_reuse).add_to_agent(self)
   
\ No newline at end of file
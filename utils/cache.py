@@ -0,0 +1,187 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from os import getenv
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+from utils.schema import ChangeInAccountValue
+from utils.tracing import langfuse_context
+
+
+def sha256_file(path: Union[Path, str, bytes]) -> str:
+    """
+    SHA-256 of a file's contents, or of the bytes themselves when given bytes.
+    """
+    if isinstance(path, bytes):
+        return hashlib.sha256(path).hexdigest()
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def schema_hash(schema: Dict[str, Any] = None) -> str:
+    if schema is None:
+        schema = ChangeInAccountValue.model_json_schema()
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+
+
+class ExtractionCache:
+    """
+    SQLite backed cache of extraction outputs.
+
+    Keys are content addressed: the image bytes, model, Langfuse prompt name and
+    version and the ChangeInAccountValue schema all go into the key, so changing
+    any of them misses the cache instead of returning a stale answer. Entries
+    older than max_age_seconds are dropped, and the least recently used entries
+    are evicted once the cache holds more than max_entries or max_bytes.
+    """
+
+    def __init__(
+        self,
+        path: Union[Path, str],
+        max_entries: int = 10_000,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_age_seconds: float = 30 * 24 * 3600,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS extractions (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """)
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(
+        image_path: Union[Path, str, bytes],
+        model: str,
+        prompt_name: str,
+        prompt_version: Any,
+        json_schema: Dict[str, Any] = None,
+        **extra,
+    ) -> str:
+        key_parts = {
+            "image_sha256": sha256_file(image_path),
+            "model": model,
+            "prompt_name": prompt_name,
+            "prompt_version": prompt_version,
+            "schema": schema_hash(json_schema),
+            **extra,
+        }
+        return hashlib.sha256(
+            json.dumps(key_parts, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE extractions SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode()), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        self._conn.execute(
+            "DELETE FROM extractions WHERE created_at < ?",
+            (now - self.max_age_seconds,),
+        )
+        count, total_bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions"
+        ).fetchone()
+
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+
+        rows = self._conn.execute(
+            "SELECT key, size FROM extractions ORDER BY accessed_at ASC"
+        ).fetchall()
+        to_delete = []
+        for key, size in rows:
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            count -= 1
+            total_bytes -= size
+        self._conn.executemany("DELETE FROM extractions WHERE key = ?", to_delete)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM extractions")
+            self._conn.commit()
+
+    def report(self, hit: bool):
+        """
+        Adds the lookup outcome and running hit/miss counters to the current Langfuse observation.
+        """
+        langfuse_context.update_current_observation(
+            metadata={
+                "extraction_cache": {
+                    "hit": hit,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                }
+            }
+        )
+
+
+_DEFAULT_CACHE: Optional[ExtractionCache] = None
+_DEFAULT_CACHE_LOCK = threading.Lock()
+
+
+def get_extraction_cache() -> Optional[ExtractionCache]:
+    """
+    Process-wide cache at EXTRACTION_CACHE_PATH (default .cache/extractions.sqlite).
+    Returns None when EXTRACTION_CACHE is set to 0/false.
+    """
+    global _DEFAULT_CACHE
+
+    if getenv("EXTRACTION_CACHE", "1").lower() in ("0", "false", "no"):
+        return None
+
+    with _DEFAULT_CACHE_LOCK:
+        if _DEFAULT_CACHE is None:
+            path = getenv(
+                "EXTRACTION_CACHE_PATH",
+                Path(__file__).parent.parent / ".cache" / "extractions.sqlite",
+            )
+            _DEFAULT_CACHE = ExtractionCache(path)
+        return _DEFAULT_CACHE
@@ -0,0 +1,182 @@
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+
+from utils.tracing import langfuse_context
+from utils.utils import parse_extraction
+from utils.validation import validate_change_in_account_value
+
+
+def order_by_cost(models: Sequence[str], costs: Dict[str, float]) -> List[str]:
+    """
+    Cheapest first. Models without a known cost go last.
+    """
+    return sorted(models, key=lambda model: costs.get(model, float("inf")))
+
+
+@dataclass
+class ExtractionScore:
+    """
+    Confidence in an extraction, from 0 to 1.
+
+    consistency is 1 when the accounting identities hold, 0 when one fails and
+    0.5 when none of them can be checked.
+    """
+
+    valid: bool
+    null_ratio: float = 1.0
+    consistency: float = 0.0
+    score: float = 0.0
+
+
+def score_extraction(
+    content: Optional[str],
+    consistency_weight: float = 0.7,
+    completeness_weight: float = 0.3,
+) -> ExtractionScore:
+    extraction = parse_extraction(content)
+    if extraction is None:
+        return ExtractionScore(valid=False)
+
+    values = extraction.model_dump()
+    null_ratio = sum(value is None for value in values.values()) / len(values)
+
+    report = validate_change_in_account_value(extraction)
+    if not report.checked:
+        consistency = 0.5
+    else:
+        consistency = 1.0 if report.ok else 0.0
+
+    return ExtractionScore(
+        valid=True,
+        null_ratio=round(null_ratio, 3),
+        consistency=consistency,
+        score=round(
+            consistency_weight * consistency + completeness_weight * (1 - null_ratio),
+            3,
+        ),
+    )
+
+
+@dataclass
+class CascadeStage:
+    model: str
+    output: Optional[str] = None
+    error: Optional[str] = None
+    score: Optional[ExtractionScore] = None
+    latency_s: float = 0.0
+
+
+@dataclass
+class CascadeResult:
+    output: Optional[str]
+    model: Optional[str]
+    # index of the accepted stage, None when no stage reached the threshold
+    accepted_stage: Optional[int]
+    stages: List[CascadeStage] = field(default_factory=list)
+
+
+def _best_stage(stages: List[CascadeStage]) -> Optional[int]:
+    scored = [i for i, stage in enumerate(stages) if stage.score is not None]
+    if not scored:
+        return None
+    return max(scored, key=lambda i: stages[i].score.score)
+
+
+def _finish(stages: List[CascadeStage], accepted_stage: Optional[int]):
+    """
+    Picks the output and logs the cascade to the current trace. The
+    cascade_stage score and cascade_model tag are what per-stage hit rates are
+    computed from in Langfuse.
+    """
+    chosen = accepted_stage if accepted_stage is not None else _best_stage(stages)
+    stage = stages[chosen] if chosen is not None else None
+
+    langfuse_context.update_current_observation(
+        metadata={
+            "cascade": {
+                "accepted_stage": accepted_stage,
+                "stages": [asdict(s) for s in stages],
+            }
+        }
+    )
+    langfuse_context.update_current_trace(
+        tags=[
+            f"cascade_model:{stage.model if stage else None}",
+            "cascade:accepted" if accepted_stage is not None else "cascade:exhausted",
+        ]
+    )
+    langfuse_context.score_current_trace(
+        name="cascade_stage",
+        value=accepted_stage if accepted_stage is not None else len(stages),
+        comment=f"Stages tried: {', '.join(s.model for s in stages)}",
+    )
+    if stage and stage.score:
+        langfuse_context.score_current_trace(
+            name="cascade_confidence", value=stage.score.score
+        )
+
+    output = stage.output if stage else None
+    if stage and stage.score and stage.score.valid:
+        # normalize fenced or partial JSON to the full ChangeInAccountValue JSON
+        output = parse_extraction(output).model_dump_json()
+
+    return CascadeResult(
+        output=output,
+        model=stage.model if stage else None,
+        accepted_stage=accepted_stage,
+        stages=stages,
+    )
+
+
+def run_cascade(
+    models: Sequence[str],
+    extract: Callable[[str], str],
+    threshold: float = 0.7,
+    score: Callable[[Optional[str]], ExtractionScore] = score_extraction,
+) -> CascadeResult:
+    """
+    Runs extract(model) for models in order, cheapest first, and stops at the
+    first output scoring at least threshold. When none does, the best scoring
+    output is returned. A model that raises is skipped.
+    """
+    stages = []
+    for i, model in enumerate(models):
+        stage = CascadeStage(model=model)
+        start = time.perf_counter()
+        try:
+            stage.output = extract(model)
+            stage.score = score(stage.output)
+        except Exception as e:
+            stage.error = f"{type(e).__name__}: {e}"
+        stage.latency_s = round(time.perf_counter() - start, 3)
+        stages.append(stage)
+
+        if stage.score is not None and stage.score.score >= threshold:
+            return _finish(stages, i)
+
+    return _finish(stages, None)
+
+
+async def a_run_cascade(
+    models: Sequence[str],
+    extract: Callable[[str], Awaitable[str]],
+    threshold: float = 0.7,
+    score: Callable[[Optional[str]], ExtractionScore] = score_extraction,
+) -> CascadeResult:
+    stages = []
+    for i, model in enumerate(models):
+        stage = CascadeStage(model=model)
+        start = time.perf_counter()
+        try:
+            stage.output = await extract(model)
+            stage.score = score(stage.output)
+        except Exception as e:
+            stage.error = f"{type(e).__name__}: {e}"
+        stage.latency_s = round(time.perf_counter() - start, 3)
+        stages.append(stage)
+
+        if stage.score is not None and stage.score.score >= threshold:
+            return _finish(stages, i)
+
+    return _finish(stages, None)
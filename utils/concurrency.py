@@ -0,0 +1,514 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from os import getenv
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+import openai
+
+from utils.timing import count
+
+# max_retries of the requests sent inside a retry_limit() block
+_retry_limit: ContextVar[Optional[int]] = ContextVar("retry_limit", default=None)
+
+# Responses retried by the rate controlled transports, and those that mean the
+# model is overloaded and shrink its concurrency limit.
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+
+
+def backoff_delay(
+    attempt: int, base_delay: float = 1.0, max_delay: float = 60.0
+) -> float:
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """
+    Seconds to wait from retry-after-ms or Retry-After (seconds or HTTP date).
+    """
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def parse_model_rates(value: Optional[str]) -> Dict[str, float]:
+    """
+    {"gpt-4o": 5.0} from "gpt-4o=5,...".
+    """
+    rates = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            model, rate = item.split("=", 1)
+            rates[model.strip()] = float(rate)
+    return rates
+
+
+class ModelLimit:
+    """
+    Limits of one model: an optional token bucket of `rate` requests per second
+    and an AIMD concurrency limit, which grows by one request for every `limit`
+    successful ones and is cut by a factor on throttles. Not thread safe, see
+    RateController.
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float] = None,
+        burst: Optional[int] = None,
+        limit: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 64,
+    ):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate or 1))
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.paused_until = 0.0
+
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.throttle_events = 0
+        self.retries = 0
+
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._decreased_at = 0.0
+
+    def try_acquire(self, now: float, poll_s: float) -> float:
+        """
+        Takes a slot and a token, returns 0, or the seconds to wait before
+        trying again.
+        """
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.limit):
+            return poll_s
+        if self.rate:
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    def on_success(self):
+        self.completed += 1
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_throttle(
+        self,
+        now: float,
+        retry_after: Optional[float],
+        decrease: float,
+        cooldown_s: float,
+    ):
+        self.throttle_events += 1
+        # a burst of 429s for requests sent together is one signal
+        if now - self._decreased_at >= cooldown_s:
+            self.limit = max(self.min_limit, self.limit * decrease)
+            self._decreased_at = now
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "limit": round(self.limit, 2),
+            "rate": self.rate,
+            "completed": self.completed,
+            "failed": self.failed,
+            "throttle_events": self.throttle_events,
+            "retries": self.retries,
+            "paused_s": round(max(0.0, self.paused_until - time.monotonic()), 3),
+        }
+
+
+class RateController:
+    """
+    Client side rate and concurrency control per model, shared by every thread
+    and event loop of the process (see get_rate_controller).
+
+    Requests take a slot of their model before they are sent and give it back
+    with their outcome: successes raise the model's concurrency limit
+    additively, throttles (429/503, timeouts, dropped connections) cut it
+    multiplicatively and pause the model for their Retry-After. Each model's
+    limit thus settles at what it serves instead of every caller retrying into
+    429s.
+
+    Retries are bounded by max_retries (or the enclosing retry_limit()) and
+    max_delay: a Retry-After longer than max_delay ends them.
+    """
+
+    def __init__(
+        self,
+        rates: Optional[Dict[str, float]] = None,
+        initial_limit: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        decrease: float = 0.5,
+        cooldown_s: float = 1.0,
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        poll_s: float = 0.02,
+    ):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.cooldown_s = cooldown_s
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_s = poll_s
+
+        self._models: Dict[str, ModelLimit] = {}
+        self._lock = threading.Lock()
+        for model, rate in (rates or {}).items():
+            self.configure(model, rate=rate)
+
+    def _model(self, model: str) -> ModelLimit:
+        limit = self._models.get(model)
+        if limit is None:
+            limit = self._models[model] = ModelLimit(
+                limit=self.initial_limit,
+                min_limit=self.min_limit,
+                max_limit=self.max_limit,
+            )
+        return limit
+
+    def configure(
+        self, model: str, rate: Optional[float] = None, burst: Optional[int] = None
+    ):
+        """
+        Sets the requests per second model is started at, None for no limit.
+        """
+        with self._lock:
+            limit = self._model(model)
+            limit.rate = rate
+            limit.capacity = burst or max(1, int(rate or 1))
+
+    def _try_acquire(self, model: str, queued: bool) -> float:
+        with self._lock:
+            limit = self._model(model)
+            wait = limit.try_acquire(time.monotonic(), self.poll_s)
+            if wait and not queued:
+                limit.queued += 1
+            elif not wait and queued:
+                limit.queued -= 1
+            return wait
+
+    def _leave_queue(self, model: str):
+        with self._lock:
+            self._model(model).queued -= 1
+
+    def acquire(self, model: str):
+        queued = False
+        try:
+            while True:
+                wait = self._try_acquire(model, queued)
+                if not wait:
+                    return
+                queued = True
+                time.sleep(wait)
+        except BaseException:
+            if queued:
+                self._leave_queue(model)
+            raise
+
+    async def a_acquire(self, model: str):
+        queued = False
+        try:
+            while True:
+                wait = self._try_acquire(model, queued)
+                if not wait:
+                    return
+                queued = True
+                await asyncio.sleep(wait)
+        except BaseException:
+            if queued:
+                self._leave_queue(model)
+            raise
+
+    def release(
+        self,
+        model: str,
+        status_code: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ):
+        """
+        Gives back a slot taken by acquire. status_code None means the
+        request failed without a response.
+        """
+        with self._lock:
+            limit = self._model(model)
+            limit.in_flight -= 1
+            if status_code is not None and status_code < 400:
+                limit.on_success()
+                return
+            limit.failed += 1
+            if status_code is None or status_code in THROTTLE_STATUSES:
+                limit.on_throttle(
+                    time.monotonic(), retry_after, self.decrease, self.cooldown_s
+                )
+                count("throttle_events")
+
+    def retry_delay(
+        self, model: Optional[str], attempt: int, retry_after: Optional[float] = None
+    ) -> Optional[float]:
+        """
+        Seconds to wait before retry number attempt + 1, None to give up.
+        """
+        max_retries = _retry_limit.get()
+        if max_retries is None:
+            max_retries = self.max_retries
+        if attempt >= max_retries or (retry_after or 0) > self.max_delay:
+            return None
+        if model is not None:
+            with self._lock:
+                self._model(model).retries += 1
+        count("retries")
+        return max(
+            retry_after or 0.0, backoff_delay(attempt, self.base_delay, self.max_delay)
+        )
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Live metrics per model: in flight and queued requests, the current
+        concurrency limit, throttle events and retries.
+        """
+        with self._lock:
+            return {model: limit.stats() for model, limit in self._models.items()}
+
+
+@contextmanager
+def retry_limit(max_retries: int):
+    """
+    Caps the retries of the requests sent inside the block, including in asyncio
+    tasks and asyncio.to_thread calls started from it, instead of the shared
+    controller's max_retries.
+    """
+    token = _retry_limit.set(max_retries)
+    try:
+        yield
+    finally:
+        _retry_limit.reset(token)
+
+
+@lru_cache(maxsize=None)
+def get_rate_controller() -> RateController:
+    """
+    Process-wide RateController. MODEL_RATE_LIMITS ("gpt-4o=5,pixtral-12b=2")
+    sets requests per second, RATE_INITIAL_CONCURRENCY, RATE_MAX_CONCURRENCY
+    and RATE_MAX_RETRIES the rest.
+    """
+    return RateController(
+        rates=parse_model_rates(getenv("MODEL_RATE_LIMITS")),
+        initial_limit=float(getenv("RATE_INITIAL_CONCURRENCY", 4)),
+        max_limit=float(getenv("RATE_MAX_CONCURRENCY", 64)),
+        max_retries=int(getenv("RATE_MAX_RETRIES", 4)),
+    )
+
+
+def request_model(request: httpx.Request) -> Optional[str]:
+    """
+    The model of a chat completion request, None for other requests.
+    """
+    if not request.url.path.endswith("/chat/completions"):
+        return None
+    try:
+        return json.loads(request.content).get("model")
+    except (ValueError, AttributeError, httpx.RequestNotRead):
+        return None
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """
+    Response stream giving the request's slot back once it is closed, so a
+    streamed completion holds it until its last chunk.
+    """
+
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if self._release is not None:
+                self._release, release = None, self._release
+                release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release, release = None, self._release
+                release()
+
+
+class RateControlledTransport(httpx.BaseTransport):
+    """
+    httpx transport sending chat completions through a RateController, with
+    bounded jittered retries (honoring Retry-After) of every request. Clients
+    using it should not retry themselves (max_retries=0).
+    """
+
+    def __init__(
+        self,
+        controller: Optional[RateController] = None,
+        transport: Optional[httpx.BaseTransport] = None,
+    ):
+        self.controller = controller or get_rate_controller()
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        controller = self.controller
+        model = request_model(request)
+        attempt = 0
+        while True:
+            if model is not None:
+                controller.acquire(model)
+            try:
+                response = self.transport.handle_request(request)
+            except httpx.TransportError:
+                if model is not None:
+                    controller.release(model)
+                delay = controller.retry_delay(model, attempt)
+                if delay is None:
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUSES:
+                    if model is not None:
+                        response.stream = _ReleasingStream(
+                            response.stream,
+                            lambda: controller.release(model, response.status_code),
+                        )
+                    return response
+                retry_after = parse_retry_after(response.headers)
+                if model is not None:
+                    controller.release(model, response.status_code, retry_after)
+                delay = controller.retry_delay(model, attempt, retry_after)
+                if delay is None:
+                    return response
+                response.read()
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncRateControlledTransport(httpx.AsyncBaseTransport):
+    """
+    Async version of RateControlledTransport, sharing its controller.
+    """
+
+    def __init__(
+        self,
+        controller: Optional[RateController] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.controller = controller or get_rate_controller()
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        controller = self.controller
+        model = request_model(request)
+        attempt = 0
+        while True:
+            if model is not None:
+                await controller.a_acquire(model)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError:
+                if model is not None:
+                    controller.release(model)
+                delay = controller.retry_delay(model, attempt)
+                if delay is None:
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUSES:
+                    if model is not None:
+                        response.stream = _AsyncReleasingStream(
+                            response.stream,
+                            lambda: controller.release(model, response.status_code),
+                        )
+                    return response
+                retry_after = parse_retry_after(response.headers)
+                if model is not None:
+                    controller.release(model, response.status_code, retry_after)
+                delay = controller.retry_delay(model, attempt, retry_after)
+                if delay is None:
+                    return response
+                await response.aread()
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+@lru_cache(maxsize=None)
+def get_rate_controlled_http_client() -> httpx.Client:
+    """
+    The http client of every OpenAI client of the process: the single round
+    extractors' and the autogen agents'.
+    """
+    return openai.DefaultHttpxClient(transport=RateControlledTransport())
+
+
+@lru_cache(maxsize=None)
+def get_rate_controlled_async_http_client() -> httpx.AsyncClient:
+    return openai.DefaultAsyncHttpxClient(transport=AsyncRateControlledTransport())
@@ -0,0 +1,109 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+
+from autogen import ConversableAgent
+from autogen.agentchat.chat import ChatResult
+
+from utils.text_layer import is_complete_extraction
+from utils.tracing import langfuse_context
+from utils.utils import parse_extraction
+
+
+def last_extraction_content(chat_result: ChatResult) -> Optional[str]:
+    """
+    Content of the last message of the chat holding a ChangeInAccountValue
+    that validates.
+    """
+    for message in reversed(chat_result.chat_history):
+        if parse_extraction(message.get("content")) is not None:
+            return message["content"]
+    return None
+
+
+def is_valid_extraction(chat_result: ChatResult) -> bool:
+    """
+    True when any message of the chat holds a ChangeInAccountValue with every
+    required field (see utils.text_layer.REQUIRED_FIELDS). Every field is
+    optional, so an empty object or one with the wrong keys would validate.
+    """
+    return any(
+        is_complete_extraction(parse_extraction(message.get("content")))
+        for message in chat_result.chat_history
+    )
+
+
+async def a_initiate_chats_parallel(
+    sender: ConversableAgent,
+    chat_queue: List[Dict[str, Any]],
+    timeout: Optional[float] = None,
+    first_n: Optional[int] = None,
+    is_valid: Callable[[ChatResult], bool] = is_valid_extraction,
+) -> Dict[Any, ChatResult]:
+    """
+    Parallel version of ConversableAgent.a_initiate_chats for chats without
+    prerequisites. Every chat is started at once and the results are keyed by
+    chat_id, like a_initiate_chats.
+
+    Args:
+        timeout: seconds each chat may run. A chat_info can override it with
+            its own "timeout" key. Chats that time out are left out of the results.
+        first_n: once this many chats have finished with a result accepted by
+            is_valid, the remaining chats are cancelled.
+    """
+    tasks = {}
+    for chat_info in chat_queue:
+        chat_info = dict(chat_info)
+        chat_id = chat_info.pop("chat_id")
+        chat_timeout = chat_info.pop("timeout", timeout)
+        if chat_info.pop("prerequisites", None):
+            raise ValueError(
+                f"Chat {chat_id} has prerequisites and can't be run in parallel"
+            )
+        chat_sender = chat_info.pop("sender", None) or sender
+
+        task = asyncio.create_task(
+            asyncio.wait_for(chat_sender.a_initiate_chat(**chat_info), chat_timeout)
+        )
+        tasks[task] = chat_id
+
+    results = {}
+    timed_out = []
+    valid_results = 0
+    pending = set(tasks)
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                chat_id = tasks[task]
+                try:
+                    chat_result = task.result()
+                except asyncio.TimeoutError:
+                    timed_out.append(chat_id)
+                    continue
+
+                chat_result.chat_id = chat_id
+                results[chat_id] = chat_result
+                if first_n and is_valid(chat_result):
+                    valid_results += 1
+
+            if first_n and valid_results >= first_n:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    langfuse_context.update_current_observation(
+        metadata={
+            "fan_out": {
+                "completed": list(results),
+                "timed_out": timed_out,
+                "cancelled": [tasks[task] for task in pending],
+            }
+        }
+    )
+
+    return results
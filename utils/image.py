@@ -0,0 +1,263 @@
+import base64
+import hashlib
+import io
+import math
+import mimetypes
+import os
+import tempfile
+from dataclasses import asdict, dataclass, field
+from os import getenv
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+from PIL import Image, ImageOps
+
+
+@dataclass(frozen=True)
+class ImageProfile:
+    """
+    How an image is preprocessed before being base64 encoded for a vision model.
+
+    max_long_side/max_short_side default to the resolution OpenAI models
+    downscale to anyway in high detail mode, so anything above it is wasted upload.
+
+    roi crops the page to the Change in Account Value table (see utils.roi),
+    keeping the full page when the table isn't found with roi_min_confidence.
+    """
+
+    name: str
+    max_long_side: Optional[int] = 2048
+    max_short_side: Optional[int] = 768
+    grayscale: bool = False
+    autocrop: bool = False
+    autocrop_threshold: int = 245
+    autocrop_margin: int = 16
+    format: str = "JPEG"
+    quality: int = 85
+    roi: bool = False
+    roi_margin: int = 24
+    roi_min_confidence: float = 0.6
+
+
+IMAGE_PROFILES: Dict[str, Optional[ImageProfile]] = {
+    # send the file untouched
+    "original": None,
+    "default": ImageProfile(name="default", autocrop=True),
+    "compact": ImageProfile(
+        name="compact", grayscale=True, autocrop=True, format="WEBP", quality=75
+    ),
+    "table": ImageProfile(name="table", autocrop=True, roi=True),
+}
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_bytes: int
+    original_width: int
+    original_height: int
+    profile: Optional[str] = None
+    roi: Optional[Dict[str, Any]] = None
+    _base64: Optional[str] = field(default=None, repr=False)
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode("utf-8")
+        return self._base64
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+    @property
+    def tokens(self) -> int:
+        return estimate_image_tokens(self.width, self.height)
+
+    def stats(self) -> Dict[str, Any]:
+        original_tokens = estimate_image_tokens(
+            self.original_width, self.original_height
+        )
+        return {
+            "profile": self.profile,
+            "mime_type": self.mime_type,
+            "bytes": len(self.data),
+            "bytes_saved": self.original_bytes - len(self.data),
+            "size": [self.width, self.height],
+            "original_size": [self.original_width, self.original_height],
+            "tokens": self.tokens,
+            "tokens_saved": original_tokens - self.tokens,
+            "roi": self.roi,
+        }
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """
+    Vision token cost of an image for OpenAI models in high detail mode: the image
+    is fit into 2048x2048, scaled so the short side is at most 768, then billed
+    85 tokens plus 170 per 512px tile.
+    """
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def get_image_profile(
+    profile: Union[str, ImageProfile, None] = None,
+) -> Optional[ImageProfile]:
+    """
+    Resolves a profile name. Defaults to the IMAGE_PROFILE env var, else "original".
+    """
+    if isinstance(profile, ImageProfile):
+        return profile
+    return IMAGE_PROFILES[profile or getenv("IMAGE_PROFILE", "original")]
+
+
+def autocrop_image(image: Image.Image, threshold: int = 245, margin: int = 16):
+    """
+    Crops near-white margins, keeping `margin` pixels around the content.
+    """
+    mask = image.convert("L").point(lambda p: 255 if p < threshold else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop(
+        (
+            max(0, left - margin),
+            max(0, top - margin),
+            min(image.width, right + margin),
+            min(image.height, bottom + margin),
+        )
+    )
+
+
+def resize_image(
+    image: Image.Image, max_long_side: Optional[int], max_short_side: Optional[int]
+):
+    scale = 1.0
+    if max_long_side:
+        scale = min(scale, max_long_side / max(image.size))
+    if max_short_side:
+        scale = min(scale, max_short_side / min(image.size))
+    if scale >= 1:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS)
+
+
+def preprocess_image(
+    image: Union[Path, str, bytes],
+    profile: Union[str, ImageProfile, None] = None,
+    mime_type: Optional[str] = None,
+) -> EncodedImage:
+    """
+    Applies an ImageProfile to an image file (or raw image bytes) and returns the
+    re-encoded bytes together with their MIME type and size/token savings.
+    """
+    profile = get_image_profile(profile)
+
+    if isinstance(image, bytes):
+        raw = image
+    else:
+        mime_type = mime_type or mimetypes.guess_type(str(image))[0]
+        with open(image, "rb") as f:
+            raw = f.read()
+
+    pil_image = Image.open(io.BytesIO(raw))
+    original_size = pil_image.size
+    mime_type = mime_type or Image.MIME.get(pil_image.format, "image/png")
+
+    if profile is None:
+        return EncodedImage(
+            data=raw,
+            mime_type=mime_type,
+            width=original_size[0],
+            height=original_size[1],
+            original_bytes=len(raw),
+            original_width=original_size[0],
+            original_height=original_size[1],
+        )
+
+    pil_image = ImageOps.exif_transpose(pil_image)
+    roi = None
+    if profile.roi:
+        # utils.roi imports this module
+        from utils.roi import crop_to_table
+
+        pil_image, region = crop_to_table(
+            pil_image, profile.roi_margin, profile.roi_min_confidence
+        )
+        roi = region.stats()
+    if profile.autocrop:
+        pil_image = autocrop_image(
+            pil_image, profile.autocrop_threshold, profile.autocrop_margin
+        )
+    pil_image = resize_image(pil_image, profile.max_long_side, profile.max_short_side)
+
+    if profile.grayscale:
+        pil_image = pil_image.convert("L")
+    elif pil_image.mode not in ("RGB", "L"):
+        pil_image = pil_image.convert("RGB")
+
+    buffer = io.BytesIO()
+    save_kwargs = {"optimize": True}
+    if profile.format.upper() in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = profile.quality
+    pil_image.save(buffer, format=profile.format, **save_kwargs)
+
+    return EncodedImage(
+        data=buffer.getvalue(),
+        mime_type=Image.MIME[profile.format.upper()],
+        width=pil_image.width,
+        height=pil_image.height,
+        original_bytes=len(raw),
+        original_width=original_size[0],
+        original_height=original_size[1],
+        profile=profile.name,
+        roi=roi,
+    )
+
+
+def image_profile_cache_params(
+    profile: Union[str, ImageProfile, None] = None,
+) -> Dict[str, Any]:
+    profile = get_image_profile(profile)
+    return {"image_profile": asdict(profile) if profile else None}
+
+
+def preprocessed_image_file(
+    image_path: Union[Path, str],
+    profile: Union[str, ImageProfile, None] = None,
+    cache_dir: Union[Path, str, None] = None,
+) -> str:
+    """
+    Path of image_path preprocessed with `profile`, for the agents, which load
+    images from `<img path>` tags themselves. The file is written once to
+    cache_dir (default IMAGE_CACHE_DIR, else .cache/images), named by its
+    content hash. Returns image_path itself when there is nothing to apply.
+    """
+    if get_image_profile(profile) is None:
+        return str(image_path)
+
+    image = preprocess_image(image_path, profile)
+    cache_dir = Path(
+        cache_dir
+        or getenv("IMAGE_CACHE_DIR", Path(__file__).parent.parent / ".cache" / "images")
+    )
+    path = cache_dir / (
+        hashlib.sha256(image.data).hexdigest()
+        + mimetypes.guess_extension(image.mime_type)
+    )
+    if not path.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # written aside and renamed, so a concurrent reader never sees a partial file
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+            f.write(image.data)
+        os.replace(f.name, path)
+    return str(path)
@@ -0,0 +1,162 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+from PIL import Image, ImageChops, ImageOps
+
+# What follow-up turns get instead of an image the agent already answered on:
+# "full" resends it, "reference" sends a short text reference and "crop" the
+# image trimmed to its content and downscaled. Only "full" and "crop" let the
+# agent read the image again, e.g. to redo an extraction the verifier rejected.
+IMAGE_REUSE_MODES = ("full", "reference", "crop")
+
+
+class ImageStore:
+    """
+    Content hash of each image seen in a conversation, and its cropped
+    version, computed once per image.
+    """
+
+    def __init__(self, max_crops: int = 64, crop_max_side: int = 768):
+        self.crop_max_side = crop_max_side
+        self.max_crops = max_crops
+        # PIL images aren't hashable, they are keyed by id() until collected
+        self._refs: Dict[int, str] = {}
+        self._crops: "OrderedDict[str, Image.Image]" = OrderedDict()
+        self._crop_ids: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def _forget(self, image_id: int):
+        with self._lock:
+            self._refs.pop(image_id, None)
+            self._crop_ids.discard(image_id)
+
+    def ref(self, image: Image.Image) -> str:
+        with self._lock:
+            ref = self._refs.get(id(image))
+        if ref is None:
+            digest = hashlib.sha256(f"{image.mode};{image.size};".encode())
+            digest.update(image.tobytes())
+            ref = digest.hexdigest()
+            with self._lock:
+                self._refs[id(image)] = ref
+            weakref.finalize(image, self._forget, id(image))
+        return ref
+
+    def crop(self, image: Image.Image) -> Image.Image:
+        """
+        The image without its blank margins, at most crop_max_side pixels on
+        its longest side.
+        """
+        ref = self.ref(image)
+        with self._lock:
+            if ref in self._crops:
+                self._crops.move_to_end(ref)
+                return self._crops[ref]
+
+        cropped = image.convert("RGB")
+        background = Image.new("RGB", cropped.size, (255, 255, 255))
+        bbox = ImageChops.difference(cropped, background).convert("L").getbbox()
+        if bbox:
+            cropped = cropped.crop(bbox)
+        if max(cropped.size) > self.crop_max_side:
+            cropped = ImageOps.contain(
+                cropped, (self.crop_max_side, self.crop_max_side)
+            )
+
+        with self._lock:
+            self._crops[ref] = cropped
+            self._crop_ids.add(id(cropped))
+            while len(self._crops) > self.max_crops:
+                self._crops.popitem(last=False)
+        weakref.finalize(cropped, self._forget, id(cropped))
+        return cropped
+
+    def is_crop(self, image: Image.Image) -> bool:
+        with self._lock:
+            return id(image) in self._crop_ids
+
+
+IMAGE_STORE = ImageStore()
+
+
+def _is_image_part(part: Any) -> bool:
+    return (
+        isinstance(part, dict)
+        and part.get("type") == "image_url"
+        and isinstance(part.get("image_url", {}).get("url"), Image.Image)
+    )
+
+
+def reference_part(ref: str) -> Dict[str, str]:
+    return {
+        "type": "text",
+        "text": f"[image {ref[:12]}: the statement image shown earlier in this conversation]",
+    }
+
+
+class ImageReuse:
+    """
+    process_all_messages_before_reply hook for multimodal agents: an image is
+    sent in full until the agent has replied to it, after that follow-up turns
+    carry a reference or a crop of it (see IMAGE_REUSE_MODES).
+
+    The agent's stored history is compacted the same way, so it stops holding
+    the decoded full-size image.
+    """
+
+    def __init__(self, mode: str = "crop", store: ImageStore = IMAGE_STORE):
+        if mode not in IMAGE_REUSE_MODES:
+            raise ValueError(f"Unknown image reuse mode {mode}")
+        self.mode = mode
+        self.store = store
+
+    def add_to_agent(self, agent):
+        if self.mode != "full":
+            agent.register_hook("process_all_messages_before_reply", self.process)
+
+    def replacement(self, part: Dict[str, Any]) -> Dict[str, Any]:
+        image = part["image_url"]["url"]
+        if self.mode == "crop":
+            return {
+                **part,
+                "image_url": {**part["image_url"], "url": self.store.crop(image)},
+            }
+        return reference_part(self.store.ref(image))
+
+    def needs_replacement(self, part: Any) -> bool:
+        return _is_image_part(part) and not self.store.is_crop(
+            part["image_url"]["url"]
+        )
+
+    def compact(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Copy of message with its images replaced, None if there is nothing to
+        replace.
+        """
+        content = message.get("content")
+        if not isinstance(content, list):
+            return None
+        if not any(self.needs_replacement(part) for part in content):
+            return None
+        return {
+            **message,
+            "content": [
+                self.replacement(part) if self.needs_replacement(part) else part
+                for part in content
+            ],
+        }
+
+    def process(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        answered = max(
+            (i for i, m in enumerate(messages) if m.get("role") == "assistant"),
+            default=-1,
+        )
+        for i in range(answered):
+            compacted = self.compact(messages[i])
+            if compacted is not None:
+                # in place: the list is the agent's history for this sender
+                messages[i] = compacted
+        return messages
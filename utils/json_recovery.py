@@ -0,0 +1,324 @@
+import json
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+
+from utils.schema import ChangeInAccountValue
+
+# Literals models borrow from Python or JavaScript, and their JSON spelling.
+_LITERALS = {
+    "None": "null",
+    "NaN": "null",
+    "undefined": "null",
+    "True": "true",
+    "False": "false",
+}
+_SMART_QUOTES = "“”"
+_NULL_STRINGS = {"", "-", "–", "—", "n/a", "na", "none", "null", "nil"}
+_NUMBER = re.compile(r"^[-+]?(\d+(\.\d*)?|\.\d+)$")
+# thousands separators in groups of 3, before the decimal point
+_GROUPED_NUMBER = re.compile(r"^[-+]?\d{1,3}(,\d{3})+(\.\d*)?$")
+# a JSON string, number or literal, possibly cut, as the last token of an output
+_SCALAR = r'(?:"(?:[^"\\]|\\.)*"|[-+\w.][\w.+-]*)'
+_ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# Complete dates besides ISO, as statements print them.
+DATE_FORMATS = (
+    "%m/%d/%Y",
+    "%m/%d/%y",
+    "%B %d, %Y",
+    "%b %d, %Y",
+    "%d %B %Y",
+    "%Y/%m/%d",
+)
+
+
+@dataclass
+class RecoveryResult:
+    """
+    The JSON object recovered from a model output, the repairs applied to get
+    it, and for recover_extraction the validated model.
+    """
+
+    data: Optional[Dict[str, Any]] = None
+    repairs: List[str] = field(default_factory=list)
+    extraction: Optional[BaseModel] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.data is not None
+
+
+def find_json_objects(text: str) -> List[Tuple[int, int, bool]]:
+    """
+    (start, end, closed) of every top-level {...} in text, in one pass.
+    Quotes only count inside an object, so prose apostrophes don't matter.
+    An object still open at the end (a truncated output) has closed=False.
+    """
+    spans = []
+    depth = 0
+    start = 0
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"' and depth:
+            in_string = True
+        elif char == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                spans.append((start, i + 1, True))
+    if depth:
+        spans.append((start, len(text), False))
+    return spans
+
+
+def _strip_trailing_comma(out: List[str]) -> bool:
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i]
+        return True
+    return False
+
+
+def _drop_incomplete_member(text: str, in_array: bool) -> Tuple[str, List[str]]:
+    """
+    Drops what a truncation leaves after the last complete member: a dangling
+    comma, a key without a value, a key and colon, or a scalar value not
+    followed by its delimiter, which may have been cut mid-token (33458 of
+    334582.17) and is never kept. in_array is whether the truncation is in an
+    array rather than an object. Returns the text and a "dropped:<key>" repair
+    per dropped value ("dropped:item" for an array item).
+    """
+    if in_array:
+        item = re.search(rf"([\[,])\s*{_SCALAR}\s*$", text)
+        if item:
+            return re.sub(r"\s*,$", "", text[: item.end(1)]), ["dropped:item"]
+        return re.sub(r"\s*,\s*$", "", text), []
+
+    dropped = []
+    member = re.search(rf'"((?:[^"\\]|\\.)*)"\s*:\s*{_SCALAR}\s*$', text)
+    if member:
+        dropped.append(f"dropped:{member.group(1)}")
+        text = text[: member.start()]
+    text = re.sub(r'\s*"(?:[^"\\]|\\.)*"\s*:\s*$', "", text)
+    text = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*$', r"\1", text)
+    return re.sub(r"\s*[,:]\s*$", "", text), dropped
+
+
+def repair_json(candidate: str) -> Tuple[str, List[str]]:
+    """
+    Fixes the usual defects of model-written JSON in one pass: smart quotes,
+    // comments, trailing commas, Python/JS literals, stray closing brackets and
+    truncation (closes the open string and brackets). Returns the repaired
+    text and the names of the repairs applied.
+    """
+    repairs = set()
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = False
+    escaped = False
+    i = 0
+    n = len(candidate)
+    while i < n:
+        char = candidate[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"' or char in _SMART_QUOTES:
+                if char != '"':
+                    repairs.add("smart_quotes")
+                    char = '"'
+                in_string = False
+            elif char == "\n":
+                repairs.add("newline_in_string")
+                char = "\\n"
+            out.append(char)
+            i += 1
+            continue
+
+        if char in _SMART_QUOTES:
+            repairs.add("smart_quotes")
+            char = '"'
+
+        if char == '"':
+            in_string = True
+            out.append(char)
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            out.append(char)
+        elif char in "}]":
+            if _strip_trailing_comma(out):
+                repairs.add("trailing_comma")
+            if stack and stack[-1] == char:
+                stack.pop()
+                out.append(char)
+            else:
+                repairs.add("unbalanced_bracket")
+        elif char == "/" and candidate.startswith("//", i):
+            repairs.add("comments")
+            end = candidate.find("\n", i)
+            i = n if end == -1 else end
+            continue
+        elif char.isalpha():
+            end = i
+            while end < n and (candidate[end].isalnum() or candidate[end] == "_"):
+                end += 1
+            word = candidate[i:end]
+            if word in _LITERALS:
+                repairs.add("literals")
+                word = _LITERALS[word]
+            out.append(word)
+            i = end
+            continue
+        else:
+            out.append(char)
+        i += 1
+
+    if in_string:
+        out.append('"')
+    text = "".join(out)
+    if in_string or stack:
+        repairs.add("truncated")
+        text, dropped = _drop_incomplete_member(text, stack[-1:] == ["]"])
+        repairs.update(dropped)
+        text += "".join(reversed(stack))
+    return text, sorted(repairs)
+
+
+def recover_json(content: Optional[str]) -> RecoveryResult:
+    """
+    Recovers the largest JSON object in a model output: bare, in a ```json
+    block, surrounded by prose, or truncated. Complete objects are tried
+    before a truncated one.
+    """
+    if not isinstance(content, str):
+        return RecoveryResult()
+
+    spans = find_json_objects(content)
+    spans.sort(key=lambda span: (span[2], span[1] - span[0]), reverse=True)
+    for start, end, _ in spans:
+        candidate = content[start:end]
+        try:
+            data = json.loads(candidate)
+            repairs = []
+        except json.JSONDecodeError:
+            candidate, repairs = repair_json(candidate)
+            try:
+                data = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+        if isinstance(data, dict):
+            if start > 0 or content[end:].strip():
+                repairs = ["surrounding_text", *repairs]
+            return RecoveryResult(data=data, repairs=repairs)
+    return RecoveryResult()
+
+
+def coerce_number(value: Any) -> Tuple[Any, bool]:
+    """
+    Float from a formatted amount: "$1,234.56", "(12.00)" (negative), "-",
+    "N/A" (null). Returns (value, whether it was changed); values that aren't
+    amounts are returned as is, including commas that aren't thousands
+    separators ("1.234,56", "12,34"), which can't be read unambiguously.
+    """
+    if not isinstance(value, str):
+        return value, False
+
+    text = value.strip()
+    if text.lower() in _NULL_STRINGS:
+        return None, True
+
+    negative = text.startswith("(") and text.endswith(")")
+    text = text.strip("()").replace("−", "-")
+    text = re.sub(r"[\s$]|USD", "", text)
+    if text.endswith("-"):
+        negative, text = True, text[:-1]
+    if "," in text:
+        if not _GROUPED_NUMBER.match(text):
+            return value, False
+        text = text.replace(",", "")
+    if not _NUMBER.match(text):
+        return value, False
+
+    number = float(text)
+    return (-abs(number) if negative else number), True
+
+
+def coerce_date(value: Any) -> Tuple[Any, bool]:
+    """
+    YYYY-MM-DD from the date formats statements use, e.g. 05/31/2024 or
+    May 31, 2024.
+    """
+    if not isinstance(value, str) or _ISO_DATE.match(value.strip()):
+        return value, False
+    text = value.strip()
+    if text.lower() in _NULL_STRINGS:
+        return None, True
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat(), True
+        except ValueError:
+            continue
+    return value, False
+
+
+def coerce_fields(
+    data: Dict[str, Any], model_cls: Type[BaseModel] = ChangeInAccountValue
+) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Coerces the values of data to the types of model_cls's fields: amounts for
+    float fields, ISO dates for fields named *_date or date. Returns the new
+    dict and one "coerced:<field>" repair per changed field.
+    """
+    coerced = dict(data)
+    repairs = []
+    for name, info in model_cls.model_fields.items():
+        if name not in coerced:
+            continue
+        if info.annotation in (float, Optional[float]):
+            value, changed = coerce_number(coerced[name])
+        elif name == "date" or name.endswith("_date"):
+            value, changed = coerce_date(coerced[name])
+        else:
+            continue
+        if changed:
+            coerced[name] = value
+            repairs.append(f"coerced:{name}")
+    return coerced, repairs
+
+
+def recover_extraction(
+    content: Optional[str], model_cls: Type[BaseModel] = ChangeInAccountValue
+) -> RecoveryResult:
+    """
+    recover_json, then coerce_fields and validation against model_cls.
+    extraction is None when the recovered object still doesn't validate.
+    """
+    result = recover_json(content)
+    if result.data is None:
+        return result
+
+    data, repairs = coerce_fields(result.data, model_cls)
+    result = RecoveryResult(data=data, repairs=result.repairs + repairs)
+    try:
+        result.extraction = model_cls.model_validate(data)
+    except ValidationError:
+        result.repairs.append("invalid")
+    return result
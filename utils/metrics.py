@@ -0,0 +1,256 @@
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from utils.json_recovery import DATE_FORMATS
+from utils.schema import ChangeInAccountValue
+
+FIELDS = list(ChangeInAccountValue.model_fields)
+NUMERIC_FIELDS = [
+    name
+    for name, info in ChangeInAccountValue.model_fields.items()
+    if info.annotation == Optional[float]
+]
+DATE_FIELDS = [name for name in FIELDS if name not in NUMERIC_FIELDS]
+
+METRICS = [
+    "support",
+    "exact",
+    "match",
+    "mean_rel_error",
+    "null_precision",
+    "null_recall",
+]
+
+
+def _parse_output(output: Any) -> Optional[Dict[str, Any]]:
+    if isinstance(output, dict):
+        return output
+    try:
+        parsed = json.loads(output)
+    except (TypeError, json.JSONDecodeError):
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+@dataclass
+class EvalFrames:
+    """
+    Predicted and expected outputs of many eval runs as aligned columnar frames,
+    one row per run and one column per ChangeInAccountValue field.
+
+    scored marks the fields present in the expected output; only those are
+    scored, like eval_exact_match. Runs whose output isn't a JSON object match
+    nothing.
+    """
+
+    index: pd.DataFrame
+    predicted: pd.DataFrame
+    expected: pd.DataFrame
+    scored: np.ndarray
+    parsed: np.ndarray
+
+    @classmethod
+    def from_records(
+        cls,
+        records: Iterable[Dict[str, Any]],
+        output_key: str = "output",
+        expected_key: str = "expected_output",
+    ) -> "EvalFrames":
+        """
+        records are dicts with "model", "item_id", output_key and expected_key.
+        Outputs are JSON strings or dicts.
+        """
+        records = list(records)
+        predicted = [_parse_output(r.get(output_key)) for r in records]
+        # every model is scored against the same expected outputs, parse each once
+        parsed_expected = {}
+        expected = []
+        for r in records:
+            value = r.get(expected_key)
+            key = value if isinstance(value, str) else id(value)
+            if key not in parsed_expected:
+                parsed_expected[key] = _parse_output(value) or {}
+            expected.append(parsed_expected[key])
+        parsed = np.array([p is not None for p in predicted], dtype=bool)
+        predicted = [p or {} for p in predicted]
+
+        index = pd.DataFrame(
+            {
+                "model": [r.get("model") for r in records],
+                "item_id": [r.get("item_id") for r in records],
+            }
+        )
+        scored = np.array(
+            [[name in e for name in FIELDS] for e in expected], dtype=bool
+        ).reshape(len(records), len(FIELDS))
+
+        return cls(
+            index=index,
+            predicted=pd.DataFrame.from_records(predicted, columns=FIELDS),
+            expected=pd.DataFrame.from_records(expected, columns=FIELDS),
+            scored=scored,
+            parsed=parsed,
+        )
+
+
+def _to_values(frame: pd.DataFrame) -> np.ndarray:
+    """
+    Float matrix of the frame: numbers as floats, dates as days since the
+    epoch. Values that can't be parsed are NaN, including partial dates such
+    as "2024" or "May 2024", which must not match a day.
+    """
+    values = np.full(frame.shape, np.nan)
+    for j, name in enumerate(FIELDS):
+        column = frame[name]
+        if name in NUMERIC_FIELDS:
+            values[:, j] = pd.to_numeric(column, errors="coerce").to_numpy(
+                dtype=float, na_value=np.nan
+            )
+        else:
+            column = column.astype("string").str.strip()
+            dates = pd.to_datetime(column, errors="coerce", format="%Y-%m-%d")
+            # only try the other formats on the values that aren't ISO dates
+            for date_format in DATE_FORMATS:
+                unparsed = dates.isna() & column.notna()
+                if not unparsed.any():
+                    break
+                dates[unparsed] = pd.to_datetime(
+                    column[unparsed], errors="coerce", format=date_format
+                )
+            days = dates.dt.normalize().to_numpy(dtype="datetime64[D]")
+            values[:, j] = np.where(
+                np.isnat(days), np.nan, days.astype("int64").astype(float)
+            )
+    return values
+
+
+def _normalized_text(frame: pd.DataFrame) -> np.ndarray:
+    """
+    Object matrix of the frame's values lowercased, with whitespace collapsed.
+    """
+    return (
+        frame.astype("string")
+        .apply(lambda column: column.str.lower().str.split().str.join(" "))
+        .to_numpy(dtype=object, na_value=None)
+    )
+
+
+def compare(
+    frames: EvalFrames, abs_tolerance: float = 0.01, rel_tolerance: float = 1e-6
+) -> Dict[str, np.ndarray]:
+    """
+    Compares every predicted field with its expected value in one pass.
+
+    Returns runs × fields boolean matrices "exact" (equal once normalized),
+    "match" (numbers within tolerance, dates on the same day), "predicted_null"
+    and "expected_null", and the float matrix "rel_error". Both values null
+    counts as a match. Date fields that aren't both complete dates match when
+    their normalized text is equal. Fields not in the expected output are
+    False everywhere.
+    """
+    predicted_null = frames.predicted.isna().to_numpy()
+    expected_null = frames.expected.isna().to_numpy()
+    predicted = _to_values(frames.predicted)
+    expected = _to_values(frames.expected)
+
+    both_values = ~predicted_null & ~expected_null
+    both_null = predicted_null & expected_null
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        diff = np.abs(predicted - expected)
+        rel_error = np.where(
+            both_values, diff / np.maximum(np.abs(expected), 1e-9), np.nan
+        )
+
+    is_numeric = np.isin(FIELDS, NUMERIC_FIELDS)
+    tolerance = np.where(
+        is_numeric, np.maximum(abs_tolerance, rel_tolerance * np.abs(expected)), 0
+    )
+    rounded_equal = np.round(predicted, 2) == np.round(expected, 2)
+
+    not_both_dates = np.isin(FIELDS, DATE_FIELDS) & (
+        np.isnan(predicted) | np.isnan(expected)
+    )
+    text_equal = (
+        both_values
+        & not_both_dates
+        & (_normalized_text(frames.predicted) == _normalized_text(frames.expected))
+    )
+
+    scored = frames.scored
+    both_null &= frames.parsed[:, None]
+    return {
+        "exact": scored & (both_null | (both_values & rounded_equal) | text_equal),
+        "match": scored
+        & (both_null | (both_values & (diff <= tolerance)) | text_equal),
+        "rel_error": np.where(scored, rel_error, np.nan),
+        "predicted_null": scored & predicted_null,
+        "expected_null": scored & expected_null,
+    }
+
+
+def record_scores(frames: EvalFrames, **tolerances) -> pd.DataFrame:
+    """
+    Share of scored fields that are exact and tolerant matches, per run.
+    """
+    comparison = compare(frames, **tolerances)
+    n_scored = np.maximum(frames.scored.sum(axis=1), 1)
+    return frames.index.assign(
+        exact=comparison["exact"].sum(axis=1) / n_scored,
+        match=comparison["match"].sum(axis=1) / n_scored,
+    )
+
+
+def field_metrics(frames: EvalFrames, **tolerances) -> pd.DataFrame:
+    """
+    Metrics per (model, field) over the whole dataset: number of scored
+    values, exact and tolerant match rates, mean relative error of non-null
+    values, and precision/recall of predicting null.
+    """
+    comparison = compare(frames, **tolerances)
+    models = frames.index["model"].to_numpy()
+
+    def per_model(matrix: np.ndarray) -> pd.DataFrame:
+        return pd.DataFrame(matrix, columns=FIELDS).groupby(models).sum()
+
+    support = per_model(frames.scored.astype(int))
+    true_nulls = per_model(comparison["predicted_null"] & comparison["expected_null"])
+    rel_error = pd.DataFrame(comparison["rel_error"], columns=FIELDS).groupby(models)
+
+    metrics = {
+        "support": support,
+        "exact": per_model(comparison["exact"]) / support,
+        "match": per_model(comparison["match"]) / support,
+        "mean_rel_error": rel_error.mean(),
+        "null_precision": true_nulls / per_model(comparison["predicted_null"]),
+        "null_recall": true_nulls / per_model(comparison["expected_null"]),
+    }
+    long = pd.concat(
+        {name: frame.stack(future_stack=True) for name, frame in metrics.items()},
+        axis=1,
+    )
+    long.index.names = ["model", "field"]
+    return long[METRICS]
+
+
+def metric_matrix(metrics: pd.DataFrame, metric: str = "match") -> pd.DataFrame:
+    """
+    model × field matrix of one metric from field_metrics.
+    """
+    return metrics[metric].unstack("field").reindex(columns=FIELDS)
+
+
+def evaluate(
+    records: Iterable[Dict[str, Any]], **tolerances
+) -> Dict[str, pd.DataFrame]:
+    frames = EvalFrames.from_records(records)
+    metrics = field_metrics(frames, **tolerances)
+    return {
+        "records": record_scores(frames, **tolerances),
+        "fields": metrics,
+        "match_matrix": metric_matrix(metrics, "match"),
+    }
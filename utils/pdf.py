@@ -0,0 +1,90 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from utils.schema import ChangeInAccountValue
+
+DEFAULT_PAGE_KEYWORDS = (
+    "Change in Account Value",
+    "Beginning Account Value",
+    "Ending Account Value",
+)
+
+
+@dataclass
+class PdfPage:
+    pdf_path: Path
+    page_number: int
+    text: str
+    words: List[Tuple]
+    # width and height in points, the unit of words' coordinates
+    page_size: Optional[Tuple[float, float]] = None
+    image: Optional[bytes] = None
+    mime_type: Optional[str] = None
+
+
+def is_relevant_page(text: str, keywords: Optional[Sequence[str]]) -> bool:
+    """
+    Pages without a text layer (e.g. scans) can't be filtered and count as relevant.
+    """
+    if not keywords or not text.strip():
+        return True
+    text = " ".join(text.lower().split())
+    return any(keyword.lower() in text for keyword in keywords)
+
+
+def iter_pdf_pages(
+    pdf_path: Union[Path, str],
+    dpi: int = 150,
+    keywords: Optional[Sequence[str]] = DEFAULT_PAGE_KEYWORDS,
+    pages: Optional[Iterable[int]] = None,
+    image_format: str = "png",
+    render: bool = True,
+) -> Iterator[PdfPage]:
+    """
+    Yields one PdfPage per candidate page of a PDF.
+
+    Pages are rasterized lazily, and only after their text layer matched one of
+    `keywords`, so irrelevant pages are never rendered. Pass keywords=None to
+    yield every page, and render=False to only read the text layer.
+    """
+    import pymupdf
+
+    with pymupdf.open(pdf_path) as document:
+        page_numbers = range(document.page_count) if pages is None else pages
+        for page_number in page_numbers:
+            page = document[page_number]
+            text = page.get_text()
+            if not is_relevant_page(text, keywords):
+                continue
+
+            pdf_page = PdfPage(
+                pdf_path=Path(pdf_path),
+                page_number=page_number,
+                text=text,
+                words=page.get_text("words"),
+                page_size=(page.rect.width, page.rect.height),
+            )
+            if render:
+                pdf_page.image = page.get_pixmap(dpi=dpi).tobytes(image_format)
+                pdf_page.mime_type = f"image/{image_format}"
+            yield pdf_page
+
+
+def select_extraction(
+    extractions: List[Optional[ChangeInAccountValue]],
+) -> ChangeInAccountValue:
+    """
+    The per-page extraction with the most fields, the first page's on a tie.
+    Fields are never combined across pages: a multi-account statement has one
+    Change in Account Value table per account, often many pages apart.
+    """
+    candidates = [extraction for extraction in extractions if extraction is not None]
+    if not candidates:
+        return ChangeInAccountValue()
+    return max(
+        candidates,
+        key=lambda extraction: sum(
+            value is not None for value in extraction.model_dump().values()
+        ),
+    )
@@ -0,0 +1,280 @@
+import json
+import logging
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Optional, Union
+
+from utils.timing import timed
+
+logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from langfuse import Langfuse
+    from langfuse.model import PromptClient
+
+# Every Langfuse prompt the extraction pipeline uses.
+PIPELINE_PROMPTS = [
+    "extractor_system_prompt",
+    "qwen_extractor_prompt",
+    "autogen_extractor_system_prompt",
+    "autogen_extractor_message_prompt",
+    "verifier_system_prompt",
+]
+
+
+def prompt_to_dict(prompt: "PromptClient") -> Dict[str, Any]:
+    from langfuse.model import ChatPromptClient
+
+    return {
+        "type": "chat" if isinstance(prompt, ChatPromptClient) else "text",
+        "name": prompt.name,
+        "version": prompt.version,
+        "config": prompt.config,
+        "labels": prompt.labels,
+        "tags": prompt.tags,
+        "prompt": prompt.prompt,
+    }
+
+
+def prompt_from_dict(data: Dict[str, Any]) -> "PromptClient":
+    from langfuse.api.resources.prompts import ChatMessage, Prompt_Chat, Prompt_Text
+    from langfuse.model import ChatPromptClient, TextPromptClient
+
+    data = dict(data)
+    prompt_type = data.pop("type")
+    if prompt_type == "chat":
+        data["prompt"] = [ChatMessage(**message) for message in data["prompt"]]
+        return ChatPromptClient(Prompt_Chat(**data), is_fallback=True)
+    return TextPromptClient(Prompt_Text(**data), is_fallback=True)
+
+
+class PromptRegistry:
+    """
+    In-memory cache of Langfuse prompts in front of Langfuse.get_prompt.
+
+    Prompts are served from memory for ttl_seconds. A stale prompt is still
+    served while it is refetched in the background, so only the first fetch of
+    a prompt waits on Langfuse. If Langfuse is unreachable the last known good
+    version is served, from memory or from the on-disk snapshot written after
+    every successful fetch.
+    Compiled templates are memoized (LRU) per (prompt, version, args).
+
+    client is a Langfuse client, or a function returning one so the client is
+    only created on the first fetch.
+    """
+
+    def __init__(
+        self,
+        client: Union["Langfuse", Callable[[], "Langfuse"]],
+        ttl_seconds: float = 300,
+        snapshot_path: Optional[Union[Path, str]] = None,
+        max_compiled: int = 1024,
+    ):
+        self._client = client
+        self.ttl_seconds = ttl_seconds
+        self.snapshot_path = Path(snapshot_path) if snapshot_path else None
+
+        self._prompts: Dict[str, "PromptClient"] = {}
+        self._fetched_at: Dict[str, float] = {}
+        self.max_compiled = max_compiled
+        self._compiled: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+        # one snapshot write at a time, apart from _lock so reads don't wait on disk
+        self._snapshot_lock = threading.Lock()
+        self._refreshing: Dict[str, threading.Thread] = {}
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._stop_refresh = threading.Event()
+
+    @property
+    def client(self) -> "Langfuse":
+        if callable(self._client):
+            self._client = self._client()
+        return self._client
+
+    def _fetch(self, name: str) -> "PromptClient":
+        # bypass the SDK's own cache, the registry decides when to refetch
+        prompt = self.client.get_prompt(name, cache_ttl_seconds=0)
+        with self._lock:
+            self._prompts[name] = prompt
+            self._fetched_at[name] = time.monotonic()
+        return prompt
+
+    def _load_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        if self.snapshot_path is None or not self.snapshot_path.exists():
+            return {}
+        with open(self.snapshot_path) as f:
+            return json.load(f)
+
+    def save_snapshot(self):
+        """
+        Writes the fetched prompts to snapshot_path. A failed write is logged,
+        it never fails the request that triggered it.
+        """
+        if self.snapshot_path is None:
+            return
+        with self._snapshot_lock:
+            try:
+                with self._lock:
+                    snapshot = self._load_snapshot()
+                    snapshot.update(
+                        {
+                            name: prompt_to_dict(prompt)
+                            for name, prompt in self._prompts.items()
+                            if not prompt.is_fallback
+                        }
+                    )
+                self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    "w",
+                    dir=self.snapshot_path.parent,
+                    prefix=f"{self.snapshot_path.name}.",
+                    suffix=".tmp",
+                    delete=False,
+                ) as f:
+                    tmp_path = Path(f.name)
+                    try:
+                        json.dump(snapshot, f, indent=2, default=str)
+                    except BaseException:
+                        f.close()
+                        tmp_path.unlink(missing_ok=True)
+                        raise
+                tmp_path.replace(self.snapshot_path)
+            except (OSError, ValueError) as e:
+                logger.warning("Could not save the prompt snapshot: %s", e)
+
+    def _fallback(self, name: str, error: Exception) -> "PromptClient":
+        with self._lock:
+            if name in self._prompts:
+                return self._prompts[name]
+            snapshot = self._load_snapshot()
+            if name not in snapshot:
+                raise error
+            prompt = prompt_from_dict(snapshot[name])
+            self._prompts[name] = prompt
+            # retry the network on the next call
+            self._fetched_at[name] = float("-inf")
+            return prompt
+
+    def get_prompt(self, name: str) -> "PromptClient":
+        with timed("prompt_fetch"):
+            return self._get_prompt(name)
+
+    def _get_prompt(self, name: str) -> "PromptClient":
+        with self._lock:
+            prompt = self._prompts.get(name)
+            fetched_at = self._fetched_at.get(name, float("-inf"))
+        if prompt is not None:
+            if time.monotonic() - fetched_at >= self.ttl_seconds:
+                self._refresh_in_background(name)
+            return prompt
+
+        try:
+            prompt = self._fetch(name)
+        except Exception as e:
+            return self._fallback(name, e)
+
+        self.save_snapshot()
+        return prompt
+
+    def _refresh_in_background(self, name: str):
+        """
+        Refetches a stale prompt in a daemon thread, at most one per prompt,
+        so callers on an event loop never block on Langfuse.
+        """
+
+        def refresh():
+            try:
+                self._fetch(name)
+                self.save_snapshot()
+            except Exception:
+                # the stale prompt stays in use, retried on the next call
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.pop(name, None)
+
+        with self._lock:
+            if name in self._refreshing:
+                return
+            thread = threading.Thread(
+                target=refresh, name=f"prompt-refresh-{name}", daemon=True
+            )
+            self._refreshing[name] = thread
+        thread.start()
+
+    def compile(self, prompt: Union[str, "PromptClient"], **prompt_args):
+        """
+        Compiles a prompt, given by name or as a prompt client, reusing earlier
+        compilations with the same args.
+        """
+        if isinstance(prompt, str):
+            prompt = self.get_prompt(prompt)
+        key = (
+            prompt.name,
+            prompt.version,
+            prompt.is_fallback,
+            json.dumps(prompt_args, sort_keys=True, default=str),
+        )
+        with self._lock:
+            if key in self._compiled:
+                self._compiled.move_to_end(key)
+            else:
+                self._compiled[key] = prompt.compile(**prompt_args)
+                if len(self._compiled) > self.max_compiled:
+                    self._compiled.popitem(last=False)
+            return deepcopy(self._compiled[key])
+
+    def prefetch(self, names: Iterable[str] = PIPELINE_PROMPTS):
+        """
+        Fetches prompts concurrently, falling back to the snapshot for any that fail.
+        """
+        names = list(names)
+        with ThreadPoolExecutor(max_workers=max(1, len(names))) as executor:
+            results = list(executor.map(self._prefetch_one, names))
+        self.save_snapshot()
+        return dict(zip(names, results))
+
+    def _prefetch_one(self, name: str) -> Optional["PromptClient"]:
+        try:
+            return self._fetch(name)
+        except Exception as e:
+            try:
+                return self._fallback(name, e)
+            except Exception:
+                return None
+
+    def start_background_refresh(self, interval_seconds: Optional[float] = None):
+        """
+        Refreshes every known prompt in a daemon thread, so requests never wait
+        on prompt management.
+        """
+        if self._refresh_thread is not None:
+            return
+        interval_seconds = interval_seconds or self.ttl_seconds / 2
+
+        def refresh():
+            while not self._stop_refresh.wait(interval_seconds):
+                with self._lock:
+                    names = list(self._prompts)
+                refreshed = False
+                for name in names:
+                    try:
+                        self._fetch(name)
+                        refreshed = True
+                    except Exception:
+                        continue
+                if refreshed:
+                    self.save_snapshot()
+
+        self._refresh_thread = threading.Thread(
+            target=refresh, name="prompt-registry-refresh", daemon=True
+        )
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self):
+        self._stop_refresh.set()
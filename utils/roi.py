@@ -0,0 +1,383 @@
+import io
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+from utils.image import estimate_image_tokens
+from utils.pdf import PdfPage
+from utils.text_layer import (
+    FIELD_LABELS,
+    find_label,
+    group_rows,
+    parse_amount,
+    parse_reporting_period,
+)
+from utils.timing import count
+
+# Labels of the first and last rows of the Change in Account Value table.
+START_LABELS: Sequence[str] = (
+    *FIELD_LABELS["starting_value"],
+    "Beginning Portfolio Value",
+)
+END_LABELS: Sequence[str] = (*FIELD_LABELS["ending_value"], "Ending Portfolio Value")
+ALL_LABELS: Sequence[str] = tuple(
+    label for labels in FIELD_LABELS.values() for label in labels
+)
+
+
+@dataclass
+class TableRegion:
+    """
+    Where the target table is on a page image, in pixels, and how sure the
+    detection is of it. method is "text_layer", "lines" or "full_page".
+    header is the part of the page with the statement period, which the
+    table usually doesn't include.
+    """
+
+    box: Tuple[int, int, int, int]
+    confidence: float
+    method: str
+    header: Optional[Tuple[int, int, int, int]] = None
+
+    def stats(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def full_page(image: Image.Image) -> TableRegion:
+    return TableRegion((0, 0, image.width, image.height), 0.0, "full_page")
+
+
+def _find_row(
+    rows: List[List[Tuple]], labels: Sequence[str], after: float = -1
+) -> Optional[Tuple[List[Tuple], int]]:
+    for row in rows:
+        if row[0][1] <= after:
+            continue
+        for label in labels:
+            index = find_label(row, label)
+            if index is not None:
+                return row, index - len(label.split()) + 1
+    return None
+
+
+def _join(words: List[Tuple]) -> str:
+    return " ".join(word[4] for word in words)
+
+
+def _find_period(rows: List[List[Tuple]]) -> Optional[List[Tuple]]:
+    """
+    The words of the first statement period, e.g. "July 1 – July 31, 2015".
+    """
+    for row in rows:
+        if parse_reporting_period(_join(row))[0] is None:
+            continue
+        # the last words that still match, so the rest of the row is left out
+        first = max(
+            index
+            for index in range(len(row))
+            if parse_reporting_period(_join(row[index:]))[0] is not None
+        )
+        last = min(
+            index
+            for index in range(first + 1, len(row) + 1)
+            if parse_reporting_period(_join(row[first:index]))[0] is not None
+        )
+        return row[first:last]
+    return None
+
+
+def _scale_box(box: Tuple[float, ...], scale: float) -> Tuple[int, int, int, int]:
+    left, top, right, bottom = box
+    return (
+        int(left * scale),
+        int(top * scale),
+        int(right * scale) + 1,
+        int(bottom * scale) + 1,
+    )
+
+
+def locate_table_from_words(
+    words: List[Tuple],
+    page_size: Tuple[float, float],
+    scale: float = 1.0,
+    header_rows: float = 2.5,
+) -> Optional[TableRegion]:
+    """
+    Locates the table between the beginning and ending value rows of a PDF
+    text layer (PyMuPDF words, in points). The box spans from the beginning
+    value label to the last amount of its row or the ending value row, and
+    from `header_rows` lines above the beginning value row (the table title
+    and column headers) to the last labelled row close below the ending
+    value, scaled to pixels by `scale` (dpi / 72). The header is the
+    statement period, when the page has one.
+    """
+    rows = group_rows(words)
+    start = _find_row(rows, START_LABELS)
+    if start is None:
+        return None
+    start_row, start_index = start
+    left = start_row[start_index][0]
+    top = start_row[start_index][1]
+
+    end = _find_row(rows, END_LABELS, after=top)
+    if end is None:
+        return None
+    end_row, _ = end
+
+    # the table ends with its amount columns, other columns of the page may
+    # share its rows
+    width, height = page_size
+    right = left
+    for row in (start_row, end_row):
+        edge = left
+        for word in row:
+            if word[0] < left:
+                continue
+            if word[0] - edge > 0.15 * width:
+                break
+            edge = word[2]
+            if parse_amount(word[4]) is not None:
+                right = max(right, word[2])
+    if right == left:
+        return None
+    bottom = max(word[3] for word in end_row if left <= word[0] < right)
+    line_height = start_row[start_index][3] - top
+
+    # rows like "Ending Value with Accrued Income" can follow the ending value
+    for row in rows[rows.index(end_row) + 1 :]:
+        row = [word for word in row if left - line_height <= word[0] < right]
+        if not row:
+            continue
+        if row[0][1] - bottom > 3 * line_height:
+            break
+        if any(find_label(row, label) is not None for label in ALL_LABELS):
+            bottom = max(word[3] for word in row)
+
+    top = max(0, top - header_rows * line_height)
+
+    # a "table" over most of the page means the labels matched unrelated rows
+    confidence = 0.9 if (bottom - top) < 0.6 * height else 0.3
+    box = _scale_box((left, top, right, bottom), scale)
+
+    header = None
+    period = _find_period(rows)
+    if period is not None:
+        header = _scale_box(
+            (
+                min(word[0] for word in period),
+                min(word[1] for word in period),
+                max(word[2] for word in period),
+                max(word[3] for word in period),
+            ),
+            scale,
+        )
+    return TableRegion(box, confidence, "text_layer", header)
+
+
+def _extend(ink_rows, start: int, step: int, max_gap: int, limit: int) -> int:
+    """
+    Last row with ink reached from `start` moving by `step`, crossing blank
+    runs of at most max_gap rows, at most `limit` rows away.
+    """
+    last = start
+    y = start
+    while 0 <= y + step < len(ink_rows) and abs(y + step - start) <= limit:
+        y += step
+        if ink_rows[y]:
+            last = y
+        elif abs(y - last) > max_gap:
+            break
+    return last
+
+
+def _overlap(a: Tuple[int, ...], b: Tuple[int, ...]) -> bool:
+    """
+    Whether two rules (x, y, w, h) share at least half of the shorter one.
+    """
+    shared = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    return shared >= 0.5 * min(a[2], b[2])
+
+
+def locate_table_from_lines(
+    image: Image.Image,
+    rule_threshold: int = 240,
+    text_threshold: int = 180,
+    header_fraction: float = 0.15,
+) -> Optional[TableRegion]:
+    """
+    Locates a ruled table on a page image from its horizontal rules: thin
+    rules under the same columns and close to each other are grouped into
+    tables, a thick rule (a section bar) always starts a new one. The topmost
+    table is extended up and down to the text around its rules. With several
+    candidate tables the choice is a guess and the confidence is low.
+
+    Without a text layer the statement period can't be found, the header is
+    the top header_fraction of the page right of the table, where the
+    layouts we see print it.
+
+    Returns None when OpenCV isn't installed, so the caller falls back to the
+    full page.
+    """
+    try:
+        import cv2
+    except ImportError:
+        return None
+    import numpy as np
+
+    gray = np.asarray(image.convert("L"))
+    height, width = gray.shape
+    # fixed thresholds rather than Otsu, which misses light gray rules, and
+    # text darker than watermarks and shading
+    ink = (gray < rule_threshold).astype(np.uint8) * 255
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(40, width // 25), 1))
+    rules_mask = cv2.morphologyEx(ink, cv2.MORPH_OPEN, kernel)
+    contours, _ = cv2.findContours(
+        rules_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    )
+    max_thickness = max(8, height // 100)
+    rules = sorted(
+        (
+            (x, y, w, h)
+            for x, y, w, h in map(cv2.boundingRect, contours)
+            # not filled shapes, and not the page border
+            if h <= max_thickness and 0.15 * width <= w < 0.95 * width
+        ),
+        key=lambda rule: rule[1],
+    )
+
+    tables: List[List[Tuple[int, int, int, int]]] = []
+    for rule in rules:
+        x, y, w, h = rule
+        # the nearest table first
+        for table in reversed(tables) if h < 4 else []:
+            bottom = max(ty + th for _, ty, _, th in table)
+            if y - bottom <= 0.2 * height and any(_overlap(rule, r) for r in table):
+                table.append(rule)
+                break
+        else:
+            tables.append([rule])
+
+    tables = [table for table in tables if len(table) >= 2]
+    if not tables:
+        return None
+    table = min(tables, key=lambda table: table[0][1])
+
+    # the table's columns are those of its median rule, rules much wider than
+    # it run under neighbouring content too
+    median = sorted(table, key=lambda rule: rule[2])[len(table) // 2]
+    columns = [
+        rule for rule in table if rule[2] <= 1.5 * median[2] and _overlap(rule, median)
+    ]
+    left = min(x for x, _, _, _ in columns)
+    right = max(x + w for x, _, w, _ in columns)
+
+    ink_rows = (gray[:, left:right] < text_threshold).any(axis=1)
+    max_gap = max(12, height // 40)
+    top = _extend(ink_rows, columns[0][1], -1, max_gap, height // 4)
+    bottom = _extend(ink_rows, columns[-1][1] + columns[-1][3], 1, max_gap, height // 4)
+
+    confidence = 0.8 if len(tables) == 1 else 0.5
+    header = (left, 0, width, int(height * header_fraction))
+    return TableRegion((left, top, right, bottom + 1), confidence, "lines", header)
+
+
+def locate_table(
+    image: Image.Image,
+    words: Optional[List[Tuple]] = None,
+    page_size: Optional[Tuple[float, float]] = None,
+) -> TableRegion:
+    """
+    The region of the Change in Account Value table: from the text layer when
+    there is one, else from the image's ruling lines, else the full page.
+    A text layer without the table's labels means the lines would only find
+    some other table.
+    """
+    if words and page_size:
+        region = locate_table_from_words(
+            words, page_size, scale=image.width / page_size[0]
+        )
+    else:
+        region = locate_table_from_lines(image)
+    return region or full_page(image)
+
+
+def crop_with_header(
+    image: Image.Image,
+    box: Tuple[int, int, int, int],
+    header: Optional[Tuple[int, int, int, int]] = None,
+) -> Image.Image:
+    """
+    The crop of image to box, with the crop to header stacked above it. A
+    header that reaches the box is cropped together with it instead.
+    """
+    if header is None:
+        return image.crop(box)
+    if header[3] >= box[1]:
+        return image.crop((min(box[0], header[0]), min(box[1], header[1]), *box[2:]))
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    header_image = image.crop(header)
+    table = image.crop(box)
+    combined = Image.new(
+        image.mode,
+        (max(header_image.width, table.width), header_image.height + table.height),
+        "white",
+    )
+    combined.paste(header_image, (0, 0))
+    combined.paste(table, (0, header_image.height))
+    return combined
+
+
+def crop_to_table(
+    image: Image.Image,
+    margin: int = 24,
+    min_confidence: float = 0.6,
+    words: Optional[List[Tuple]] = None,
+    page_size: Optional[Tuple[float, float]] = None,
+) -> Tuple[Image.Image, TableRegion]:
+    """
+    Crops image to the table found by locate_table plus `margin` pixels, with
+    the region's header (the statement period) stacked above it. The image is returned whole, with a "full_page"
+    region, below min_confidence or when the crop would cost as many vision
+    tokens as the page (a wide table isn't downscaled like the page is).
+    """
+    region = locate_table(image, words, page_size)
+    if region.confidence < min_confidence:
+        count("roi_fallbacks")
+        return image, replace(full_page(image), confidence=region.confidence)
+
+    left, top, right, bottom = region.box
+    box = (
+        max(0, left - margin),
+        max(0, top - margin),
+        min(image.width, right + margin),
+        min(image.height, bottom + margin),
+    )
+    cropped = crop_with_header(image, box, region.header)
+    if estimate_image_tokens(*cropped.size) >= estimate_image_tokens(*image.size):
+        count("roi_fallbacks")
+        return image, replace(full_page(image), confidence=region.confidence)
+
+    count("roi_crops")
+    return cropped, replace(region, box=box)
+
+
+def crop_pdf_page(
+    page: PdfPage, margin: int = 24, min_confidence: float = 0.6
+) -> Tuple[PdfPage, TableRegion]:
+    """
+    page with its image cropped by crop_to_table using the page's text layer,
+    or page itself when the full page is kept.
+    """
+    image = Image.open(io.BytesIO(page.image))
+    cropped, region = crop_to_table(
+        image, margin, min_confidence, page.words, page.page_size
+    )
+    if cropped is image:
+        return page, region
+    buffer = io.BytesIO()
+    cropped.save(buffer, format="PNG")
+    return replace(page, image=buffer.getvalue(), mime_type="image/png"), region
@@ -53,3 +53,66 @@ class ChangeInAccountValue(BaseModel):
         None,
         description="The overall change in the account value during the period, including deposits, withdrawals and any accrued income.",
     )
+
+
+class Holding(BaseModel):
+    description: Optional[str] = Field(
+        None, description="Name or description of the security or cash position."
+    )
+    symbol: Optional[str] = Field(
+        None, description="Ticker symbol or CUSIP of the security, if shown."
+    )
+    quantity: Optional[float] = Field(
+        None, description="Number of shares or units held at the end of the period."
+    )
+    price: Optional[float] = Field(
+        None, description="Price per share or unit at the end of the period."
+    )
+    market_value: Optional[float] = Field(
+        None, description="Market value of the position at the end of the period."
+    )
+    cost_basis: Optional[float] = Field(
+        None, description="Total cost basis of the position, if shown."
+    )
+
+
+class Transaction(BaseModel):
+    date: Optional[str] = Field(
+        None, description="The date of the transaction. In the format YYYY-MM-DD."
+    )
+    transaction_type: Optional[str] = Field(
+        None,
+        description="The type of transaction as shown, e.g. Buy, Sell, Dividend, Deposit, Withdrawal.",
+    )
+    description: Optional[str] = Field(
+        None, description="Description of the transaction or security."
+    )
+    quantity: Optional[float] = Field(
+        None, description="Number of shares or units, if applicable."
+    )
+    price: Optional[float] = Field(
+        None, description="Price per share or unit, if applicable."
+    )
+    amount: Optional[float] = Field(
+        None,
+        description="Net amount of the transaction, negative when money leaves the account.",
+    )
+
+
+class IncomeSummary(BaseModel):
+    dividends: Optional[float] = Field(
+        None, description="Total dividends received during the period."
+    )
+    interest: Optional[float] = Field(
+        None, description="Total interest received during the period."
+    )
+    capital_gains_distributions: Optional[float] = Field(
+        None,
+        description="Total capital gains distributions received during the period.",
+    )
+    other_income: Optional[float] = Field(
+        None, description="Any other income received during the period."
+    )
+    total_income: Optional[float] = Field(
+        None, description="Total income received during the period."
+    )
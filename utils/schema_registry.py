@@ -0,0 +1,200 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type
+
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, create_model
+
+from utils.json_recovery import coerce_fields, recover_json
+from utils.schema import ChangeInAccountValue, Holding, IncomeSummary, Transaction
+
+# Name of the structured output when only ChangeInAccountValue is extracted,
+# kept so single table outputs are unchanged.
+DEFAULT_SCHEMA_NAME = "change_in_account_value"
+COMPOSITE_SCHEMA_NAME = "statement_tables"
+
+
+@dataclass(frozen=True)
+class TableSchema:
+    """
+    One table of a statement. Tables with many=True are lists of rows.
+    """
+
+    name: str
+    model: Type[BaseModel]
+    description: str
+    many: bool = False
+
+    @property
+    def annotation(self) -> Any:
+        return List[self.model] if self.many else self.model
+
+
+class SchemaRegistry:
+    """
+    Table models that can be extracted from a statement, and the subsets of
+    them to extract per document type.
+
+    The tables requested for a document are combined into one composite
+    Pydantic model, one optional field per table, so a single model call
+    extracts all of them from the image.
+    """
+
+    def __init__(self):
+        self._tables: Dict[str, TableSchema] = {}
+        self._document_types: Dict[str, Tuple[str, ...]] = {}
+        # built once per combination of tables, until a table is registered
+        self._composite_models: Dict[Tuple[str, ...], Type[BaseModel]] = {}
+
+    def register(
+        self,
+        name: str,
+        model: Type[BaseModel],
+        description: str,
+        many: bool = False,
+    ) -> TableSchema:
+        table = TableSchema(name, model, description, many)
+        self._tables[name] = table
+        self._composite_models.clear()
+        return table
+
+    def register_document_type(self, document_type: str, tables: Sequence[str]):
+        self._check_tables(tables)
+        self._document_types[document_type] = tuple(tables)
+
+    @property
+    def tables(self) -> List[str]:
+        return list(self._tables)
+
+    @property
+    def document_types(self) -> List[str]:
+        return list(self._document_types)
+
+    def get(self, name: str) -> TableSchema:
+        self._check_tables([name])
+        return self._tables[name]
+
+    def select(
+        self, document_type: str = None, tables: Sequence[str] = None
+    ) -> Tuple[str, ...]:
+        """
+        Tables to extract: `tables` if given, else the tables of
+        `document_type`, else every registered table.
+        """
+        if tables:
+            self._check_tables(tables)
+            return tuple(tables)
+        if document_type is not None:
+            if document_type not in self._document_types:
+                raise ValueError(
+                    f"Unknown document type {document_type}, "
+                    f"expected one of {self.document_types}"
+                )
+            return self._document_types[document_type]
+        return tuple(self._tables)
+
+    def composite_model(self, tables: Sequence[str]) -> Type[BaseModel]:
+        self._check_tables(tables)
+        tables = tuple(tables)
+        model = self._composite_models.get(tables)
+        if model is None:
+            model = self._composite_models.setdefault(
+                tables, self._build_composite_model(tables)
+            )
+        return model
+
+    def _build_composite_model(self, tables: Tuple[str, ...]) -> Type[BaseModel]:
+        fields = {
+            name: (
+                Optional[self._tables[name].annotation],
+                Field(None, description=self._tables[name].description),
+            )
+            for name in tables
+        }
+        return create_model(
+            "StatementTables_" + "_".join(tables), __base__=BaseModel, **fields
+        )
+
+    def json_schema(self, tables: Sequence[str]) -> Dict[str, Any]:
+        """
+        JSON schema of the requested tables. A lone ChangeInAccountValue keeps
+        its own flat schema, so existing prompts and cached outputs still apply.
+        """
+        if tuple(tables) == (DEFAULT_SCHEMA_NAME,):
+            return self._tables[DEFAULT_SCHEMA_NAME].model.model_json_schema()
+        return self.composite_model(tables).model_json_schema()
+
+    def schema_name(self, tables: Sequence[str]) -> str:
+        """
+        Structured output name: the table's name for a single table, else
+        COMPOSITE_SCHEMA_NAME.
+        """
+        if len(tables) == 1:
+            return tables[0]
+        return COMPOSITE_SCHEMA_NAME
+
+    def parse(self, content: Optional[str], tables: Sequence[str]) -> Dict[str, Any]:
+        """
+        Typed object per table from a model's output, recovered and coerced
+        with utils.json_recovery. Tables missing from the output or failing
+        validation are None.
+        """
+        self._check_tables(tables)
+        parsed = {name: None for name in tables}
+        data = recover_json(content).data
+        if data is None:
+            return parsed
+
+        if tuple(tables) == (DEFAULT_SCHEMA_NAME,) and DEFAULT_SCHEMA_NAME not in data:
+            data = {DEFAULT_SCHEMA_NAME: data}
+
+        for name in tables:
+            table = self._tables[name]
+            value = data.get(name)
+            if value is None:
+                continue
+            if table.many and isinstance(value, list):
+                value = [
+                    coerce_fields(row, table.model)[0] if isinstance(row, dict) else row
+                    for row in value
+                ]
+            elif isinstance(value, dict):
+                value = coerce_fields(value, table.model)[0]
+            try:
+                parsed[name] = TypeAdapter(table.annotation).validate_python(value)
+            except ValidationError:
+                continue
+        return parsed
+
+    def _check_tables(self, tables: Sequence[str]):
+        unknown = [name for name in tables if name not in self._tables]
+        if unknown:
+            raise ValueError(f"Unknown tables {unknown}, expected one of {self.tables}")
+
+
+schema_registry = SchemaRegistry()
+schema_registry.register(
+    DEFAULT_SCHEMA_NAME,
+    ChangeInAccountValue,
+    "The change in account value summary for the reporting period.",
+)
+schema_registry.register(
+    "holdings",
+    Holding,
+    "Every position held at the end of the period, one row per security.",
+    many=True,
+)
+schema_registry.register(
+    "transactions",
+    Transaction,
+    "Every transaction listed for the period, one row per transaction.",
+    many=True,
+)
+schema_registry.register(
+    "income_summary",
+    IncomeSummary,
+    "The income summary for the period.",
+)
+schema_registry.register_document_type(
+    "brokerage_statement",
+    [DEFAULT_SCHEMA_NAME, "holdings", "transactions", "income_summary"],
+)
+schema_registry.register_document_type("account_summary", [DEFAULT_SCHEMA_NAME])
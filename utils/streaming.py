@@ -0,0 +1,267 @@
+import json
+import time
+from contextlib import aclosing
+from dataclasses import dataclass, field, replace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+from utils.schema import ChangeInAccountValue
+from utils.timing import count, timed
+
+
+class StreamingViolation(Exception):
+    """
+    Raised when a streamed completion can no longer produce a valid
+    extraction: it isn't JSON, a field fails validation, or it runs too long.
+    """
+
+    def __init__(self, reason: str, text: str):
+        super().__init__(reason)
+        self.reason = reason
+        self.text = text
+
+
+class IncrementalJSONParser:
+    """
+    Parses a JSON object field by field while it is being streamed.
+
+    Text before the opening brace (e.g. a ```json fence) is skipped, up to
+    max_preamble_chars. feed() returns the (key, value) pairs of the top-level
+    object completed by the new text; nested values are returned whole once
+    they are closed.
+    """
+
+    def __init__(self, max_preamble_chars: int = 200):
+        self.max_preamble_chars = max_preamble_chars
+        self.text = ""
+        self.done = False
+        self.start: Optional[int] = None
+        self.end: Optional[int] = None
+
+        self._pos = 0
+        self._state = "preamble"
+        self._token_start = 0
+        self._key: Optional[str] = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self.text += chunk
+        fields = []
+        while self._pos < len(self.text) and not self.done:
+            field = self._step(self.text[self._pos])
+            self._pos += 1
+            if field is not None:
+                fields.append(field)
+
+        if self._state == "preamble" and len(self.text) > self.max_preamble_chars:
+            raise StreamingViolation("no JSON object in the output", self.text)
+        return fields
+
+    @property
+    def json_text(self) -> Optional[str]:
+        """
+        The parsed object's text, once it is complete.
+        """
+        return self.text[self.start : self.end] if self.done else None
+
+    def _step(self, char: str) -> Optional[Tuple[str, Any]]:
+        state = self._state
+
+        if state == "preamble":
+            if char == "{":
+                self.start = self._pos
+                self._state = "key_or_end"
+
+        elif state in ("key_or_end", "key"):
+            if char.isspace():
+                pass
+            elif char == '"':
+                self._token_start = self._pos
+                self._state = "key_string"
+            elif char == "}" and state == "key_or_end":
+                self._finish()
+            else:
+                self._violation(f"unexpected {char!r} where a key was expected")
+
+        elif state == "key_string":
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._key = json.loads(self.text[self._token_start : self._pos + 1])
+                self._state = "colon"
+
+        elif state == "colon":
+            if char == ":":
+                self._token_start = self._pos + 1
+                self._state = "value"
+            elif not char.isspace():
+                self._violation(f"unexpected {char!r} after key {self._key!r}")
+
+        elif state == "value":
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+            elif char in "]}" and self._depth > 0:
+                self._depth -= 1
+            elif char in ",}" and self._depth == 0:
+                field = self._value()
+                if char == "}":
+                    self._finish()
+                else:
+                    self._state = "key"
+                return field
+        return None
+
+    def _value(self) -> Tuple[str, Any]:
+        raw = self.text[self._token_start : self._pos].strip()
+        try:
+            return self._key, json.loads(raw)
+        except json.JSONDecodeError:
+            self._violation(f"invalid JSON value for {self._key!r}: {raw[:50]!r}")
+
+    def _finish(self):
+        self.end = self._pos + 1
+        self.done = True
+        self._state = "done"
+
+    def _violation(self, reason: str):
+        raise StreamingViolation(reason, self.text)
+
+
+class FieldValidator:
+    """
+    Validates single fields of `model_cls` as they are parsed.
+    """
+
+    def __init__(self, model_cls: Type[BaseModel] = ChangeInAccountValue):
+        self.model_cls = model_cls
+        self._adapters = {
+            name: TypeAdapter(info.annotation)
+            for name, info in model_cls.model_fields.items()
+        }
+
+    def validate(self, key: str, value: Any, text: str = "") -> Any:
+        if key not in self._adapters:
+            raise StreamingViolation(f"unknown field {key!r}", text)
+        try:
+            return self._adapters[key].validate_python(value)
+        except ValidationError as e:
+            raise StreamingViolation(
+                f"invalid {key!r}: {e.errors()[0]['msg']}", text
+            ) from None
+
+
+@dataclass
+class PartialExtraction:
+    """
+    The fields streamed so far. The last PartialExtraction of a stream has
+    done=True and output set to the complete JSON object.
+    """
+
+    fields: Dict[str, Any] = field(default_factory=dict)
+    done: bool = False
+    output: Optional[str] = None
+    attempt: int = 1
+    elapsed_s: float = 0.0
+
+
+def iter_chunk_text(chunk) -> Iterator[str]:
+    for choice in chunk.choices or []:
+        content = getattr(choice.delta, "content", None)
+        if content:
+            yield content
+
+
+async def a_stream_fields(
+    stream,
+    model_cls: Type[BaseModel] = ChangeInAccountValue,
+    max_completion_chars: int = 4000,
+    max_preamble_chars: int = 200,
+    attempt: int = 1,
+) -> AsyncIterator[PartialExtraction]:
+    """
+    Consumes a streamed chat completion and yields a PartialExtraction every
+    time a field of `model_cls` is complete and valid.
+
+    Raises StreamingViolation, after closing the stream so no more tokens are
+    generated, on the first invalid field or once the completion is longer
+    than max_completion_chars.
+    """
+    parser = IncrementalJSONParser(max_preamble_chars)
+    validator = FieldValidator(model_cls)
+    partial = PartialExtraction(attempt=attempt)
+    start = time.perf_counter()
+
+    try:
+        async with aclosing(aiter(stream)) as chunks:
+            while True:
+                # not around the yields, so the caller's time isn't counted
+                with timed("model_call"):
+                    chunk = await anext(chunks, None)
+                if chunk is None:
+                    break
+
+                if getattr(chunk, "usage", None) is not None:
+                    count("prompt_tokens", chunk.usage.prompt_tokens)
+                    count("completion_tokens", chunk.usage.completion_tokens)
+
+                for text in iter_chunk_text(chunk):
+                    for key, value in parser.feed(text):
+                        partial.fields[key] = validator.validate(
+                            key, value, parser.text
+                        )
+                        if len(partial.fields) == 1:
+                            count("time_to_first_field_s", time.perf_counter() - start)
+                        partial.elapsed_s = time.perf_counter() - start
+                        yield replace(partial, fields=dict(partial.fields))
+
+                    if len(parser.text) > max_completion_chars:
+                        raise StreamingViolation(
+                            f"output longer than {max_completion_chars} chars",
+                            parser.text,
+                        )
+    except StreamingViolation as e:
+        await stream.close()
+        count("aborted_streams")
+        # only a rough count: aborted streams don't report usage
+        count("wasted_completion_tokens", len(e.text) // 4)
+        raise
+
+    if not parser.done:
+        raise StreamingViolation("the JSON object was never closed", parser.text)
+
+    partial.done = True
+    partial.output = parser.json_text
+    partial.elapsed_s = time.perf_counter() - start
+    yield partial
+
+
+async def a_stream_completion(
+    client,
+    request: Dict[str, Any],
+    model_cls: Type[BaseModel] = ChangeInAccountValue,
+    **stream_kwargs,
+) -> AsyncIterator[PartialExtraction]:
+    """
+    Starts a streamed chat completion for `request` and yields its partial
+    extractions, see a_stream_fields.
+    """
+    with timed("model_call"):
+        stream = await client.chat.completions.create(
+            **request, stream=True, stream_options={"include_usage": True}
+        )
+    async for partial in a_stream_fields(stream, model_cls, **stream_kwargs):
+        yield partial
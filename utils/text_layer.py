@@ -0,0 +1,188 @@
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from utils.schema import ChangeInAccountValue
+
+# Row labels used by the brokerages we see, per ChangeInAccountValue field,
+# tried in order.
+FIELD_LABELS: Dict[str, Sequence[str]] = {
+    "starting_value": ("Beginning Account Value", "Starting Value"),
+    "credits": ("Additions", "Credits"),
+    "debits": ("Subtractions", "Debits"),
+    "transfer_of_securities": ("Transfer of Securities",),
+    "transaction_costs_fees_and_charges": (
+        "Trans. Costs, Fees & Charges",
+        "Transaction Costs, Fees & Charges",
+    ),
+    "income_reinvested": ("Income Reinvested",),
+    "change_in_investment_value": (
+        "Change in Investment Value",
+        "Change in Value of Investments",
+    ),
+    "ending_value_with_accrued_income": ("Ending Value with Accrued Income",),
+    "accrued_income": ("Accrued Income",),
+    "ending_value": ("Ending Account Value", "Ending Value"),
+    "total_change_in_value": (
+        "Includes Deposits, Withdrawals, and Accrued Income",
+        "Including Deposits and Withdrawals",
+    ),
+}
+
+# Printed on every statement, whatever rows its table has.
+REQUIRED_FIELDS = (
+    "reporting_period_start_date",
+    "reporting_period_end_date",
+    "starting_value",
+    "ending_value",
+)
+
+AMOUNT_PATTERN = re.compile(
+    r"^(\()?([-−–])?\$?([-−–])?(\d{1,3}(?:,\d{3})*|\d+)(\.\d+)?(\))?$"
+)
+DASHES = {"—", "–", "-", "−"}
+
+MONTHS = (
+    "january|february|march|april|may|june|july|august|september|october|"
+    "november|december"
+)
+PERIOD_PATTERNS = (
+    # July 1 – July 31, 2015 / December 1, 2017 - January 31, 2018
+    re.compile(
+        rf"({MONTHS})\s+(\d{{1,2}})(?:,\s*(\d{{4}}))?\s*[-–—]\s*({MONTHS})\s+(\d{{1,2}}),\s*(\d{{4}})",
+        re.IGNORECASE,
+    ),
+    # JUNE 1–30, 2018
+    re.compile(
+        rf"({MONTHS})\s+(\d{{1,2}})\s*[-–—]\s*(\d{{1,2}}),\s*(\d{{4}})",
+        re.IGNORECASE,
+    ),
+)
+
+
+def parse_amount(token: str) -> Optional[float]:
+    """
+    Parses statement amounts like "$1,234.56", "(12.00)" or "−4,614.82".
+    """
+    match = AMOUNT_PATTERN.match(token.strip())
+    if match is None:
+        return None
+    open_paren, sign, inner_sign, integer, decimals, close_paren = match.groups()
+    value = float(integer.replace(",", "") + (decimals or ""))
+    if (open_paren and close_paren) or sign or inner_sign:
+        value = -value
+    return value
+
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r"[^\w&.,()/-]", "", word.lower()).strip(":*")
+
+
+def group_rows(words: List[Tuple], tolerance: float = 3.0) -> List[List[Tuple]]:
+    """
+    Groups PyMuPDF words (x0, y0, x1, y1, text, ...) into visual rows by their
+    vertical center, each row sorted left to right.
+    """
+    rows = []
+    for word in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        center = (word[1] + word[3]) / 2
+        if rows and abs(rows[-1][0] - center) <= tolerance:
+            rows[-1][1].append(word)
+        else:
+            rows.append([center, [word]])
+    return [sorted(row, key=lambda w: w[0]) for _, row in rows]
+
+
+def find_label(row: List[Tuple], label: str) -> Optional[int]:
+    """
+    Index of the last word of `label` in row, if the label appears as consecutive words.
+    """
+    label_words = [_normalize_word(w) for w in label.split()]
+    row_words = [_normalize_word(w[4]) for w in row]
+    for start in range(len(row_words) - len(label_words) + 1):
+        if row_words[start : start + len(label_words)] == label_words:
+            return start + len(label_words) - 1
+    return None
+
+
+def _first_value_after(row: List[Tuple], index: int) -> Tuple[bool, Optional[float]]:
+    """
+    First amount to the right of row[index], i.e. the "This Period" column.
+    A dash means the statement shows no value for the period.
+    """
+    for word in row[index + 1 :]:
+        token = word[4].strip()
+        if token in DASHES:
+            return True, None
+        amount = parse_amount(token)
+        if amount is not None:
+            return True, amount
+    return False, None
+
+
+def parse_reporting_period(text: str) -> Tuple[Optional[str], Optional[str]]:
+    for pattern in PERIOD_PATTERNS:
+        match = pattern.search(text)
+        if match is None:
+            continue
+        groups = match.groups()
+        if len(groups) == 6:
+            start_month, start_day, start_year, end_month, end_day, end_year = groups
+            start_year = start_year or end_year
+        else:
+            start_month, start_day, end_day, end_year = groups
+            end_month, start_year = start_month, end_year
+        try:
+            start = datetime.strptime(
+                f"{start_month} {start_day} {start_year}", "%B %d %Y"
+            )
+            end = datetime.strptime(f"{end_month} {end_day} {end_year}", "%B %d %Y")
+        except ValueError:
+            continue
+        return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+    return None, None
+
+
+def parse_change_in_account_value(
+    text: str, words: List[Tuple]
+) -> Tuple[ChangeInAccountValue, List[str]]:
+    """
+    Deterministically fills ChangeInAccountValue from a PDF page's text layer by
+    matching row labels and reading the first amount to their right.
+
+    Returns the parsed object and the list of fields that were found on the page.
+    """
+    values = {}
+    rows = group_rows(words)
+
+    for field, labels in FIELD_LABELS.items():
+        for label in labels:
+            for row in rows:
+                index = find_label(row, label)
+                if index is None:
+                    continue
+                # "Ending Value with Accrued Income" must not count as "Ending Value"
+                if (
+                    field == "ending_value"
+                    and find_label(row, "Accrued Income") is not None
+                ):
+                    continue
+                found, value = _first_value_after(row, index)
+                if found:
+                    values[field] = value
+                    break
+            if field in values:
+                break
+
+    start_date, end_date = parse_reporting_period(text)
+    if start_date:
+        values["reporting_period_start_date"] = start_date
+        values["reporting_period_end_date"] = end_date
+
+    return ChangeInAccountValue(**values), list(values)
+
+
+def is_complete_extraction(extraction: Optional[ChangeInAccountValue]) -> bool:
+    return extraction is not None and all(
+        getattr(extraction, field) is not None for field in REQUIRED_FIELDS
+    )
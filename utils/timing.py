@@ -0,0 +1,99 @@
+import functools
+import inspect
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# Stages the extraction pipeline reports time for.
+STAGES = ("git", "prompt_fetch", "image_encoding", "model_call", "tracing")
+
+
+class Timings:
+    """
+    Seconds spent per stage and counters (bytes, tokens, turns) for one unit
+    of work, e.g. one document.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, float] = defaultdict(float)
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        return {"stages": dict(self.stages), "counters": dict(self.counters)}
+
+
+_current_timings: ContextVar[Optional[Timings]] = ContextVar(
+    "current_timings", default=None
+)
+# stages the current task is already inside of
+_active_stages: ContextVar[frozenset] = ContextVar("active_stages", default=frozenset())
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collects every timed() stage and count() inside the block, including in
+    asyncio tasks and asyncio.to_thread calls started from it.
+    """
+    timings = Timings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Adds the time spent in the block to `stage` of the current collection.
+    Nested blocks of the same stage are only counted once, concurrent ones
+    (e.g. parallel model calls) are summed. Does nothing outside
+    collect_timings().
+    """
+    timings = _current_timings.get()
+    active = _active_stages.get()
+    if timings is None or stage in active:
+        yield
+        return
+
+    token = _active_stages.set(active | {stage})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.stages[stage] += time.perf_counter() - start
+        _active_stages.reset(token)
+
+
+def timed_function(stage: str):
+    """
+    Decorator version of timed(), for sync and async functions.
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, value: float = 1):
+    timings = _current_timings.get()
+    if timings is not None and value:
+        timings.counters[name] += value
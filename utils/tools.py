@@ -0,0 +1,180 @@
+import ast
+import json
+import operator
+from decimal import Decimal, localcontext
+from typing import Annotated, Any, Callable, Dict, List, Optional, Tuple
+
+from utils.timing import count
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+_UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+
+def _evaluate(node: ast.AST) -> Decimal:
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        # from the literal's text, not the float, so 0.1 stays 0.1
+        return Decimal(str(node.value))
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        return _BINARY_OPERATORS[type(node.op)](
+            _evaluate(node.left), _evaluate(node.right)
+        )
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_evaluate(node.operand))
+    raise ValueError(f"Unsupported expression: {ast.dump(node)}")
+
+
+def evaluate_expression(expression: str, precision: int = 28) -> Decimal:
+    """
+    Value of an arithmetic expression of numbers, + - * / and parentheses,
+    computed in Decimal. Thousands separators and $ signs are ignored, so
+    amounts can be copied from a statement as printed.
+    """
+    cleaned = expression.replace(",", "").replace("$", "").strip()
+    with localcontext() as context:
+        context.prec = precision
+        try:
+            return +_evaluate(ast.parse(cleaned, mode="eval"))
+        except SyntaxError:
+            raise ValueError(f"Invalid expression: {expression}") from None
+
+
+def format_decimal(value: Decimal) -> str:
+    text = format(value.normalize(), "f")
+    return "0" if text == "-0" else text
+
+
+def calculator(
+    expressions: Annotated[
+        List[str],
+        "Arithmetic expressions with + - * / and parentheses, "
+        "e.g. ['3295752.51 + 37997.22 - 37974.82', '45927.86 / 3']",
+    ],
+) -> Dict[str, str]:
+    """
+    Evaluates every expression exactly, so all the identities of an extraction
+    can be checked in one call. An expression that can't be evaluated gets
+    an error message instead of a value.
+    """
+    results = {}
+    for expression in expressions:
+        try:
+            results[expression] = format_decimal(evaluate_expression(expression))
+        except ZeroDivisionError:
+            results[expression] = "Error: division by zero"
+        except (ValueError, ArithmeticError) as e:
+            results[expression] = f"Error: {type(e).__name__}: {e}"
+    return results
+
+
+class LocalTools:
+    """
+    Deterministic tools run by the agent that calls them: when the agent's
+    model replies with calls to these tools only, they are executed in
+    process and their results sent back to the model straight away, instead
+    of a round trip through the agent registered for their execution and an
+    extra conversation turn.
+
+    At most max_rounds tool rounds are run per reply. The tool calls and
+    results stay out of the chat history, only the final reply is sent.
+    """
+
+    def __init__(
+        self,
+        tools: Dict[str, Tuple[Callable[..., Any], str]],
+        max_rounds: int = 5,
+    ):
+        self.tools = tools
+        self.max_rounds = max_rounds
+
+    def add_to_agent(self, agent):
+        from autogen import Agent
+
+        for name, (func, description) in self.tools.items():
+            agent.register_for_llm(name=name, description=description)(func)
+        agent.register_reply([Agent, None], self.reply, position=0)
+        agent.register_reply(
+            [Agent, None],
+            self.a_reply,
+            position=0,
+            ignore_async_in_sync_chat=True,
+        )
+
+    def local_tool_calls(self, reply: Any) -> Optional[List[Dict[str, Any]]]:
+        if not isinstance(reply, dict) or not reply.get("tool_calls"):
+            return None
+        tool_calls = reply["tool_calls"]
+        if any(call["function"]["name"] not in self.tools for call in tool_calls):
+            return None
+        return tool_calls
+
+    def run(self, call: Dict[str, Any]) -> str:
+        func, _ = self.tools[call["function"]["name"]]
+        try:
+            result = func(**json.loads(call["function"]["arguments"] or "{}"))
+        except Exception as e:
+            result = f"Error: {type(e).__name__}: {e}"
+        count("local_tool_calls")
+        return result if isinstance(result, str) else json.dumps(result)
+
+    def with_results(
+        self, messages: List[Dict[str, Any]], reply: Dict[str, Any], tool_calls
+    ) -> List[Dict[str, Any]]:
+        return [
+            *messages,
+            {
+                "role": "assistant",
+                "content": reply.get("content"),
+                "tool_calls": tool_calls,
+            },
+            *(
+                {
+                    "role": "tool",
+                    "tool_call_id": call.get("id"),
+                    "content": self.run(call),
+                }
+                for call in tool_calls
+            ),
+        ]
+
+    def generate_oai_reply(self, agent, messages, sender):
+        """
+        agent.generate_oai_reply, with calls to the local tools answered in
+        process.
+        """
+        messages = list(
+            messages if messages is not None else agent.chat_messages[sender]
+        )
+        final, reply = agent.generate_oai_reply(messages, sender)
+        for _ in range(self.max_rounds):
+            tool_calls = self.local_tool_calls(reply)
+            if tool_calls is None:
+                break
+            messages = self.with_results(messages, reply, tool_calls)
+            final, reply = agent.generate_oai_reply(messages, sender)
+        return final, reply
+
+    async def a_generate_oai_reply(self, agent, messages, sender):
+        messages = list(
+            messages if messages is not None else agent.chat_messages[sender]
+        )
+        final, reply = await agent.a_generate_oai_reply(messages, sender)
+        for _ in range(self.max_rounds):
+            tool_calls = self.local_tool_calls(reply)
+            if tool_calls is None:
+                break
+            messages = self.with_results(messages, reply, tool_calls)
+            final, reply = await agent.a_generate_oai_reply(messages, sender)
+        return final, reply
+
+    def reply(self, recipient, messages=None, sender=None, config=None):
+        return self.generate_oai_reply(recipient, messages, sender)
+
+    async def a_reply(self, recipient, messages=None, sender=None, config=None):
+        return await self.a_generate_oai_reply(recipient, messages, sender)
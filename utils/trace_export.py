@@ -0,0 +1,216 @@
+import atexit
+import hashlib
+import queue
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from functools import lru_cache
+from os import getenv
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.utils import get_langfuse_client
+
+# References of the images already hashed, by id() since PIL images aren't
+# hashable, so an image sent on every turn is only hashed once.
+_IMAGE_REFS: Dict[int, Dict[str, Any]] = {}
+
+
+def media_ref(data: bytes, mime_type: str = None) -> Dict[str, Any]:
+    return {
+        "media_ref": "sha256:" + hashlib.sha256(data).hexdigest(),
+        "mime_type": mime_type,
+        "bytes": len(data),
+    }
+
+
+def _image_ref(image) -> Dict[str, Any]:
+    ref = _IMAGE_REFS.get(id(image))
+    if ref is None:
+        ref = media_ref(image.tobytes(), f"image/raw;{image.mode};{image.size}")
+        _IMAGE_REFS[id(image)] = ref
+        weakref.finalize(image, _IMAGE_REFS.pop, id(image), None)
+    return ref
+
+
+def strip_media(value: Any) -> Any:
+    """
+    Copy of value with inline media replaced by a content hash reference:
+    base64 data URLs, bytes, and PIL images (as in MultimodalConversableAgent
+    messages).
+    """
+    if isinstance(value, str):
+        if value.startswith("data:") and ";base64," in value[:100]:
+            header, data = value.split(",", 1)
+            return media_ref(data.encode(), header[5:].split(";")[0])
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return media_ref(bytes(value))
+    if isinstance(value, dict):
+        return {key: strip_media(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [strip_media(item) for item in value]
+    if hasattr(value, "tobytes") and hasattr(value, "mode"):
+        return _image_ref(value)
+    return value
+
+
+@dataclass
+class TraceEvent:
+    """
+    Input of one observation: the messages added since the previous one.
+    """
+
+    trace_id: Optional[str]
+    observation_id: Optional[str]
+    messages: List[Any]
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
+def export_to_langfuse(batch: List[TraceEvent]):
+    from langfuse.client import StatefulGenerationClient, StateType
+
+    client = get_langfuse_client()
+    for event in batch:
+        if event.observation_id is None or event.trace_id is None:
+            continue
+        # an update only sets the given fields of the observation
+        StatefulGenerationClient(
+            client.client,
+            event.observation_id,
+            StateType.OBSERVATION,
+            event.trace_id,
+            client.task_manager,
+        ).update(input=strip_media(event.messages), metadata=event.metadata)
+
+
+class TraceExporter:
+    """
+    Bounded queue of TraceEvents exported in batches by a background thread,
+    so the work of tracing a turn (copying, hashing images, serializing) stays
+    off the caller's path.
+
+    When the queue is full, submit() waits up to max_wait_s for room and then
+    drops the event; dropped events are counted, never raised.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 1000,
+        batch_size: int = 50,
+        flush_interval_s: float = 0.5,
+        max_wait_s: float = 0.0,
+        export: Callable[[List[TraceEvent]], None] = export_to_langfuse,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.max_wait_s = max_wait_s
+        self.export = export
+
+        self.submitted = 0
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_error: Optional[str] = None
+
+        self._queue: "queue.Queue[TraceEvent]" = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def submit(self, event: TraceEvent) -> bool:
+        self._ensure_worker()
+        try:
+            if self.max_wait_s > 0:
+                self._queue.put(event, timeout=self.max_wait_s)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def flush(self):
+        """
+        Blocks until every submitted event has been exported.
+        """
+        if self._worker is not None:
+            self._queue.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "exported": self.exported,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batches,
+                "queued": self._queue.qsize(),
+                "last_error": self.last_error,
+            }
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="trace-exporter", daemon=True
+                )
+                self._worker.start()
+                atexit.register(self.flush)
+
+    def _next_batch(self) -> List[TraceEvent]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval_s
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.export(batch)
+                with self._lock:
+                    self.exported += len(batch)
+                    self.batches += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += len(batch)
+                    self.last_error = f"{type(e).__name__}: {e}"
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+@lru_cache(maxsize=None)
+def get_trace_exporter() -> TraceExporter:
+    return TraceExporter(
+        max_queue_size=int(getenv("TRACE_QUEUE_SIZE", 1000)),
+        batch_size=int(getenv("TRACE_BATCH_SIZE", 50)),
+        flush_interval_s=float(getenv("TRACE_FLUSH_INTERVAL_S", 0.5)),
+        max_wait_s=float(getenv("TRACE_MAX_WAIT_S", 0.0)),
+    )
+
+
+def new_messages(
+    seen_counts: Dict[Any, int], key: Any, messages: List[Any]
+) -> Tuple[int, List[Any]]:
+    """
+    (offset, messages) of the messages added to a conversation since the last
+    call for `key`. The caller removes `key` from seen_counts when the
+    conversation's history is cleared.
+    """
+    seen = seen_counts.get(key, 0)
+    seen_counts[key] = len(messages)
+    return seen, messages[seen:]
@@ -0,0 +1,55 @@
+import functools
+import inspect
+from typing import Any, Callable
+
+
+class _LazyLangfuseContext:
+    """
+    Stand-in for langfuse.decorators.langfuse_context that only imports
+    langfuse the first time it is used.
+    """
+
+    def __getattr__(self, name: str) -> Any:
+        from langfuse.decorators import langfuse_context
+
+        return getattr(langfuse_context, name)
+
+
+langfuse_context = _LazyLangfuseContext()
+
+
+def observe(*args, **kwargs) -> Callable:
+    """
+    langfuse.decorators.observe, applied on the decorated function's first
+    call instead of at import time. Takes the same arguments, and can be used
+    with or without them.
+    """
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return observe()(args[0])
+
+    def decorator(func):
+        observed = None
+
+        def get_observed():
+            nonlocal observed
+            if observed is None:
+                from langfuse.decorators import observe as langfuse_observe
+
+                observed = langfuse_observe(*args, **kwargs)(func)
+            return observed
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*f_args, **f_kwargs):
+                return await get_observed()(*f_args, **f_kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*f_args, **f_kwargs):
+            return get_observed()(*f_args, **f_kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,18 +1,30 @@
-import base64
-from langfuse import Langfuse
+import threading
+from os import getenv
 from utils.schema import ChangeInAccountValue
-from git import Repo
+from utils.json_recovery import recover_extraction
 from pathlib import Path
-from typing import Union, Dict, Any
-from autogen.code_utils import extract_code
+from typing import TYPE_CHECKING, Union, Dict, Any, Optional
+from utils.timing import timed
 
+# langfuse and GitPython are slow to import, they are imported where they are
+# used.
+if TYPE_CHECKING:
+    from langfuse import Langfuse
 
-langfuse_client = Langfuse()
 
+def get_langfuse_client() -> "Langfuse":
+    """
+    The process-wide Langfuse client. It is the same instance the @observe
+    decorators and the langfuse.openai integration use, so there is a single
+    background flush thread and HTTP session.
+    """
+    from langfuse.utils.langfuse_singleton import LangfuseSingleton
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    return LangfuseSingleton().get(
+        host=getenv("LANGFUSE_HOST"),
+        secret_key=getenv("LANGFUSE_SECRET_KEY"),
+        public_key=getenv("LANGFUSE_PUBLIC_KEY"),
+    )
 
 
 def create_langfuse_text_prompt(
@@ -27,7 +39,7 @@ def create_langfuse_text_prompt(
     if model_kwargs:
         config["model_kwargs"] = model_kwargs
 
-    langfuse_client.create_prompt(
+    get_langfuse_client().create_prompt(
         name=prompt_name,
         prompt=prompt,
         labels=labels,
@@ -50,7 +62,7 @@ def create_langfuse_chat_prompt(
     if model_kwargs:
         config["model_kwargs"] = model_kwargs
 
-    langfuse_client.create_prompt(
+    get_langfuse_client().create_prompt(
         name=prompt_name,
         prompt=messages,
         labels=labels,
@@ -105,6 +117,8 @@ def get_git_repository_info(
     repo_path: Union[Path, str],
 ) -> Dict[str, Any]:
 
+    from git import Repo
+
     repo = Repo(path=repo_path, search_parent_directories=True)
     return {
         "commit_hash": repo.head.commit.hexsha,
@@ -114,11 +128,116 @@ def get_git_repository_info(
         "untracked_files": repo.untracked_files,
     }
 
-def extract_jsons_from_message_content(message_content):
-    code_outputs = extract_code(message_content)
-    json_outputs = []
-    for code_output in code_outputs:
-        if code_output[0] == "json":
-            json_outputs.append(code_output[1])
-    return json_outputs
 
+_GIT_INFO_CACHE: Dict[Any, Any] = {}
+_GIT_INFO_LOCK = threading.Lock()
+
+
+def _find_git_dir(repo_path: Union[Path, str]) -> Optional[Path]:
+    """
+    Walk up from repo_path looking for a .git directory (or a .git file pointing
+    at one, as used by worktrees and submodules).
+    """
+    for directory in [Path(repo_path).resolve(), *Path(repo_path).resolve().parents]:
+        git_path = directory / ".git"
+        if git_path.is_dir():
+            return git_path
+        if git_path.is_file():
+            content = git_path.read_text().strip()
+            if content.startswith("gitdir:"):
+                return (directory / content[len("gitdir:") :].strip()).resolve()
+    return None
+
+
+def _head_state(git_dir: Path):
+    """
+    Returns (ref_name, ref_file, stat signature) for HEAD. The signature changes
+    whenever HEAD is moved or the branch it points at gets a new commit.
+    """
+    head_file = git_dir / "HEAD"
+    head = head_file.read_text().strip()
+    ref_name = head[len("ref:") :].strip() if head.startswith("ref:") else None
+
+    # worktrees keep refs in the common dir
+    common_dir = git_dir
+    if (git_dir / "commondir").is_file():
+        common_dir = (git_dir / (git_dir / "commondir").read_text().strip()).resolve()
+
+    ref_file = common_dir / ref_name if ref_name else None
+    signature = [head]
+    for path in (head_file, ref_file, common_dir / "packed-refs"):
+        if path is not None and path.exists():
+            stat = path.stat()
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        else:
+            signature.append(None)
+
+    return ref_name, ref_file, common_dir, tuple(signature)
+
+
+def _read_commit_hash(git_dir: Path) -> Optional[str]:
+    ref_name, ref_file, common_dir, _ = _head_state(git_dir)
+    if ref_name is None:
+        # detached HEAD holds the hash directly
+        return (git_dir / "HEAD").read_text().strip()
+    if ref_file.exists():
+        return ref_file.read_text().strip()
+    packed_refs = common_dir / "packed-refs"
+    if packed_refs.exists():
+        for line in packed_refs.read_text().splitlines():
+            if line.endswith(f" {ref_name}"):
+                return line.split(" ", 1)[0]
+    return None
+
+
+def get_cached_git_repository_info(
+    repo_path: Union[Path, str],
+    lightweight: bool = True,
+) -> Dict[str, Any]:
+    """
+    Process-wide memoized version of get_git_repository_info.
+
+    The result is cached per repository and only recomputed when HEAD changes.
+    With lightweight=True only the commit hash and branch name are read straight
+    from the .git directory, skipping GitPython, `git diff` and the untracked
+    files scan. When there is no .git directory (e.g. a deployed build) the
+    commit hash is taken from the GIT_COMMIT_HASH environment variable.
+    """
+    git_dir = _find_git_dir(repo_path)
+
+    if git_dir is None:
+        return {"commit_hash": getenv("GIT_COMMIT_HASH"), "branch_name": None}
+
+    ref_name, _, _, signature = _head_state(git_dir)
+    cache_key = (str(git_dir), lightweight)
+
+    with _GIT_INFO_LOCK:
+        cached = _GIT_INFO_CACHE.get(cache_key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        if lightweight:
+            info = {
+                "commit_hash": _read_commit_hash(git_dir),
+                "branch_name": (
+                    ref_name.removeprefix("refs/heads/") if ref_name else None
+                ),
+            }
+        else:
+            info = get_git_repository_info(repo_path)
+
+        _GIT_INFO_CACHE[cache_key] = (signature, info)
+        return info
+
+
+def get_commit_hash(repo_path: Union[Path, str]) -> Optional[str]:
+    with timed("git"):
+        return get_cached_git_repository_info(repo_path)["commit_hash"]
+
+
+def parse_extraction(content: Optional[str]) -> Optional[ChangeInAccountValue]:
+    """
+    Parses a ChangeInAccountValue from a message: bare JSON, a ```json block,
+    JSON within prose, or defective JSON that utils.json_recovery can repair.
+    """
+    return recover_extraction(content).extraction
@@ -0,0 +1,214 @@
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from utils.schema import ChangeInAccountValue
+
+# Terms added to starting_value to get ending_value. Debits are always
+# subtracted, whatever sign the statement prints them with. Some brokerages
+# already include fees in debits, so the identity is accepted with or without
+# the fees term.
+FLOW_TERMS = (
+    "credits",
+    "transfer_of_securities",
+    "income_reinvested",
+    "change_in_investment_value",
+)
+NEGATIVE_FLOW_TERMS = ("debits",)
+OPTIONAL_NEGATIVE_FLOW_TERMS = ("transaction_costs_fees_and_charges",)
+
+
+@dataclass
+class IdentityCheck:
+    name: str
+    fields: List[str]
+    expected: Optional[float] = None
+    actual: Optional[float] = None
+    # False when a required field is missing and the identity can't be checked
+    checked: bool = True
+    ok: bool = True
+
+    @property
+    def difference(self) -> Optional[float]:
+        if self.expected is None or self.actual is None:
+            return None
+        return self.actual - self.expected
+
+
+@dataclass
+class ValidationReport:
+    checks: List[IdentityCheck] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return all(check.ok for check in self.checks)
+
+    @property
+    def checked(self) -> bool:
+        """
+        True when at least one identity had all its fields.
+        """
+        return any(check.checked for check in self.checks)
+
+    @property
+    def failures(self) -> List[IdentityCheck]:
+        return [check for check in self.checks if not check.ok]
+
+    @property
+    def failing_fields(self) -> List[str]:
+        fields = []
+        for check in self.failures:
+            fields.extend(f for f in check.fields if f not in fields)
+        return fields
+
+    def summary(self) -> str:
+        if self.ok:
+            return "All accounting identities hold."
+        lines = ["These accounting identities do not hold:"]
+        for check in self.failures:
+            lines.append(
+                f"- {check.name} ({', '.join(check.fields)}): expected "
+                f"{check.expected:,.2f}, got {check.actual:,.2f} "
+                f"(difference {check.difference:,.2f})"
+            )
+        return "\n".join(lines)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ok": self.ok,
+            "checked": self.checked,
+            "failing_fields": self.failing_fields,
+            "checks": [asdict(check) for check in self.checks],
+        }
+
+
+def _close(a: float, b: float, abs_tolerance: float, rel_tolerance: float) -> bool:
+    return abs(a - b) <= max(abs_tolerance, rel_tolerance * max(abs(a), abs(b)))
+
+
+def _check_any(
+    name: str,
+    actual_field: str,
+    actual: Optional[float],
+    candidates: Sequence[tuple],
+    abs_tolerance: float,
+    rel_tolerance: float,
+) -> IdentityCheck:
+    """
+    Passes if `actual` matches any of the (fields, expected) candidates. On
+    failure the first candidate is reported.
+    """
+    candidates = [c for c in candidates if c[1] is not None]
+    if actual is None or not candidates:
+        return IdentityCheck(name=name, fields=[actual_field], checked=False)
+
+    for fields, expected in candidates:
+        if _close(actual, expected, abs_tolerance, rel_tolerance):
+            return IdentityCheck(
+                name=name,
+                fields=[*fields, actual_field],
+                expected=expected,
+                actual=actual,
+            )
+
+    fields, expected = candidates[0]
+    return IdentityCheck(
+        name=name,
+        fields=[*fields, actual_field],
+        expected=expected,
+        actual=actual,
+        ok=False,
+    )
+
+
+def validate_change_in_account_value(
+    extraction: Union[ChangeInAccountValue, Dict[str, Any]],
+    abs_tolerance: float = 0.05,
+    rel_tolerance: float = 5e-4,
+) -> ValidationReport:
+    """
+    Checks the accounting identities between ChangeInAccountValue fields:
+
+    - starting_value + credits - debits + transfer_of_securities
+      + income_reinvested + change_in_investment_value (- fees) ≈ ending_value
+    - total_change_in_value ≈ ending_value (or ending_value_with_accrued_income)
+      - starting_value
+    - ending_value_with_accrued_income ≈ ending_value + accrued_income
+
+    Identities whose fields are missing are skipped, not failed. Values match
+    when they are within abs_tolerance or rel_tolerance of each other.
+    """
+    if isinstance(extraction, dict):
+        extraction = ChangeInAccountValue.model_validate(extraction)
+    values = extraction.model_dump()
+    tolerances = {"abs_tolerance": abs_tolerance, "rel_tolerance": rel_tolerance}
+
+    report = ValidationReport()
+
+    starting_value = values["starting_value"]
+    ending_value = values["ending_value"]
+
+    flow_fields = [f for f in FLOW_TERMS + NEGATIVE_FLOW_TERMS if values[f] is not None]
+    flow_candidates = []
+    if starting_value is not None and flow_fields:
+        flow = starting_value
+        flow += sum(values[f] for f in FLOW_TERMS if values[f] is not None)
+        flow -= sum(
+            abs(values[f]) for f in NEGATIVE_FLOW_TERMS if values[f] is not None
+        )
+        fields = ["starting_value", *flow_fields]
+        flow_candidates.append((fields, flow))
+
+        fee_fields = [f for f in OPTIONAL_NEGATIVE_FLOW_TERMS if values[f] is not None]
+        if fee_fields:
+            fees = sum(abs(values[f]) for f in fee_fields)
+            flow_candidates.append(([*fields, *fee_fields], flow - fees))
+
+    report.checks.append(
+        _check_any(
+            "account_value_flow",
+            "ending_value",
+            ending_value,
+            flow_candidates,
+            **tolerances,
+        )
+    )
+
+    total_change_candidates = []
+    if starting_value is not None:
+        for ending_field in ("ending_value", "ending_value_with_accrued_income"):
+            if values[ending_field] is not None:
+                total_change_candidates.append(
+                    (
+                        [ending_field, "starting_value"],
+                        values[ending_field] - starting_value,
+                    )
+                )
+    report.checks.append(
+        _check_any(
+            "total_change_in_value",
+            "total_change_in_value",
+            values["total_change_in_value"],
+            total_change_candidates,
+            **tolerances,
+        )
+    )
+
+    accrued_candidates = []
+    if ending_value is not None and values["accrued_income"] is not None:
+        accrued_candidates.append(
+            (
+                ["ending_value", "accrued_income"],
+                ending_value + values["accrued_income"],
+            )
+        )
+    report.checks.append(
+        _check_any(
+            "ending_value_with_accrued_income",
+            "ending_value_with_accrued_income",
+            values["ending_value_with_accrued_income"],
+            accrued_candidates,
+            **tolerances,
+        )
+    )
+
+    return report